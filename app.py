@@ -1,19 +1,37 @@
+import os
+import uuid
+
 import streamlit as st
 from utils import (
-    generar_datos_generales,
-    generar_syllabus_completo,
-    generar_outline_csv
+    STUDENT_PERSONA, SECCIONES_SYLLABUS, get_google_creds, obtener_servicios, generar_syllabus_y_outline, secreto,
+    id_desde_link, regenerar_secciones_syllabus, actualizar_outline
 )
+from checkpoints import EstadoSyllabus
+from outline import clases_desde_filas
 from generador_clases import (
     leer_outline_desde_sheets,
-    generar_documento_clases_completo
+    generar_clases_desde_outline,
+    generar_clase_en_streaming,
+    contexto_clases,
+    EscritorDocumentoStreaming
 )
+from exportar import exportar_curso, limpiar_exportaciones
+from trabajos import obtener_gestor
+from metricas import iniciar_servidor_metricas
 
 # Configuración de la página de Streamlit
 st.set_page_config(page_title="Generador de Syllabus", layout="centered")
 st.title("🧠 Generador de Syllabus y Outline")
 st.markdown("Completa los campos del curso para generar automáticamente el syllabus y el outline.")
 
+# 📈 Endpoint de métricas del proceso (/metrics y /metrics.json), solo si se configura un puerto
+if secreto("METRICAS_PUERTO", ""):
+    iniciar_servidor_metricas(int(secreto("METRICAS_PUERTO")))
+
+# 🔐 Sin sesión de Google se muestra el botón de conexión y se detiene el script;
+# los clientes de Docs/Drive/Sheets se construyen hasta que se usan por primera vez
+get_google_creds()
+
 # === Inputs del curso ===
 nombre = st.text_input("Nombre del curso")
 nivel = st.selectbox("Nivel del curso", ["básico", "intermedio", "avanzado"])
@@ -21,6 +39,99 @@ publico = st.text_area("Público objetivo (Agregar Industria)")
 objetivos_raw = st.text_area("Objetivos del curso")
 num_clases = st.number_input("Número de clases del curso", min_value=4, max_value=24, value=12, step=1)
 siguiente = st.text_input("Nombre del siguiente curso sugerido", value="N/A")
+regenerar = st.checkbox("🔄 Regenerar contenido (ignorar respuestas guardadas en caché)", value=False)
+diagnostico = st.checkbox("🩺 Mostrar diagnóstico de la generación (tiempos, tokens y llamadas a APIs)", value=False)
+
+
+gestor = obtener_gestor()
+
+
+# === Trabajos en segundo plano: el id vive en la sesión y en la URL para sobrevivir a un refresh ===
+def recordar_trabajo(clave, trabajo_id):
+    st.session_state[clave] = trabajo_id
+    st.query_params[clave] = trabajo_id
+
+
+def trabajo_actual(clave):
+    trabajo_id = st.session_state.get(clave) or st.query_params.get(clave)
+    return gestor.obtener(trabajo_id) if trabajo_id else None
+
+
+EN_CURSO = ("pendiente", "en_curso")
+
+
+@st.fragment(run_every=2)
+def sondear_trabajo(clave, icono_link):
+    # Solo se sondea mientras el trabajo corre: al terminar, un rerun completo muestra el estado
+    # final fuera del fragmento y el fragmento deja de programarse
+    trabajo = trabajo_actual(clave)
+    if trabajo is None or trabajo.estado not in EN_CURSO:
+        st.rerun()
+    mostrar_progreso(trabajo, icono_link)
+
+
+def mostrar_progreso(trabajo, icono_link):
+    total = trabajo.total or 1
+    st.progress(min(trabajo.actual / total, 1.0), text=trabajo.etapa or "En cola...")
+    for idx, link in enumerate(trabajo.links, 1):
+        st.markdown(f"[{icono_link} {idx}]({link})", unsafe_allow_html=True)
+
+
+def mostrar_diagnostico(titulo, metricas):
+    contadores = metricas["contadores"]
+
+    def total(prefijo, filtro=""):
+        return int(sum(v for k, v in contadores.items() if k.startswith(prefijo) and filtro in k))
+
+    with st.expander(f"🩺 Diagnóstico: {titulo} ({metricas['duracion_s']} s)"):
+        col1, col2, col3 = st.columns(3)
+        col1.metric("Tokens de entrada", total("gemini_tokens_total", 'tipo="prompt"'))
+        col2.metric("Tokens de salida", total("gemini_tokens_total", 'tipo="salida"'))
+        col3.metric("Tokens de entrada desde caché de contexto", total("gemini_tokens_total", 'tipo="cache"'))
+        col1, col2, col3 = st.columns(3)
+        col1.metric("Llamadas a Gemini", total("gemini_peticiones_total"))
+        col2.metric("Llamadas a Google", total("google_llamadas_total"))
+        col3.metric("KB enviados a Google", total("google_bytes_enviados_total") // 1024)
+        col1, col2, col3 = st.columns(3)
+        col1.metric("Reintentos a Gemini", total("gemini_reintentos_total"))
+        col2.metric("KB enviados a Gemini", total("gemini_bytes_enviados_total") // 1024)
+        st.dataframe([{"span": nombre, **acumulado} for nombre, acumulado in metricas["por_span"].items()],
+                     hide_index=True)
+        st.json(metricas["spans"], expanded=False)
+
+
+def seguimiento_syllabus():
+    trabajo = trabajo_actual("trabajo_syllabus")
+    if trabajo is None or st.session_state.get("trabajo_syllabus_aplicado") == trabajo.id:
+        return
+    if trabajo.estado in EN_CURSO:
+        sondear_trabajo("trabajo_syllabus", "🔗 Ver archivo listo")
+    elif trabajo.estado == "error":
+        st.error(f"Ha ocurrido un error durante la generación: {trabajo.error}")
+        st.info("Verifica que todos los campos estén completos y que la plantilla tenga los placeholders correctos.")
+    else:
+        # ✅ Guardar los links para mantenerlos visibles y refrescar la página completa
+        st.session_state["link_syllabus"], st.session_state["link_outline"], st.session_state["clases_outline"] = \
+            trabajo.resultado
+        st.session_state["trabajo_syllabus_aplicado"] = trabajo.id
+        st.rerun()
+
+
+def seguimiento_clases():
+    trabajo = trabajo_actual("trabajo_clases")
+    if trabajo is None:
+        return
+    if trabajo.estado in EN_CURSO:
+        sondear_trabajo("trabajo_clases", "📝 Ver documento Parte")
+    elif trabajo.estado == "error":
+        st.error(f"Ocurrió un error: {trabajo.error}")
+        st.info("Vuelve a presionar 'Generar clases desde Outline creado' para reanudar: solo se generará y escribirá lo que falta.")
+    else:
+        st.success("✅ Documento(s) de clases generado(s) exitosamente.")
+        for idx, link in enumerate(trabajo.resultado, 1):
+            st.markdown(f"[📝 Ver documento Parte {idx}]({link})", unsafe_allow_html=True)
+    if diagnostico and trabajo.metricas:
+        mostrar_diagnostico("Clases", trabajo.metricas)
 
 
 # ✅ NUEVO BLOQUE: Mostrar links si ya se generaron previamente
@@ -31,77 +142,182 @@ if "link_syllabus" in st.session_state and "link_outline" in st.session_state:
         st.markdown(f"[📄 Ver Syllabus en Google Docs]({st.session_state['link_syllabus']})", unsafe_allow_html=True)
     with col2:
         st.markdown(f"[📊 Ver Outline en Google Sheets]({st.session_state['link_outline']})", unsafe_allow_html=True)
+    trabajo_syllabus = trabajo_actual("trabajo_syllabus")
+    if diagnostico and trabajo_syllabus and trabajo_syllabus.metricas:
+        mostrar_diagnostico("Syllabus y outline", trabajo_syllabus.metricas)
 
-# Perfil fijo del estudiante tipo
-student_persona = (
-    "Usuario de negocios quiere construir productos de datos pero:\n"
-    "- No tiene el hábito o modelo de trabajo mental de tomar decisiones basadas en datos.\n"
-    "- No tiene conocimiento suficiente para traducir sus problemas a productos de datos.\n"
-    "- No tiene habilidades técnicas para manipular data.\n"
-    "- No colabora activamente con equipos de data.\n"
-    "- Tiene poco tiempo y necesita soluciones prácticas que le ayuden a avanzar ya."
-)
-
-# === Acción principal: Generar syllabus y outline ===
-if st.button("Generar Syllabus y Outline"):
-    with st.spinner("Generando contenido con IA..."):
-        try:
-            perfil_ingreso, objetivos_mejorados, perfil_egreso, outline, \
-            titulo1, desc1, titulo2, desc2, titulo3, desc3 = generar_datos_generales(
-                nombre, nivel, publico, student_persona, siguiente, objetivos_raw, num_clases
-            )
+    # === Correcciones puntuales: se rehace solo lo que depende de lo que cambió ===
+    filas_outline = EstadoSyllabus.de_documento(id_desde_link(st.session_state["link_syllabus"])).leer("filas")
+    if filas_outline:
+        with st.expander("✏️ Corregir una sección o el outline sin regenerar todo"):
+            secciones_elegidas = st.multiselect("Secciones del syllabus a regenerar", list(SECCIONES_SYLLABUS))
+            if st.button("Regenerar secciones seleccionadas", disabled=not secciones_elegidas):
+                try:
+                    obtener_servicios()
+                    with st.spinner("Regenerando secciones..."):
+                        regenerar_secciones_syllabus(st.session_state["link_syllabus"], secciones_elegidas)
+                    st.success("✅ Secciones actualizadas en el mismo syllabus.")
+                except Exception as e:
+                    st.error(f"Ocurrió un error: {str(e)}")
 
-            link_syllabus = generar_syllabus_completo(
-                nombre, nivel, objetivos_mejorados, publico, siguiente,
-                perfil_ingreso, perfil_egreso, outline,
-                titulo1, desc1, titulo2, desc2, titulo3, desc3
+            encabezado = filas_outline[0]
+            editadas = st.data_editor(
+                [dict(zip(encabezado, fila)) for fila in filas_outline[1:]],
+                disabled=[encabezado[0]], hide_index=True, key="editor_outline"
             )
+            if st.button("Guardar cambios del outline"):
+                # Una celda vaciada en el editor llega como None: en la hoja queda vacía, no "None"
+                filas_nuevas = [encabezado] + [["" if fila[columna] is None else str(fila[columna])
+                                                for columna in encabezado] for fila in editadas]
+                try:
+                    obtener_servicios()
+                    with st.spinner("Actualizando outline y plan de estudios..."):
+                        cambiadas = actualizar_outline(st.session_state["link_syllabus"], filas_nuevas)
+                    st.session_state["clases_outline"] = list(clases_desde_filas(filas_nuevas))
+                    if cambiadas:
+                        st.success(f"✅ Clases actualizadas: {', '.join(map(str, cambiadas))}. "
+                                   "Al generar las clases solo se rehacen esas.")
+                    else:
+                        st.info("No hubo cambios en el outline.")
+                except Exception as e:
+                    st.error(f"Ocurrió un error: {str(e)}")
 
-            link_outline = generar_outline_csv(
-                nombre, nivel, objetivos_mejorados, perfil_ingreso, siguiente, outline
-            )
+# Perfil fijo del estudiante tipo
+student_persona = STUDENT_PERSONA
 
-            # ✅ Guardar los links para mantenerlos visibles
-            st.session_state["link_syllabus"] = link_syllabus
-            st.session_state["link_outline"] = link_outline
-            st.session_state["num_clases"] = num_clases  # ✅ persistir el número
+# === Acción principal: Generar syllabus y outline ===
+if st.button("Generar Syllabus y Outline"):
+    obtener_servicios()  # el trabajo hereda los clientes de Google de esta sesión
+    trabajo_id = gestor.enviar(
+        "syllabus", generar_syllabus_y_outline,
+        nombre, nivel, publico, student_persona, siguiente, objetivos_raw, num_clases,
+        regenerar=regenerar
+    )
+    recordar_trabajo("trabajo_syllabus", trabajo_id)
+    st.session_state["num_clases"] = num_clases  # ✅ persistir el número
 
-            st.success("✅ Syllabus y Outline generados correctamente.")
-            col1, col2 = st.columns(2)
-            with col1:
-                st.markdown(f"[📄 Ver Syllabus en Google Docs]({link_syllabus})", unsafe_allow_html=True)
-            with col2:
-                st.markdown(f"[📊 Ver Outline en Google Sheets]({link_outline})", unsafe_allow_html=True)
+seguimiento_syllabus()
 
-        except Exception as e:
-            st.error(f"Ha ocurrido un error durante la generación: {str(e)}")
-            st.info("Verifica que todos los campos estén completos y que la plantilla tenga los placeholders correctos.")
-            
 
 # === Generar clases completas ===
 st.markdown("---")
 st.subheader("📚 Generar contenido completo de clases")
 st.info(f"El curso seleccionado tiene **{num_clases} clases**.")
 
-link_outline_guardado = st.session_state.get("link_outline", None)
+link_outline_externo = st.text_input(
+    "¿Editaste el outline o tienes otro? Pega aquí el link de Google Sheets (opcional)", value=""
+).strip()
+link_outline_guardado = link_outline_externo or st.session_state.get("link_outline", None)
+# El outline recién generado ya está en memoria; solo un outline externo o editado se lee de Sheets
+clases_en_memoria = None if link_outline_externo else st.session_state.get("clases_outline")
+# Los datos del curso (objetivos y perfiles) van con el outline en el prefijo común de las clases;
+# un outline externo puede ser de otro curso, así que solo se usan con el outline recién generado
+curso_guardado = None
+if not link_outline_externo and "link_syllabus" in st.session_state:
+    curso_guardado = EstadoSyllabus.de_documento(id_desde_link(st.session_state["link_syllabus"])).leer("curso")
 num_clases_guardado = st.session_state.get("num_clases", num_clases)
+clases_en_paralelo = st.slider("Clases generadas en paralelo", min_value=1, max_value=8, value=4)
+modo_streaming = st.checkbox("👀 Ver cada clase mientras se genera (una a la vez)", value=False)
+rehacer = st.multiselect(
+    "Rehacer estas clases aunque su fila del outline no haya cambiado (opcional)",
+    list(range(1, num_clases_guardado + 1)), disabled=modo_streaming
+)
 
 if st.button("Generar clases desde Outline creado"):
-    if link_outline_guardado:
-        with st.spinner("Generando documento con las el contenido de las clases completas..."):
-            try:
-                clases_info = leer_outline_desde_sheets(link_outline_guardado)
-                links_docs = generar_documento_clases_completo(
-                    nombre_doc=f"Clases - {nombre}",
-                    clases_info=clases_info,
-                    perfil_estudiante=student_persona,
-                    industria="analítica de datos"
-                )
-                st.success("✅ Documento(s) de clases generado(s) exitosamente.")
-                for idx, link in enumerate(links_docs, 1):
-                    st.markdown(f"[📝 Ver documento Parte {idx}]({link})", unsafe_allow_html=True)
-            except Exception as e:
-                st.error(f"Ocurrió un error: {str(e)}")
+    if link_outline_guardado and modo_streaming:
+        try:
+            clases_info = clases_en_memoria or leer_outline_desde_sheets(link_outline_guardado)
+            escritor = EscritorDocumentoStreaming(f"Clases - {nombre}")
+            with contexto_clases(student_persona, "analítica de datos", clases_info, curso_guardado) as contexto:
+                for numero, clase in enumerate(clases_info, 1):
+                    st.markdown(f"#### CLASE {numero}: {clase['titulo']}")
+                    fragmentos = generar_clase_en_streaming(clase, student_persona, "analítica de datos", regenerar,
+                                                            contexto)
+                    st.write_stream(escritor.escribir_clase(numero, clase["titulo"], fragmentos))
+            links_docs = escritor.cerrar()
+            st.success("✅ Documento(s) de clases generado(s) exitosamente.")
+            for idx, link in enumerate(links_docs, 1):
+                st.markdown(f"[📝 Ver documento Parte {idx}]({link})", unsafe_allow_html=True)
+        except Exception as e:
+            st.error(f"Ocurrió un error: {str(e)}")
+    elif link_outline_guardado:
+        obtener_servicios()  # el trabajo hereda los clientes de Google de esta sesión
+        trabajo_id = gestor.enviar(
+            "clases", generar_clases_desde_outline,
+            link_outline_guardado, f"Clases - {nombre}", student_persona, "analítica de datos",
+            max_workers=clases_en_paralelo, regenerar=regenerar, clases_info=clases_en_memoria, rehacer=rehacer,
+            curso=curso_guardado
+        )
+        recordar_trabajo("trabajo_clases", trabajo_id)
     else:
         st.warning("⚠️ Primero debes generar el syllabus y outline con el botón superior.")
         st.info("Para hacerlo, completa los campos del curso y haz clic en 'Generar Syllabus y Outline'. Luego podrás crear las clases.")
+
+seguimiento_clases()
+
+
+# === Exportar el curso completo a archivos (sin escribir en Google Docs) ===
+st.markdown("---")
+st.subheader("📦 Descargar el curso como archivos")
+st.caption("Syllabus en .docx, outline en .xlsx/.csv y clases en .docx/Markdown, sin esperar a Google Docs.")
+subir_a_drive = st.checkbox("☁️ Subir también a Google Drive al terminar (una carga por archivo)", value=False)
+
+DIRECTORIO_EXPORTACIONES = os.path.join(".cache", "exportaciones")
+
+ETIQUETAS_ARCHIVOS = {
+    "syllabus": "📄 Syllabus (.docx)",
+    "outline_xlsx": "📊 Outline (.xlsx)",
+    "outline_csv": "📊 Outline (.csv)",
+    "clases_docx": "📝 Clases (.docx)",
+    "clases_md": "📝 Clases (Markdown)",
+}
+
+
+def archivos_exportados(trabajo) -> dict:
+    # Los archivos se leen una sola vez por sesión; los reruns reutilizan los bytes
+    clave = f"archivos_{trabajo.id}"
+    if clave not in st.session_state:
+        contenidos = {}
+        for tipo, ruta in trabajo.resultado["archivos"].items():
+            if os.path.exists(ruta):
+                with open(ruta, "rb") as f:
+                    contenidos[tipo] = (os.path.basename(ruta), f.read())
+        st.session_state[clave] = contenidos
+    return st.session_state[clave]
+
+
+def seguimiento_exportacion():
+    trabajo = trabajo_actual("trabajo_exportacion")
+    if trabajo is None:
+        return
+    if trabajo.estado in EN_CURSO:
+        sondear_trabajo("trabajo_exportacion", "🔗 Ver archivo listo")
+    elif trabajo.estado == "error":
+        st.error(f"Ocurrió un error: {trabajo.error}")
+    else:
+        archivos = archivos_exportados(trabajo)
+        if not archivos:
+            st.info("Los archivos de esta exportación ya no están disponibles: vuelve a generarlos.")
+        for clave, (nombre_archivo, contenido) in archivos.items():
+            st.download_button(ETIQUETAS_ARCHIVOS.get(clave, clave), contenido,
+                               file_name=nombre_archivo, key=f"descarga_{trabajo.id}_{clave}")
+        for clave, link in trabajo.resultado["links"].items():
+            st.markdown(f"[{ETIQUETAS_ARCHIVOS.get(clave, clave)} en Google Drive]({link})", unsafe_allow_html=True)
+    if diagnostico and trabajo.metricas:
+        mostrar_diagnostico("Exportación", trabajo.metricas)
+
+
+if st.button("Generar y descargar archivos"):
+    # Los clientes de Google solo hacen falta para subir a Drive o para bajar la plantilla sin copia local
+    obtener_servicios()
+    # Cada exportación queda en su carpeta un día (para volver a descargarla tras un refresh) y luego se borra
+    limpiar_exportaciones(DIRECTORIO_EXPORTACIONES)
+    trabajo_id = gestor.enviar(
+        "exportacion", exportar_curso,
+        os.path.join(DIRECTORIO_EXPORTACIONES, uuid.uuid4().hex), nombre, nivel, publico, student_persona,
+        siguiente, objetivos_raw, num_clases,
+        max_workers=clases_en_paralelo, regenerar=regenerar, subir=subir_a_drive
+    )
+    recordar_trabajo("trabajo_exportacion", trabajo_id)
+
+seguimiento_exportacion()
@@ -0,0 +1,356 @@
+"""Benchmark de punta a punta: syllabus, outline y documento de clases contra servidores falsos.
+
+Uso:
+    python benchmarks/bench_pipeline.py [--clases 4,8,12,24] [--sesiones 1,4]
+        [--escala-latencia 0.1] [--error-gemini 0.05,0.02] [--cobertura] [--incremental]
+        [--mismo-curso] [--destino google|local|local+subida] [--salida bench.json]
+
+Levanta `ServidorFalso` en localhost, apunta Gemini y las APIs de Google a él con
+GEMINI_BASE_URL y GOOGLE_API_ENDPOINT, y corre el flujo completo para cada tamaño de
+curso con N sesiones simultáneas. Reporta tiempo total, percentiles por etapa y viajes
+de ida y vuelta por artefacto en JSON, para comparar entre commits. Con --incremental,
+cada sesión además edita una fila del outline y pone al día syllabus y clases en su lugar.
+Con --mismo-curso, las sesiones simultáneas de un escenario piden el mismo curso. Con
+--destino local, el curso se escribe en archivos (.docx, .xlsx, .md) en lugar de Google;
+local+subida además los sube a Drive al final.
+"""
+import argparse
+import functools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+from benchmarks.servidores_falsos import ServidorFalso  # noqa: E402
+from metricas import corrida  # noqa: E402
+
+# Funciones del pipeline que se cronometran como etapas
+ETAPAS = [
+    ("utils", "generar_datos_generales", "datos_generales"),
+    ("utils", "generar_syllabus_completo", "syllabus"),
+    ("utils", "generar_outline_csv", "outline"),
+    ("utils", "generar_syllabus_y_outline", "syllabus_y_outline"),
+    ("generador_clases", "generar_clases_desde_outline", "clases"),
+]
+
+
+class Cronometro:
+    def __init__(self):
+        self.tiempos = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def registrar(self, etapa: str, segundos: float):
+        with self.lock:
+            self.tiempos[etapa].append(segundos)
+
+    def tomar(self) -> dict:
+        with self.lock:
+            tiempos, self.tiempos = self.tiempos, defaultdict(list)
+        return tiempos
+
+    def instrumentar(self, modulo, nombre: str, etapa: str):
+        # Se reemplaza el atributo del módulo: las llamadas internas (p. ej. de
+        # generar_syllabus_y_outline a generar_datos_generales) también pasan por aquí
+        original = getattr(modulo, nombre)
+
+        @functools.wraps(original)
+        def cronometrada(*args, **kwargs):
+            inicio = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.registrar(etapa, time.perf_counter() - inicio)
+
+        setattr(modulo, nombre, cronometrada)
+
+
+def percentil(valores: list, p: float) -> float:
+    ordenados = sorted(valores)
+    if not ordenados:
+        return None
+    indice = min(len(ordenados) - 1, max(0, round(p / 100 * len(ordenados) + 0.5) - 1))
+    return ordenados[indice]
+
+
+def resumen(valores: list) -> dict:
+    return {
+        "n": len(valores),
+        "p50_s": round(percentil(valores, 50), 4),
+        "p90_s": round(percentil(valores, 90), 4),
+        "p99_s": round(percentil(valores, 99), 4),
+        "max_s": round(max(valores), 4),
+    }
+
+
+def preparar_entorno(servidor: ServidorFalso, directorio: str, cobertura: bool = False):
+    from exportar import EscritorDocx
+
+    # Plantilla local con los placeholders del syllabus: la exportación local no la descarga de Drive
+    plantilla = EscritorDocx(os.path.join(directorio, "plantilla.docx"))
+    for placeholder in ("nombre_del_curso", "anio", "generalidades_del_programa", "perfil_ingreso",
+                        "detalles_plan_estudios", "titulo_primer_objetivo_secundario"):
+        plantilla.parrafo(f"{{{{{placeholder}}}}}")
+    plantilla.cerrar()
+    os.environ.update({
+        "SYLLABUS_PLANTILLA_DOCX": os.path.join(directorio, "plantilla.docx"),
+        "GEMINI_COBERTURA": "1" if cobertura else "0",
+        "GEMINI_API_KEY": "clave-falsa",
+        "GEMINI_BASE_URL": f"{servidor.url}/v1beta",
+        "GOOGLE_API_ENDPOINT": servidor.url,
+        # Límites altos: el benchmark mide el pipeline, no el token bucket
+        "GEMINI_RPM": "100000",
+        "GEMINI_TPM": "1000000000",
+        "GEMINI_CACHE_PATH": os.path.join(directorio, "gemini.sqlite"),
+    })
+    # Los checkpoints se escriben relativos al cwd: un directorio nuevo = corrida en frío
+    os.chdir(directorio)
+
+
+def corregir_una_clase(link_syllabus: str, link_outline: str, nombre: str, workers_clases: int) -> dict:
+    import generador_clases
+    import utils
+    from checkpoints import EstadoSyllabus
+    from outline import clases_desde_filas
+
+    # Se cambia la descripción de la clase de en medio: debe rehacerse solo esa clase y su sección
+    filas = EstadoSyllabus.de_documento(utils.id_desde_link(link_syllabus)).leer("filas")
+    filas[len(filas) // 2][-1] += " (revisada)"
+    inicio = time.perf_counter()
+    with corrida(f"{nombre} incremental") as traza:
+        utils.actualizar_outline(link_syllabus, filas)
+        generador_clases.generar_clases_desde_outline(
+            link_outline, f"Clases - {nombre}", utils.STUDENT_PERSONA, "analítica de datos",
+            max_workers=workers_clases, clases_info=list(clases_desde_filas(filas)),
+            curso=EstadoSyllabus.de_documento(utils.id_desde_link(link_syllabus)).leer("curso"),
+        )
+    return {"total_s": time.perf_counter() - inicio, "contadores": traza.resumen()["contadores"]}
+
+
+def correr_sesion_local(nombre: str, num_clases: int, workers_clases: int, subir: bool) -> dict:
+    from google.auth.credentials import AnonymousCredentials
+
+    import exportar
+    import utils
+
+    inicio = time.perf_counter()
+    with utils.usar_servicios(utils.build_services(AnonymousCredentials())), corrida(nombre) as traza:
+        resultado = exportar.exportar_curso(
+            os.path.join("exportaciones", uuid.uuid4().hex[:8]), nombre, "Intermedio", "Profesionales",
+            utils.STUDENT_PERSONA, "Curso avanzado", "Objetivo uno. Objetivo dos.", num_clases,
+            max_workers=workers_clases, subir=subir,
+        )
+    return {
+        "total_s": time.perf_counter() - inicio,
+        "archivos_kb": {clave: round(os.path.getsize(ruta) / 1024, 1) for clave, ruta in resultado["archivos"].items()},
+        "contadores": traza.resumen()["contadores"],
+    }
+
+
+def correr_sesion(num_clases: int, workers_clases: int, incremental: bool = False, nombre: str = None,
+                  destino: str = "google") -> dict:
+    from google.auth.credentials import AnonymousCredentials
+
+    import generador_clases
+    import utils
+    from checkpoints import EstadoSyllabus
+
+    # Nombre único por sesión: ni st.cache_data ni la caché de Gemini devuelven resultados previos
+    nombre = nombre or f"Curso bench {num_clases} {uuid.uuid4().hex[:8]}"
+    if destino != "google":
+        return correr_sesion_local(nombre, num_clases, workers_clases, subir=destino == "local+subida")
+    inicio = time.perf_counter()
+    with utils.usar_servicios(utils.build_services(AnonymousCredentials())), corrida(nombre) as traza:
+        link_syllabus, link_outline, clases_info = utils.generar_syllabus_y_outline(
+            nombre, "Intermedio", "Profesionales", utils.STUDENT_PERSONA,
+            "Curso avanzado", "Objetivo uno. Objetivo dos.", num_clases,
+        )
+        links = generador_clases.generar_clases_desde_outline(
+            link_outline, f"Clases - {nombre}", utils.STUDENT_PERSONA, "analítica de datos",
+            max_workers=workers_clases, clases_info=clases_info,
+            curso=EstadoSyllabus.de_documento(utils.id_desde_link(link_syllabus)).leer("curso"),
+        )
+    resultado = {
+        "total_s": time.perf_counter() - inicio,
+        "documentos_clases": len(links),
+        "contadores": traza.resumen()["contadores"],
+    }
+    if incremental:
+        with utils.usar_servicios(utils.build_services(AnonymousCredentials())):
+            resultado["incremental"] = corregir_una_clase(link_syllabus, link_outline, nombre, workers_clases)
+    return resultado
+
+
+def viajes_por_artefacto(registros: list, sesiones: int) -> dict:
+    conteo = defaultdict(lambda: defaultdict(int))
+    for registro in registros:
+        conteo[registro["artefacto"]][registro["grupo"]] += 1
+    return {
+        artefacto: {grupo: round(n / sesiones, 2) for grupo, n in sorted(grupos.items())}
+        for artefacto, grupos in sorted(conteo.items())
+    }
+
+
+def contadores_por_curso(resultados: list) -> dict:
+    # Promedio por sesión de los contadores de metricas (tokens, reintentos, bytes)
+    suma = defaultdict(float)
+    for resultado in resultados:
+        for nombre, valor in resultado["contadores"].items():
+            suma[nombre] += valor
+    return {nombre: round(valor / len(resultados), 2) for nombre, valor in sorted(suma.items())}
+
+
+def correr_escenario(servidor: ServidorFalso, cronometro: Cronometro, num_clases: int,
+                     sesiones: int, workers_clases: int, incremental: bool = False, mismo_curso: bool = False,
+                     destino: str = "google") -> dict:
+    servidor.tomar_registros()
+    cronometro.tomar()
+    # Con mismo_curso, todas las sesiones piden lo mismo a la vez (dos instructores, un doble clic)
+    nombre = f"Curso bench {num_clases} {uuid.uuid4().hex[:8]}" if mismo_curso else None
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=sesiones) as executor:
+        futuros = [executor.submit(correr_sesion, num_clases, workers_clases, incremental, nombre, destino)
+                   for _ in range(sesiones)]
+        resultados, errores = [], []
+        for futuro in futuros:
+            try:
+                resultados.append(futuro.result())
+            except Exception as e:
+                errores.append(f"{type(e).__name__}: {e}")
+    pared = time.perf_counter() - inicio
+    registros = servidor.tomar_registros()
+
+    escenario = {
+        "clases": num_clases,
+        "sesiones": sesiones,
+        "sesiones_ok": len(resultados),
+        "errores": errores,
+        "tiempo_pared_s": round(pared, 4),
+        "sesion": resumen([r["total_s"] for r in resultados]) if resultados else None,
+        "etapas": {etapa: resumen(valores) for etapa, valores in sorted(cronometro.tomar().items())},
+        "viajes_por_curso": viajes_por_artefacto(registros, sesiones),
+        "contadores_por_curso": contadores_por_curso(resultados) if resultados else {},
+        "viajes_totales": {
+            "gemini": sum(1 for r in registros if r["grupo"].startswith("gemini")),
+            "google": sum(1 for r in registros if not r["grupo"].startswith("gemini")),
+        },
+        "errores_inyectados": sum(1 for r in registros if r["status"] in (429, 503)),
+    }
+    if incremental and resultados:
+        # Corrección de una fila frente a la generación completa: tiempo y llamadas por sesión
+        escenario["incremental"] = {
+            "sesion": resumen([r["incremental"]["total_s"] for r in resultados]),
+            "contadores_por_curso": contadores_por_curso([r["incremental"] for r in resultados]),
+        }
+    return escenario
+
+
+def commit_actual() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=RAIZ, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def lista_enteros(texto: str) -> list:
+    return [int(x) for x in texto.split(",") if x.strip()]
+
+
+def probabilidades(texto: str) -> tuple:
+    # "p429,p503"
+    p429, p503 = (float(x) for x in texto.split(","))
+    return p429, p503
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clases", type=lista_enteros, default=[4, 8, 12, 24])
+    parser.add_argument("--sesiones", type=lista_enteros, default=[1, 4])
+    parser.add_argument("--workers-clases", type=int, default=4)
+    parser.add_argument("--escala-latencia", type=float, default=0.1,
+                        help="multiplica las latencias simuladas (1.0 = latencias realistas)")
+    parser.add_argument("--error-gemini", type=probabilidades, default=(0.0, 0.0), help="p429,p503")
+    parser.add_argument("--error-google", type=probabilidades, default=(0.0, 0.0), help="p429,p503")
+    parser.add_argument("--min-tokens-contexto", type=int, default=1024,
+                        help="mínimo de tokens que el servidor falso acepta en cachedContents (el de gemini-2.5-flash)")
+    parser.add_argument("--cobertura", action="store_true",
+                        help="duplica las llamadas lentas a Gemini (GEMINI_COBERTURA=1)")
+    parser.add_argument("--incremental", action="store_true",
+                        help="tras cada sesión, corrige una fila del outline y actualiza syllabus y clases")
+    parser.add_argument("--mismo-curso", action="store_true",
+                        help="las sesiones simultáneas de cada escenario piden el mismo curso")
+    parser.add_argument("--destino", choices=["google", "local", "local+subida"], default="google",
+                        help="dónde se escriben los artefactos")
+    parser.add_argument("--semilla", type=int, default=1234)
+    parser.add_argument("--salida", help="archivo JSON con el reporte (además de stdout)")
+    args = parser.parse_args(argv)
+
+    salida = os.path.abspath(args.salida) if args.salida else None
+    errores = {"gemini": args.error_gemini}
+    for grupo in ("docs", "drive", "sheets", "batch"):
+        errores[grupo] = args.error_google
+
+    servidor = ServidorFalso(escala_latencia=args.escala_latencia, errores=errores, semilla=args.semilla,
+                             min_tokens_contexto=args.min_tokens_contexto).iniciar()
+    try:
+        with tempfile.TemporaryDirectory(prefix="bench-syllabus-") as directorio:
+            preparar_entorno(servidor, directorio, args.cobertura)
+
+            import generador_clases
+            import utils
+
+            cronometro = Cronometro()
+            modulos = {"utils": utils, "generador_clases": generador_clases}
+            for modulo, nombre, etapa in ETAPAS:
+                cronometro.instrumentar(modulos[modulo], nombre, etapa)
+
+            escenarios = []
+            for num_clases in args.clases:
+                for sesiones in args.sesiones:
+                    escenario = correr_escenario(servidor, cronometro, num_clases, sesiones, args.workers_clases,
+                                                 args.incremental, args.mismo_curso, args.destino)
+                    escenarios.append(escenario)
+                    print(f"{num_clases:>3} clases x {sesiones} sesiones: {escenario['tiempo_pared_s']} s",
+                          file=sys.stderr)
+            os.chdir(RAIZ)
+    finally:
+        servidor.detener()
+
+    reporte = {
+        "commit": commit_actual(),
+        "fecha": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "parametros": {
+            "escala_latencia": args.escala_latencia,
+            "workers_clases": args.workers_clases,
+            "errores": errores,
+            "min_tokens_contexto": args.min_tokens_contexto,
+            "cobertura": args.cobertura,
+            "incremental": args.incremental,
+            "mismo_curso": args.mismo_curso,
+            "destino": args.destino,
+            "semilla": args.semilla,
+        },
+        "escenarios": escenarios,
+    }
+    texto = json.dumps(reporte, ensure_ascii=False, indent=2)
+    if salida:
+        with open(salida, "w", encoding="utf-8") as f:
+            f.write(texto)
+    print(texto)
+    return 0 if all(not e["errores"] for e in escenarios) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
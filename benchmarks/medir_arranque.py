@@ -0,0 +1,120 @@
+"""Mide el costo de arranque en frío y de construir los clientes de Google.
+
+Uso:
+    python benchmarks/medir_arranque.py [--repeticiones 5]
+
+Cada medición corre en un proceso nuevo para que las importaciones sean en frío.
+No necesita credenciales reales: los clientes se construyen con credenciales anónimas
+y los documentos de discovery empaquetados, sin tocar la red.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Lo que pagaba `import utils` antes: todas las librerías pesadas + 3 builds de discovery a nivel de módulo
+ANTES_IMPORT = """
+import time
+t = time.perf_counter()
+import streamlit, json, io, re, requests
+import pandas as pd
+from googleapiclient.discovery import build
+from google_auth_oauthlib.flow import Flow
+from google.oauth2.credentials import Credentials
+from google.auth.credentials import AnonymousCredentials
+creds = AnonymousCredentials()
+docs_service = build("docs", "v1", credentials=creds)
+drive_service = build("drive", "v3", credentials=creds)
+sheets_service = build("sheets", "v4", credentials=creds)
+print(time.perf_counter() - t)
+"""
+
+DESPUES_IMPORT = """
+import time
+t = time.perf_counter()
+import utils, generador_clases
+print(time.perf_counter() - t)
+"""
+
+# Antes: los tres servicios de una sesión, como los construía build_services()
+ANTES_CONSTRUIR_SERVICIOS = """
+import time
+from google.auth.credentials import AnonymousCredentials
+from googleapiclient.discovery import build
+creds = AnonymousCredentials()
+t = time.perf_counter()
+build("docs", "v1", credentials=creds)
+build("drive", "v3", credentials=creds)
+build("sheets", "v4", credentials=creds)
+print(time.perf_counter() - t)
+"""
+
+# Ahora: lo que paga un hilo nuevo la primera vez que pide cada servicio (transporte propio incluido);
+# las importaciones quedan fuera de la medición, como en ANTES_CONSTRUIR_SERVICIOS
+CONSTRUIR_POR_HILO = """
+import threading, time
+import google_auth_httplib2, httplib2
+from googleapiclient.discovery import build
+from google.auth.credentials import AnonymousCredentials
+from clientes_google import ClientesGoogle
+clientes = ClientesGoogle(AnonymousCredentials())
+tiempos = []
+def primer_uso():
+    t = time.perf_counter()
+    clientes.docs(); clientes.drive(); clientes.sheets()
+    tiempos.append(time.perf_counter() - t)
+hilo = threading.Thread(target=primer_uso)
+hilo.start(); hilo.join()
+print(tiempos[0])
+"""
+
+# Un rerun con los servicios ya guardados en la sesión solo hace una búsqueda
+RERUN_CACHEADO = """
+import time
+from google.auth.credentials import AnonymousCredentials
+import utils
+servicios = utils.build_services(AnonymousCredentials())
+with utils.usar_servicios(servicios):
+    t = time.perf_counter()
+    for _ in range(1000):
+        utils.get_docs_service(); utils.get_drive_service(); utils.get_sheets_service()
+    print((time.perf_counter() - t) / 1000)
+"""
+
+
+def medir(codigo: str, repeticiones: int) -> float:
+    tiempos = []
+    for _ in range(repeticiones):
+        salida = subprocess.run(
+            [sys.executable, "-c", codigo], cwd=RAIZ, capture_output=True, text=True, check=True,
+            env={**os.environ, "PYTHONPATH": RAIZ},
+        )
+        tiempos.append(float(salida.stdout.strip().splitlines()[-1]))
+    return statistics.median(tiempos)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeticiones", type=int, default=5)
+    args = parser.parse_args()
+
+    resultado = {
+        "antes": {
+            "importacion_s": medir(ANTES_IMPORT, args.repeticiones),
+            "construccion_servicios_por_sesion_s": medir(ANTES_CONSTRUIR_SERVICIOS, args.repeticiones),
+        },
+        "despues": {
+            "importacion_s": medir(DESPUES_IMPORT, args.repeticiones),
+            "construccion_servicios_por_hilo_s": medir(CONSTRUIR_POR_HILO, args.repeticiones),
+            "rerun_servicios_cacheados_s": medir(RERUN_CACHEADO, args.repeticiones),
+        },
+    }
+    print(json.dumps(resultado, indent=2))
+
+
+if __name__ == "__main__":
+    main()
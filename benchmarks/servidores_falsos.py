@@ -0,0 +1,425 @@
+"""Servidores HTTP locales que imitan a Gemini y a las APIs de Docs/Drive/Sheets.
+
+Sirven para medir el pipeline sin gastar cuota: cada endpoint tiene una latencia
+configurable (distribución log-normal), se pueden inyectar respuestas 429/503 y todas
+las peticiones quedan registradas con el artefacto al que pertenecen.
+"""
+import itertools
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from email.parser import Parser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlparse
+
+# Latencias por defecto (mediana en segundos, sigma de la log-normal)
+LATENCIAS_POR_DEFECTO = {
+    "gemini_datos": (8.0, 0.3),
+    "gemini_seccion": (3.0, 0.3),
+    "gemini_clase": (20.0, 0.4),
+    "docs": (0.4, 0.3),
+    "drive": (0.5, 0.3),
+    "sheets": (0.4, 0.3),
+    "batch": (0.6, 0.3),
+    "gemini_contexto": (1.0, 0.3),
+}
+
+TEXTO_SLIDE = (
+    "SLIDE {n}: TÍTULO DE LA SLIDE\n"
+    "Texto explicativo completo con ejemplos de negocio, métricas y decisiones estratégicas 📈. "
+    "Caso de uso: una empresa de retail redujo 18% su inventario inmovilizado. Fuente: https://example.com/caso\n"
+    "TIP: empieza con un piloto acotado. RECURSO VISUAL: dashboard de KPIs.\n\n"
+)
+
+
+class DocumentoFalso:
+    """Texto del cuerpo de un documento de Docs, con índices en unidades UTF-16 que empiezan en 1."""
+
+    def __init__(self, texto: str = "\n"):
+        self.texto = texto.encode("utf-16-le")
+
+    @property
+    def fin(self) -> int:
+        return 1 + len(self.texto) // 2
+
+    def _insertar(self, indice: int, texto: str):
+        posicion = (indice - 1) * 2
+        self.texto = self.texto[:posicion] + texto.encode("utf-16-le") + self.texto[posicion:]
+
+    def aplicar(self, request: dict):
+        if "insertText" in request:
+            insercion = request["insertText"]
+            # endOfSegmentLocation inserta antes del salto de línea final, como Docs
+            indice = insercion["location"]["index"] if "location" in insercion else self.fin - 1
+            self._insertar(indice, insercion["text"])
+        elif "deleteContentRange" in request:
+            rango = request["deleteContentRange"]["range"]
+            self.texto = self.texto[:(rango["startIndex"] - 1) * 2] + self.texto[(rango["endIndex"] - 1) * 2:]
+        elif "replaceAllText" in request:
+            reemplazo = request["replaceAllText"]
+            texto = self.texto.decode("utf-16-le")
+            self.texto = texto.replace(reemplazo["containsText"]["text"], reemplazo["replaceText"]).encode("utf-16-le")
+
+    def cuerpo(self) -> dict:
+        return {"content": [{"paragraph": {"elements": [
+            {"startIndex": 1, "endIndex": self.fin, "textRun": {"content": self.texto.decode("utf-16-le")}}
+        ]}}]}
+
+
+class ServidorFalso:
+    def __init__(self, latencias: dict = None, escala_latencia: float = 1.0, errores: dict = None,
+                 tamano_clase: int = 12_000, semilla: int = None, min_tokens_contexto: int = 0):
+        # `errores` mapea grupo -> (probabilidad de 429, probabilidad de 503)
+        self.latencias = {**LATENCIAS_POR_DEFECTO, **(latencias or {})}
+        self.escala_latencia = escala_latencia
+        self.errores = errores or {}
+        self.tamano_clase = tamano_clase
+        self.random = random.Random(semilla)
+        self.random_lock = threading.Lock()
+        self.registros = []
+        self.registros_lock = threading.Lock()
+        self.hojas = {}
+        self.contextos = {}
+        self.documentos = {}
+        self.documentos_lock = threading.Lock()
+        self.min_tokens_contexto = min_tokens_contexto
+        self.contador = itertools.count(1)
+        self.servidor = None
+
+    # === Ciclo de vida ===
+    def iniciar(self):
+        servidor_falso = self
+
+        class Handler(_Handler):
+            falso = servidor_falso
+
+        self.servidor = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.servidor.daemon_threads = True
+        threading.Thread(target=self.servidor.serve_forever, daemon=True).start()
+        return self
+
+    def detener(self):
+        if self.servidor:
+            self.servidor.shutdown()
+            self.servidor.server_close()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.servidor.server_port}"
+
+    # === Registro ===
+    def registrar(self, grupo: str, artefacto: str, ruta: str, status: int, latencia: float):
+        with self.registros_lock:
+            self.registros.append({
+                "grupo": grupo, "artefacto": artefacto, "ruta": ruta,
+                "status": status, "latencia_s": latencia, "t": time.time(),
+            })
+
+    def tomar_registros(self) -> list:
+        with self.registros_lock:
+            registros, self.registros = self.registros, []
+        return registros
+
+    # === Comportamiento simulado ===
+    def esperar(self, grupo: str) -> float:
+        mediana, sigma = self.latencias[grupo]
+        with self.random_lock:
+            latencia = self.random.lognormvariate(math.log(mediana), sigma) * self.escala_latencia
+        time.sleep(latencia)
+        return latencia
+
+    def error_inyectado(self, grupo: str):
+        prob_429, prob_503 = self.errores.get(grupo.split("_")[0], (0.0, 0.0))
+        with self.random_lock:
+            r = self.random.random()
+        if r < prob_429:
+            return 429
+        if r < prob_429 + prob_503:
+            return 503
+        return None
+
+    def nuevo_id(self, prefijo: str) -> str:
+        return f"{prefijo}-{next(self.contador)}-{uuid.uuid4().hex[:6]}"
+
+    def respuesta_gemini(self, prompt: str, esquema: dict = None) -> str:
+        if esquema:
+            # Salida estructurada: JSON que cumple el responseSchema pedido
+            return json.dumps(json_desde_esquema(esquema, prompt), ensure_ascii=False)
+        if "20 slides" in prompt:
+            slides = []
+            n = 1
+            while sum(map(len, slides)) < self.tamano_clase:
+                slides.append(TEXTO_SLIDE.format(n=n))
+                n += 1
+            return "".join(slides)
+        return "Párrafo generado por el servidor falso con objetivos claros y medibles."
+
+
+def json_desde_esquema(esquema: dict, prompt: str, indice: int = 1, campo: str = ""):
+    tipo = esquema.get("type", "STRING").upper()
+    if tipo == "OBJECT":
+        return {nombre: json_desde_esquema(sub, prompt, indice, nombre) for nombre, sub in esquema["properties"].items()}
+    if tipo == "ARRAY":
+        match = re.search(r"exactamente (\d+) clases", prompt)
+        total = int(match.group(1)) if match else 3
+        return [json_desde_esquema(esquema["items"], prompt, i, campo) for i in range(1, total + 1)]
+    if tipo == "INTEGER":
+        return indice
+    if campo == "titulo":
+        # El nombre del curso va en los títulos para que cada curso tenga prompts de clase distintos
+        curso = re.search(r"Curso: (.*)", prompt)
+        return f"Tema {indice} de {curso.group(1).strip() if curso else ''}"
+    return f"Texto de {campo.replace('_', ' ')} {indice}."
+
+
+def _artefacto_de_id(file_id: str) -> str:
+    return file_id.split("-", 1)[0] if "-" in file_id else "desconocido"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    falso: ServidorFalso = None
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    # === Utilidades HTTP ===
+    def _leer_cuerpo(self) -> bytes:
+        longitud = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(longitud) if longitud else b""
+
+    def _responder(self, status: int, cuerpo, content_type: str = "application/json", headers: dict = None):
+        datos = cuerpo if isinstance(cuerpo, bytes) else json.dumps(cuerpo).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(datos)))
+        for clave, valor in (headers or {}).items():
+            self.send_header(clave, valor)
+        self.end_headers()
+        self.wfile.write(datos)
+
+    def _atender(self, grupo: str, artefacto: str, generar):
+        latencia = self.falso.esperar(grupo)
+        status = self.falso.error_inyectado(grupo)
+        if status:
+            self.falso.registrar(grupo, artefacto, self.path, status, latencia)
+            self._responder(status, {"error": {"code": status, "message": "error inyectado"}},
+                            headers={"Retry-After": "0"} if status == 429 else None)
+            return
+        self.falso.registrar(grupo, artefacto, self.path, 200, latencia)
+        generar()
+
+    # === Ruteo ===
+    def do_GET(self):
+        self._rutear("GET")
+
+    def do_POST(self):
+        self._rutear("POST")
+
+    def do_PUT(self):
+        self._rutear("PUT")
+
+    def do_DELETE(self):
+        self._rutear("DELETE")
+
+    def _rutear(self, metodo: str):
+        cuerpo = self._leer_cuerpo()
+        ruta = urlparse(self.path).path
+
+        if "/cachedContents" in ruta:
+            return self._contexto(metodo, ruta, json.loads(cuerpo or b"{}"))
+        if ":generateContent" in ruta or ":streamGenerateContent" in ruta:
+            return self._gemini(ruta, json.loads(cuerpo or b"{}"))
+        if ruta.startswith("/batch/drive/v3"):
+            return self._batch(cuerpo)
+        if "/upload/drive/v3/files" in ruta:
+            return self._subida(cuerpo)
+        if ruta.startswith("/drive/v3/"):
+            return self._drive(metodo, ruta, json.loads(cuerpo or b"{}"))
+        if ruta.startswith("/v1/documents"):
+            return self._docs(metodo, ruta, json.loads(cuerpo or b"{}"))
+        if ruta.startswith("/v4/spreadsheets"):
+            return self._sheets(metodo, ruta, json.loads(cuerpo or b"{}"))
+        self._responder(404, {"error": {"code": 404, "message": f"ruta no simulada: {ruta}"}})
+
+    # === Gemini ===
+    def _contexto(self, metodo: str, ruta: str, cuerpo: dict):
+        if metodo == "DELETE":
+            self.falso.contextos.pop(ruta.split("/v1beta/", 1)[-1], None)
+            return self._atender("gemini_contexto", "clases", lambda: self._responder(200, {}))
+        prefijo = "".join(p.get("text", "") for c in cuerpo.get("contents", []) for p in c.get("parts", []))
+        tokens = len(prefijo) // 4
+        if tokens < self.falso.min_tokens_contexto:
+            # Como Gemini: un contenido por debajo del mínimo de tokens se rechaza con 400
+            mensaje = f"Cached content is too small. total_token_count={tokens}, min_total_token_count=" \
+                      f"{self.falso.min_tokens_contexto}"
+            return self._atender("gemini_contexto", "clases",
+                                 lambda: self._responder(400, {"error": {"code": 400, "message": mensaje}}))
+        nombre = f"cachedContents/{self.falso.nuevo_id('ctx')}"
+        self.falso.contextos[nombre] = prefijo
+        self._atender("gemini_contexto", "clases",
+                      lambda: self._responder(200, {"name": nombre, "usageMetadata": {"totalTokenCount": tokens}}))
+
+    def _gemini(self, ruta: str, cuerpo: dict):
+        prompt = "".join(p.get("text", "") for c in cuerpo.get("contents", []) for p in c.get("parts", []))
+        prefijo = self.falso.contextos.get(cuerpo.get("cachedContent"), "")
+        if cuerpo.get("cachedContent") and not prefijo:
+            return self._responder(404, {"error": {"code": 404, "message": "CachedContent not found"}})
+        esquema = cuerpo.get("generationConfig", {}).get("responseSchema")
+        if esquema and "outline" in esquema.get("properties", {}):
+            grupo, artefacto = "gemini_datos", "datos_generales"
+        elif "20 slides" in prefijo + prompt:
+            grupo, artefacto = "gemini_clase", "clases"
+        else:
+            grupo, artefacto = "gemini_seccion", "syllabus"
+        texto = self.falso.respuesta_gemini(prefijo + prompt, esquema)
+        uso = {"promptTokenCount": len(prefijo + prompt) // 4, "candidatesTokenCount": len(texto) // 4,
+               "totalTokenCount": (len(prefijo + prompt) + len(texto)) // 4}
+        if prefijo:
+            uso["cachedContentTokenCount"] = len(prefijo) // 4
+
+        def responder():
+            if ":streamGenerateContent" in ruta:
+                self._sse(texto, uso)
+            else:
+                self._responder(200, {"candidates": [{"content": {"parts": [{"text": texto}]}}],
+                                      "usageMetadata": uso})
+
+        self._atender(grupo, artefacto, responder)
+
+    def _sse(self, texto: str, uso: dict):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        trozos = [texto[i:i + 400] for i in range(0, len(texto), 400)]
+        for numero, trozo in enumerate(trozos, 1):
+            evento = {"candidates": [{"content": {"parts": [{"text": trozo}]}}]}
+            if numero == len(trozos):
+                evento["usageMetadata"] = uso
+            self.wfile.write(f"data: {json.dumps(evento)}\r\n\r\n".encode("utf-8"))
+            self.wfile.flush()
+        self.close_connection = True
+
+    # === Drive ===
+    def _respuesta_drive(self, metodo: str, ruta: str, cuerpo: dict):
+        partes = ruta[len("/drive/v3/"):].strip("/").split("/")
+        if partes[0] == "files" and len(partes) == 3 and partes[2] == "copy":
+            return "syllabus", {"id": self.falso.nuevo_id("syllabus")}
+        if partes[0] == "files" and len(partes) == 3 and partes[2] == "permissions":
+            return _artefacto_de_id(partes[1]), {"id": self.falso.nuevo_id("permiso")}
+        if partes[0] == "files" and len(partes) == 1 and metodo == "POST":
+            return "clases", {"id": self.falso.nuevo_id("clases")}
+        return "desconocido", {}
+
+    def _drive(self, metodo: str, ruta: str, cuerpo: dict):
+        artefacto, respuesta = self._respuesta_drive(metodo, ruta, cuerpo)
+        self._atender("drive", artefacto, lambda: self._responder(200, respuesta))
+
+    def _subida(self, cuerpo: bytes):
+        # Carga multipart (metadatos JSON + archivo); el artefacto sale del nombre pedido
+        if b'"name": "Clases - ' in cuerpo:
+            artefacto = "clases"
+        elif b"google-apps.spreadsheet" in cuerpo:
+            artefacto = "outline"
+        else:
+            artefacto = "syllabus"
+        respuesta = {"id": self.falso.nuevo_id(artefacto)}
+        self._atender("drive", artefacto, lambda: self._responder(200, respuesta))
+
+    def _batch(self, cuerpo: bytes):
+        mensaje = Parser().parsestr(
+            f"Content-Type: {self.headers['Content-Type']}\r\n\r\n" + cuerpo.decode("utf-8")
+        )
+        respuestas = []
+        artefactos = []
+        for parte in mensaje.get_payload():
+            peticion = parte.get_payload()
+            linea, resto = peticion.split("\n", 1)
+            metodo, ruta_completa, _ = linea.split(" ", 2)
+            cuerpo_interno = resto.split("\n\n", 1)[1] if "\n\n" in resto else ""
+            artefacto, respuesta = self._respuesta_drive(
+                metodo, unquote(urlparse(ruta_completa).path), json.loads(cuerpo_interno or "{}")
+            )
+            artefactos.append(artefacto)
+            content_id = parte["Content-ID"][1:-1]
+            respuestas.append(
+                f"Content-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n\r\n{json.dumps(respuesta)}\r\n"
+            )
+        frontera = uuid.uuid4().hex
+        cuerpo_respuesta = "".join(f"--{frontera}\r\n{r}" for r in respuestas) + f"--{frontera}--\r\n"
+        artefacto = artefactos[0] if artefactos else "desconocido"
+        self._atender("batch", artefacto, lambda: self._responder(
+            200, cuerpo_respuesta.encode("utf-8"), f"multipart/mixed; boundary={frontera}"
+        ))
+
+    # === Docs ===
+    def _docs(self, metodo: str, ruta: str, cuerpo: dict):
+        document_id = ruta[len("/v1/documents/"):].split(":", 1)[0]
+        artefacto = _artefacto_de_id(document_id)
+        with self.falso.documentos_lock:
+            documento = self.falso.documentos.setdefault(document_id, DocumentoFalso())
+            if ruta.endswith(":batchUpdate"):
+                for request in cuerpo.get("requests", []):
+                    documento.aplicar(request)
+                # Como Docs: cada replaceAllText informa cuántas apariciones cambió (el texto de las
+                # plantillas no se modela, así que se informa siempre una)
+                respuesta = {"documentId": document_id, "replies": [
+                    {"replaceAllText": {"occurrencesChanged": 1}} if "replaceAllText" in request else {}
+                    for request in cuerpo.get("requests", [])
+                ]}
+            else:
+                respuesta = {"documentId": document_id, "namedRanges": {}, "body": documento.cuerpo()}
+        self._atender("docs", artefacto, lambda: self._responder(200, respuesta))
+
+    # === Sheets ===
+    def _sheets(self, metodo: str, ruta: str, cuerpo: dict):
+        partes = ruta[len("/v4/spreadsheets"):].strip("/").split("/")
+        if not partes[0]:
+            spreadsheet_id = self.falso.nuevo_id("outline")
+            filas = []
+            for hoja in cuerpo.get("sheets", []):
+                for bloque in hoja.get("data", []):
+                    for fila in bloque.get("rowData", []):
+                        filas.append([c.get("userEnteredValue", {}).get("stringValue", "")
+                                      for c in fila.get("values", [])])
+            self.falso.hojas[spreadsheet_id] = filas
+            respuesta = {"spreadsheetId": spreadsheet_id}
+        else:
+            spreadsheet_id = partes[0]
+            filas = self.falso.hojas.get(spreadsheet_id, [])
+            if len(partes) == 2 and partes[1] == "values:batchUpdate":
+                for dato in cuerpo.get("data", []):
+                    fila = int(re.findall(r"\d+", dato["range"].split("!")[-1])[0])
+                    for desplazamiento, valores in enumerate(dato.get("values", [])):
+                        while len(filas) < fila + desplazamiento:
+                            filas.append([])
+                        filas[fila + desplazamiento - 1] = valores
+                respuesta = {"totalUpdatedRows": sum(len(d.get("values", [])) for d in cuerpo.get("data", []))}
+            elif len(partes) >= 3 and partes[1] == "values":
+                if metodo == "GET":
+                    respuesta = {"values": _filas_en_rango(filas, unquote(partes[2]))}
+                else:
+                    self.falso.hojas[spreadsheet_id] = cuerpo.get("values", [])
+                    respuesta = {"updatedRows": len(cuerpo.get("values", []))}
+            else:
+                respuesta = {"spreadsheetId": spreadsheet_id, "sheets": [{"properties": {
+                    "title": "Sheet1", "gridProperties": {"rowCount": max(1000, len(filas)), "columnCount": 26},
+                }}]}
+        self._atender("sheets", _artefacto_de_id(spreadsheet_id), lambda: self._responder(200, respuesta))
+
+
+def _filas_en_rango(filas: list, rango: str) -> list:
+    # Solo se interpretan los números de fila del rango A1 ("A1:G100", "'Sheet1'!1:500")
+    rango = rango.split("!")[-1]
+    numeros = re.findall(r"[A-Z]*(\d+)", rango)
+    if not numeros:
+        return filas
+    inicio = int(numeros[0])
+    fin = int(numeros[1]) if len(numeros) > 1 else inicio
+    return filas[inicio - 1:fin]
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+
+# =========================
+# 💾 CACHÉ PERSISTENTE DE RESPUESTAS DE GEMINI
+# =========================
+class CacheRespuestas:
+    """Caché en SQLite direccionada por contenido (modelo + generationConfig + prompt).
+
+    Las entradas expiran por TTL y, si la base supera `max_bytes`, se desalojan
+    primero las usadas hace más tiempo (LRU).
+    """
+
+    def __init__(self, ruta: str, ttl_segundos: int = 30 * 24 * 3600, max_bytes: int = 200 * 1024 * 1024):
+        self.ruta = ruta
+        self.ttl_segundos = ttl_segundos
+        self.max_bytes = max_bytes
+        directorio = os.path.dirname(ruta)
+        if directorio:
+            os.makedirs(directorio, exist_ok=True)
+        with self._conectar() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS respuestas (
+                    clave TEXT PRIMARY KEY,
+                    valor TEXT NOT NULL,
+                    bytes INTEGER NOT NULL,
+                    creado REAL NOT NULL,
+                    ultimo_acceso REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_ultimo_acceso ON respuestas (ultimo_acceso)")
+
+    @contextmanager
+    def _conectar(self):
+        # Una conexión por operación: sqlite3 no comparte conexiones entre hilos
+        conn = sqlite3.connect(self.ruta, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def clave(modelo: str, generation_config: dict, prompt: str) -> str:
+        contenido = json.dumps(
+            {"modelo": modelo, "generationConfig": generation_config or {}, "prompt": prompt},
+            sort_keys=True, ensure_ascii=False,
+        )
+        return hashlib.sha256(contenido.encode("utf-8")).hexdigest()
+
+    def obtener(self, clave: str):
+        ahora = time.time()
+        with self._conectar() as conn:
+            fila = conn.execute(
+                "SELECT valor FROM respuestas WHERE clave = ? AND creado >= ?",
+                (clave, ahora - self.ttl_segundos),
+            ).fetchone()
+            if fila is None:
+                return None
+            conn.execute("UPDATE respuestas SET ultimo_acceso = ? WHERE clave = ?", (ahora, clave))
+        return fila[0]
+
+    def guardar(self, clave: str, valor: str):
+        ahora = time.time()
+        with self._conectar() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO respuestas (clave, valor, bytes, creado, ultimo_acceso) VALUES (?, ?, ?, ?, ?)",
+                (clave, valor, len(valor.encode("utf-8")), ahora, ahora),
+            )
+            self._desalojar(conn, ahora)
+
+    def _desalojar(self, conn, ahora: float):
+        conn.execute("DELETE FROM respuestas WHERE creado < ?", (ahora - self.ttl_segundos,))
+        total = conn.execute("SELECT COALESCE(SUM(bytes), 0) FROM respuestas").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for clave, tamano in conn.execute("SELECT clave, bytes FROM respuestas ORDER BY ultimo_acceso").fetchall():
+            conn.execute("DELETE FROM respuestas WHERE clave = ?", (clave,))
+            total -= tamano
+            if total <= self.max_bytes:
+                break
+
+
+# === Una caché por archivo para todo el proceso ===
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def obtener_cache(ruta: str, **config) -> CacheRespuestas:
+    with _caches_lock:
+        if ruta not in _caches:
+            _caches[ruta] = CacheRespuestas(ruta, **config)
+        return _caches[ruta]
@@ -0,0 +1,196 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+# Un lock por clave de estado en este proceso (ver EstadoPersistido.exclusivo)
+_bloqueos = {}
+_bloqueos_lock = threading.Lock()
+
+
+# =========================
+# 💾 ESTADO PERSISTIDO EN JSON
+# =========================
+class EstadoPersistido:
+    """Un JSON en disco con escritura atómica; cada subclase define su contenido inicial."""
+
+    def __init__(self, ruta: str, datos: dict = None):
+        self.ruta = ruta
+        self.datos = datos or self.inicial()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def inicial() -> dict:
+        return {}
+
+    @staticmethod
+    def clave(*entradas) -> str:
+        contenido = json.dumps(entradas, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(contenido.encode("utf-8")).hexdigest()
+
+    @classmethod
+    def abrir(cls, clave: str, directorio: str = ".cache/checkpoints", reiniciar: bool = False):
+        os.makedirs(directorio, exist_ok=True)
+        ruta = os.path.join(directorio, f"{clave}.json")
+        if reiniciar or not os.path.exists(ruta):
+            return cls(ruta)
+        with open(ruta, encoding="utf-8") as f:
+            return cls(ruta, json.load(f))
+
+    @staticmethod
+    @contextmanager
+    def exclusivo(clave: str):
+        """Un solo trabajo a la vez por clave en el proceso: el segundo (doble clic, otra sesión con
+        el mismo outline) espera y al abrir el estado retoma lo que dejó el primero, sin duplicarlo."""
+        with _bloqueos_lock:
+            bloqueo = _bloqueos.setdefault(clave, threading.Lock())
+        with bloqueo:
+            yield
+
+    @staticmethod
+    def _escribir_atomico(ruta: str, texto: str):
+        # El temporal es propio de cada escritura: dos instancias con la misma ruta no escriben el mismo archivo
+        descriptor, temporal = tempfile.mkstemp(dir=os.path.dirname(ruta) or ".", prefix=os.path.basename(ruta),
+                                               suffix=".tmp")
+        try:
+            with os.fdopen(descriptor, "w", encoding="utf-8") as f:
+                f.write(texto)
+            os.replace(temporal, ruta)
+        except BaseException:
+            os.unlink(temporal)
+            raise
+
+    def _persistir(self):
+        # Escritura atómica: un proceso que muere a la mitad no deja un JSON corrupto
+        self._escribir_atomico(self.ruta, json.dumps(self.datos, ensure_ascii=False))
+
+
+# =========================
+# 📌 CHECKPOINTS DE GENERACIÓN DE CLASES
+# =========================
+class CheckpointClases(EstadoPersistido):
+    """Estado persistido de una generación de documentos de clases.
+
+    Guarda el contenido de cada clase terminada (un archivo por clase, junto al JSON), la
+    huella de la fila del outline que la produjo y, por cada "Parte N", el id del documento, qué clases le tocaron, si ya
+    se escribió y el rango (en unidades UTF-16 de Docs) de cada clase. Reintentar solo
+    genera y escribe lo que falta; si cambió una fila del outline, solo esa clase se
+    regenera y se reescribe en su rango.
+    """
+
+    @staticmethod
+    def inicial() -> dict:
+        return {"entradas": {}, "partes": {}, "permisos": False}
+
+    @classmethod
+    def abrir(cls, clave: str, directorio: str = ".cache/checkpoints", reiniciar: bool = False):
+        checkpoint = super().abrir(clave, directorio, reiniciar)
+        if reiniciar:
+            shutil.rmtree(checkpoint.directorio_clases, ignore_errors=True)
+        return checkpoint
+
+    @property
+    def directorio_clases(self) -> str:
+        # El texto de las clases no va en el JSON: no se reescribe todo el curso cada vez que termina una
+        return f"{os.path.splitext(self.ruta)[0]}.clases"
+
+    def _ruta_clase(self, numero: int) -> str:
+        return os.path.join(self.directorio_clases, f"{numero}.txt")
+
+    def contenido(self, numero: int):
+        ruta = self._ruta_clase(numero)
+        if os.path.exists(ruta):
+            with open(ruta, encoding="utf-8") as f:
+                return f.read()
+        # Checkpoints anteriores guardaban el texto dentro del JSON
+        with self.lock:
+            return self.datos.get("clases", {}).get(str(numero))
+
+    def guardar_contenido(self, numero: int, texto: str, entrada: str = None):
+        # `entrada` es la huella de la fila del outline con la que se generó el texto
+        os.makedirs(self.directorio_clases, exist_ok=True)
+        self._escribir_atomico(self._ruta_clase(numero), texto)
+        if entrada is not None:
+            with self.lock:
+                self.datos.setdefault("entradas", {})[str(numero)] = entrada
+                self._persistir()
+
+    def entrada(self, numero: int):
+        with self.lock:
+            return self.datos.get("entradas", {}).get(str(numero))
+
+    def descartar_contenido(self, numero: int):
+        # La clase se vuelve a generar en la próxima corrida
+        if os.path.exists(self._ruta_clase(numero)):
+            os.remove(self._ruta_clase(numero))
+        with self.lock:
+            if self.datos.get("clases", {}).pop(str(numero), None) is not None:
+                self._persistir()
+
+    def parte(self, indice: int):
+        with self.lock:
+            return self.datos["partes"].get(str(indice))
+
+    def partes(self) -> list:
+        # [(indice, estado)] en orden de parte
+        with self.lock:
+            return sorted((int(indice), estado) for indice, estado in self.datos["partes"].items())
+
+    def guardar_parte(self, indice: int, document_id: str, escrito: bool, errores: dict = None,
+                      clases: list = None, rangos: dict = None, huellas: dict = None):
+        # `errores` mapea número de clase -> placeholder de error que quedó escrito en el documento;
+        # `rangos` mapea número de clase -> [inicio, fin) en el documento y `huellas` -> huella del
+        # texto escrito en ese rango (para no reescribir sobre un rango que se editó a mano)
+        with self.lock:
+            self.datos["partes"][str(indice)] = {
+                "document_id": document_id, "escrito": escrito, "errores": errores or {},
+                "clases": clases or [], "rangos": rangos or {}, "huellas": huellas or {},
+            }
+            self._persistir()
+
+    @property
+    def permisos(self) -> bool:
+        with self.lock:
+            return self.datos["permisos"]
+
+    def marcar_permisos(self):
+        with self.lock:
+            self.datos["permisos"] = True
+            self._persistir()
+
+
+# =========================
+# 📄 ESTADO DE UN SYLLABUS
+# =========================
+class EstadoSyllabus(EstadoPersistido):
+    """Lo escrito en un syllabus y en su outline, para corregir una sección o una fila en su lugar.
+
+    Guarda el id del documento y de la hoja, el texto que quedó en cada placeholder,
+    las filas del outline y los datos del curso con los que se piden las secciones.
+    """
+
+    @staticmethod
+    def inicial() -> dict:
+        return {"document_id": None, "spreadsheet_id": None, "valores": {}, "filas": [], "curso": {}}
+
+    @classmethod
+    def de_documento(cls, document_id: str, directorio: str = ".cache/syllabus"):
+        return cls.abrir(document_id, directorio)
+
+    def leer(self, campo: str):
+        with self.lock:
+            return json.loads(json.dumps(self.datos[campo]))
+
+    def actualizar(self, **campos):
+        with self.lock:
+            self.datos.update(campos)
+            self._persistir()
+
+    def actualizar_valores(self, valores: dict):
+        # `valores` mapea placeholder -> texto que quedó escrito en el documento
+        with self.lock:
+            self.datos["valores"].update(valores)
+            self._persistir()
@@ -0,0 +1,114 @@
+import datetime
+import hashlib
+import threading
+
+from metricas import contar
+
+# Se renueva el token si vence dentro de este margen, antes de que una llamada reciba un 401
+MARGEN_REFRESCO_SEGUNDOS = 300
+
+
+# =========================
+# 🔌 CLIENTES GOOGLE POR HILO
+# =========================
+class ClientesGoogle:
+    """Clientes de Docs, Drive y Sheets de una credencial, uno por hilo.
+
+    El transporte httplib2 no es thread-safe: cada hilo recibe sus propios servicios
+    sobre su propio AuthorizedHttp, y los reutiliza (conexión incluida) en cada llamada.
+    Cada servicio se construye hasta que el hilo lo usa.
+    La credencial sí se comparte y se renueva bajo un lock, antes de que venza.
+    """
+
+    def __init__(self, creds, endpoint: str = "", timeout: float = 120):
+        self.creds = creds
+        self.endpoint = endpoint.rstrip("/")
+        self.timeout = timeout
+        self.local = threading.local()
+        self.lock_refresco = threading.Lock()
+        self._peticion_refresco = None
+
+    def _opciones(self, ruta_servicio: str) -> dict:
+        # GOOGLE_API_ENDPOINT apunta los tres clientes a otro servidor (p. ej. los falsos de benchmarks/)
+        if not self.endpoint:
+            return {}
+        return {"client_options": {"api_endpoint": f"{self.endpoint}/{ruta_servicio}"}}
+
+    def _construir(self, nombre: str, version: str, ruta_servicio: str):
+        import google_auth_httplib2
+        import httplib2
+        from googleapiclient.discovery import build
+
+        http = google_auth_httplib2.AuthorizedHttp(self.creds, http=httplib2.Http(timeout=self.timeout))
+        contar("google_clientes_construidos_total", servicio=nombre)
+        # Documentos de discovery empaquetados con la librería: no se descargan en cada build
+        return build(nombre, version, http=http, static_discovery=True, cache_discovery=False,
+                     **self._opciones(ruta_servicio))
+
+    def _servicio(self, nombre: str, version: str, ruta_servicio: str = ""):
+        # Cada servicio se construye la primera vez que este hilo lo pide: un hilo que solo usa
+        # Drive no paga por Docs ni Sheets
+        servicio = getattr(self.local, nombre, None)
+        if servicio is None:
+            servicio = self._construir(nombre, version, ruta_servicio)
+            setattr(self.local, nombre, servicio)
+        return servicio
+
+    def docs(self):
+        return self._servicio("docs", "v1")
+
+    def drive(self):
+        return self._servicio("drive", "v3", "drive/v3/")
+
+    def sheets(self):
+        return self._servicio("sheets", "v4")
+
+    def _por_vencer(self) -> bool:
+        expiry = getattr(self.creds, "expiry", None)
+        if expiry is None:
+            return not self.creds.valid
+        # google-auth guarda expiry como datetime UTC sin zona horaria
+        ahora = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        restante = expiry - ahora
+        return restante.total_seconds() < MARGEN_REFRESCO_SEGUNDOS
+
+    def asegurar_token(self):
+        """Renueva el access token si vence pronto; un solo hilo lo renueva, el resto lo reutiliza."""
+        if not self._por_vencer() or not getattr(self.creds, "refresh_token", None):
+            return
+        from google.auth.transport.requests import Request
+
+        with self.lock_refresco:
+            if not self._por_vencer():
+                return
+            if self._peticion_refresco is None:
+                self._peticion_refresco = Request()
+            self.creds.refresh(self._peticion_refresco)
+            contar("google_tokens_renovados_total")
+
+
+# =========================
+# 🗂️ POOL POR CREDENCIAL
+# =========================
+_clientes = {}
+_clientes_lock = threading.Lock()
+
+
+def _clave_credencial(creds):
+    # Credenciales de usuario OAuth: la misma cuenta comparte clientes entre sesiones y trabajos
+    refresh_token = getattr(creds, "refresh_token", None)
+    if not refresh_token:
+        return None
+    identidad = f"{getattr(creds, 'client_id', '')}:{refresh_token}"
+    return hashlib.sha256(identidad.encode("utf-8")).hexdigest()
+
+
+def obtener_clientes_google(creds, endpoint: str = "") -> ClientesGoogle:
+    """Clientes compartidos por credencial; sin refresh token (p. ej. anónimas) no se comparten."""
+    clave = _clave_credencial(creds)
+    if clave is None:
+        return ClientesGoogle(creds, endpoint)
+    with _clientes_lock:
+        if (clave, endpoint) not in _clientes:
+            _clientes[(clave, endpoint)] = ClientesGoogle(creds, endpoint)
+        return _clientes[(clave, endpoint)]
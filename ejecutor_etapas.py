@@ -0,0 +1,100 @@
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from metricas import span
+
+
+def enviar_con_contexto(executor, funcion, *args, **kwargs):
+    # Los hilos del pool no heredan contextvars por sí solos: se copia el contexto de quien envía
+    contexto = contextvars.copy_context()
+    return executor.submit(contexto.run, funcion, *args, **kwargs)
+
+
+def _etapa_trazada(nombre, funcion, *args):
+    with span(f"etapa:{nombre}"):
+        return funcion(*args)
+
+
+# Hilos de etapas compartidos por todo el proceso: sus clientes de Google (y sus conexiones)
+# se reutilizan de una corrida a otra en lugar de crearse con cada grafo
+_executor_etapas = None
+_executor_lock = threading.Lock()
+
+
+def _executor_compartido() -> ThreadPoolExecutor:
+    global _executor_etapas
+    with _executor_lock:
+        if _executor_etapas is None:
+            _executor_etapas = ThreadPoolExecutor(
+                max_workers=int(os.environ.get("ETAPAS_MAX_HILOS", "16")), thread_name_prefix="etapa"
+            )
+        return _executor_etapas
+
+
+# =========================
+# 🕸️ EJECUTOR DE ETAPAS (GRAFO DE DEPENDENCIAS)
+# =========================
+def ejecutar_etapas(etapas: dict, max_workers: int = 6) -> dict:
+    """Ejecuta un grafo de etapas en paralelo respetando sus dependencias.
+
+    `etapas` mapea nombre -> (funcion, [dependencias]). Cada función recibe como
+    argumentos los resultados de sus dependencias, en el orden declarado, y se lanza
+    en cuanto todas ellas terminan. Devuelve un dict nombre -> resultado.
+
+    Las etapas corren en un pool compartido (máximo `max_workers` a la vez por grafo).
+    Mientras espera, quien llama corre él mismo las etapas que siguen en la cola: un
+    grafo anidado dentro de una etapa avanza aunque el pool esté lleno.
+    """
+    for nombre, (_, dependencias) in etapas.items():
+        faltantes = [d for d in dependencias if d not in etapas]
+        if faltantes:
+            raise ValueError(f"La etapa '{nombre}' depende de etapas inexistentes: {faltantes}")
+
+    resultados = {}
+    pendientes = dict(etapas)
+    en_curso = {}
+    executor = _executor_compartido()
+
+    def cancelar_en_curso():
+        # No tiene sentido lanzar etapas que dependen de una que falló
+        for pendiente in en_curso:
+            pendiente.cancel()
+
+    while pendientes or en_curso:
+        # Lanzar todas las etapas cuyas dependencias ya tienen resultado
+        listas = [n for n, (_, deps) in pendientes.items() if all(d in resultados for d in deps)]
+        for nombre in listas[:max(1, max_workers) - len(en_curso)]:
+            funcion, dependencias = pendientes.pop(nombre)
+            futuro = enviar_con_contexto(executor, _etapa_trazada, nombre, funcion,
+                                         *[resultados[d] for d in dependencias])
+            en_curso[futuro] = nombre
+
+        if not en_curso:
+            raise ValueError(f"Dependencias circulares entre las etapas: {sorted(pendientes)}")
+
+        # Una etapa que ningún hilo ha tomado se corre aquí (cancel() solo funciona si no ha empezado)
+        sin_empezar = next((futuro for futuro in en_curso if futuro.cancel()), None)
+        if sin_empezar is not None:
+            nombre = en_curso.pop(sin_empezar)
+            funcion, dependencias = etapas[nombre]
+            try:
+                resultados[nombre] = contextvars.copy_context().run(
+                    _etapa_trazada, nombre, funcion, *[resultados[d] for d in dependencias]
+                )
+            except Exception:
+                cancelar_en_curso()
+                raise
+            continue
+
+        terminados, _ = wait(en_curso, return_when=FIRST_COMPLETED)
+        for futuro in terminados:
+            nombre = en_curso.pop(futuro)
+            try:
+                resultados[nombre] = futuro.result()
+            except Exception:
+                cancelar_en_curso()
+                raise
+
+    return resultados
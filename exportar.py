@@ -0,0 +1,403 @@
+"""Exportación local del curso: syllabus .docx, outline .xlsx/.csv y clases .docx/.md.
+
+Todo se escribe en disco sin pasar por las APIs de Google (salvo, una sola vez, la
+descarga de la plantilla si no hay copia local). Subir a Google Drive es un paso final
+opcional: cada archivo se convierte a Docs/Sheets en una sola carga.
+"""
+import csv
+import os
+import re
+import shutil
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape
+
+from checkpoints import CheckpointClases
+from ejecutor_etapas import ejecutar_etapas, enviar_con_contexto
+from generador_clases import contexto_clases, generar_clase_segura
+from metricas import trazar
+from outline import clases_desde_filas
+from utils import (
+    ANIO, SECCIONES_SYLLABUS, TEMPLATE_ID, conceder_permisos_dominio, datos_del_curso, ejecutar_google,
+    get_drive_service, obtener_datos_generales, pedir_secciones_syllabus, secreto, sin_progreso, valores_syllabus
+)
+
+MIME_DOCX = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+MIME_XLSX = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+# XML 1.0 no admite estos caracteres de control: Word no abre un documento que los tenga
+_CONTROL_INVALIDO = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+_W = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+_R = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+_PAQUETE = "http://schemas.openxmlformats.org/package/2006"
+
+
+def _texto_xml(texto: str) -> str:
+    return escape(_CONTROL_INVALIDO.sub("", texto))
+
+
+def _lineas_xml(texto: str) -> str:
+    # Texto para ir dentro de un <w:t>: cada salto de línea cierra el <w:t>, pone un <w:br/> y abre otro
+    return '</w:t><w:br/><w:t xml:space="preserve">'.join(_texto_xml(linea) for linea in texto.split("\n"))
+
+
+def _run_xml(texto: str) -> str:
+    return f'<w:t xml:space="preserve">{_lineas_xml(texto)}</w:t>'
+
+
+# =========================
+# 📝 DOCX EN STREAMING
+# =========================
+class EscritorDocx:
+    """Escribe un .docx párrafo por párrafo directo al zip: no se guarda el documento en memoria."""
+
+    def __init__(self, ruta: str):
+        self.ruta = ruta
+        self.zip = zipfile.ZipFile(ruta, "w", compression=zipfile.ZIP_DEFLATED)
+        self.zip.writestr("[Content_Types].xml", (
+            f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            f'<Types xmlns="{_PAQUETE}/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/word/document.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+            '</Types>'
+        ))
+        self.zip.writestr("_rels/.rels", (
+            f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            f'<Relationships xmlns="{_PAQUETE}/relationships">'
+            f'<Relationship Id="rId1" Type="{_R}/officeDocument" Target="word/document.xml"/>'
+            '</Relationships>'
+        ))
+        # Solo un miembro del zip puede estar abierto para escritura: el documento va al final
+        self.documento = self.zip.open("word/document.xml", "w")
+        self._escribir(f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                       f'<w:document xmlns:w="{_W}"><w:body>')
+
+    def _escribir(self, xml: str):
+        self.documento.write(xml.encode("utf-8"))
+
+    def parrafo(self, texto: str, negritas: bool = False):
+        propiedades = "<w:rPr><w:b/></w:rPr>" if negritas else ""
+        self._escribir(f"<w:p><w:r>{propiedades}{_run_xml(texto)}</w:r></w:p>")
+
+    def cerrar(self) -> str:
+        self._escribir("</w:body></w:document>")
+        self.documento.close()
+        self.zip.close()
+        return self.ruta
+
+
+class EscritorClases:
+    """Clases a .docx y/o Markdown conforme se terminan; cada clase se escribe y se suelta."""
+
+    def __init__(self, ruta_base: str, titulo: str, formatos=("docx", "md")):
+        self.rutas = {}
+        self.docx = None
+        self.markdown = None
+        if "docx" in formatos:
+            self.docx = EscritorDocx(f"{ruta_base}.docx")
+            self.docx.parrafo(titulo, negritas=True)
+            self.rutas["docx"] = self.docx.ruta
+        if "md" in formatos:
+            self.rutas["md"] = f"{ruta_base}.md"
+            self.markdown = open(self.rutas["md"], "w", encoding="utf-8")
+            self.markdown.write(f"# {titulo}\n")
+
+    def escribir_clase(self, numero: int, titulo: str, contenido: str):
+        if self.docx:
+            self.docx.parrafo(f"CLASE {numero}: {titulo}", negritas=True)
+            for linea in contenido.split("\n"):
+                self.docx.parrafo(linea)
+        if self.markdown:
+            self.markdown.write(f"\n## CLASE {numero}: {titulo}\n\n{contenido}\n")
+            self.markdown.flush()
+
+    def cerrar(self) -> dict:
+        if self.docx:
+            self.docx.cerrar()
+        if self.markdown:
+            self.markdown.close()
+        return self.rutas
+
+
+# =========================
+# 📄 PLANTILLA DEL SYLLABUS
+# =========================
+def _llenar_parrafo(parrafo: str, valores: dict) -> str:
+    # Word suele partir un placeholder en varios runs: se une el texto del párrafo, se reemplaza
+    # y el resultado queda en el primer <w:t> (con el formato de ese run)
+    textos = list(re.finditer(r"(<w:t(?: [^>]*)?>)(.*?)(</w:t>)", parrafo, re.DOTALL))
+    unido = "".join(t.group(2) for t in textos)
+    if "{{" not in unido:
+        return parrafo
+    nuevo = re.sub(r"\{\{\w+\}\}", lambda m: _lineas_xml(valores[m.group(0)]) if m.group(0) in valores
+                   else m.group(0), unido)
+    if nuevo == unido:
+        return parrafo
+    partes = []
+    cursor = 0
+    for indice, texto in enumerate(textos):
+        partes.append(parrafo[cursor:texto.start()])
+        partes.append(f'<w:t xml:space="preserve">{nuevo}</w:t>' if indice == 0 else "<w:t></w:t>")
+        cursor = texto.end()
+    partes.append(parrafo[cursor:])
+    return "".join(partes)
+
+
+def llenar_plantilla_docx(plantilla: str, valores: dict, destino: str) -> str:
+    """Copia la plantilla .docx llenando todos los placeholders en una sola pasada por cada parte."""
+    with zipfile.ZipFile(plantilla) as origen, \
+            zipfile.ZipFile(destino, "w", compression=zipfile.ZIP_DEFLATED) as salida:
+        for miembro in origen.infolist():
+            datos = origen.read(miembro)
+            # Cuerpo, encabezados y pies de página
+            if re.fullmatch(r"word/(document|header\d*|footer\d*)\.xml", miembro.filename):
+                xml = datos.decode("utf-8")
+                xml = re.sub(r"<w:p[ >].*?</w:p>", lambda m: _llenar_parrafo(m.group(0), valores), xml,
+                             flags=re.DOTALL)
+                datos = xml.encode("utf-8")
+            salida.writestr(miembro, datos)
+    return destino
+
+
+def plantilla_syllabus_local(directorio: str = ".cache", vigencia_segundos: int = 24 * 3600) -> str:
+    """Ruta de la plantilla en .docx: SYLLABUS_PLANTILLA_DOCX o una copia exportada de Drive (una vez al día)."""
+    configurada = secreto("SYLLABUS_PLANTILLA_DOCX", "")
+    if configurada:
+        return configurada
+    ruta = os.path.join(directorio, f"plantilla-{TEMPLATE_ID}.docx")
+    if os.path.exists(ruta) and time.time() - os.path.getmtime(ruta) < vigencia_segundos:
+        return ruta
+    contenido = ejecutar_google(get_drive_service().files().export_media(fileId=TEMPLATE_ID, mimeType=MIME_DOCX))
+    os.makedirs(directorio, exist_ok=True)
+    # Temporal propio de esta descarga: dos exportaciones simultáneas no escriben el mismo archivo
+    descriptor, temporal = tempfile.mkstemp(dir=directorio, prefix=f"plantilla-{TEMPLATE_ID}-", suffix=".tmp")
+    try:
+        with os.fdopen(descriptor, "wb") as f:
+            f.write(contenido)
+        os.replace(temporal, ruta)
+    except BaseException:
+        os.unlink(temporal)
+        raise
+    return ruta
+
+
+# =========================
+# 📊 OUTLINE
+# =========================
+def _columna(indice: int) -> str:
+    letras = ""
+    indice += 1
+    while indice:
+        indice, resto = divmod(indice - 1, 26)
+        letras = chr(ord("A") + resto) + letras
+    return letras
+
+
+def escribir_outline_xlsx(filas: list, destino: str) -> str:
+    hoja = "".join(
+        f'<row r="{numero}">' + "".join(
+            f'<c r="{_columna(columna)}{numero}" t="inlineStr"><is><t xml:space="preserve">{_texto_xml(str(valor))}'
+            f'</t></is></c>'
+            for columna, valor in enumerate(fila)
+        ) + "</row>"
+        for numero, fila in enumerate(filas, 1)
+    )
+    principal = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+    with zipfile.ZipFile(destino, "w", compression=zipfile.ZIP_DEFLATED) as salida:
+        salida.writestr("[Content_Types].xml", (
+            f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            f'<Types xmlns="{_PAQUETE}/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/worksheets/sheet1.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            '</Types>'
+        ))
+        salida.writestr("_rels/.rels", (
+            f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            f'<Relationships xmlns="{_PAQUETE}/relationships">'
+            f'<Relationship Id="rId1" Type="{_R}/officeDocument" Target="xl/workbook.xml"/>'
+            '</Relationships>'
+        ))
+        salida.writestr("xl/workbook.xml", (
+            f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            f'<workbook xmlns="{principal}" xmlns:r="{_R}">'
+            '<sheets><sheet name="Outline" sheetId="1" r:id="rId1"/></sheets></workbook>'
+        ))
+        salida.writestr("xl/_rels/workbook.xml.rels", (
+            f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            f'<Relationships xmlns="{_PAQUETE}/relationships">'
+            f'<Relationship Id="rId1" Type="{_R}/worksheet" Target="worksheets/sheet1.xml"/>'
+            '</Relationships>'
+        ))
+        salida.writestr("xl/worksheets/sheet1.xml", (
+            f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            f'<worksheet xmlns="{principal}"><sheetData>{hoja}</sheetData></worksheet>'
+        ))
+    return destino
+
+
+def escribir_outline_csv(filas: list, destino: str) -> str:
+    # utf-8-sig: Excel reconoce los acentos al abrir el CSV con doble clic
+    with open(destino, "w", encoding="utf-8-sig", newline="") as f:
+        csv.writer(f).writerows(filas)
+    return destino
+
+
+# =========================
+# 📚 CLASES
+# =========================
+@trazar()
+def exportar_clases(ruta_base: str, nombre_doc: str, clases_info: list, perfil_estudiante: str, industria: str,
+                    max_workers: int = 4, regenerar: bool = False, progreso=sin_progreso,
+                    formatos=("docx", "md"), curso: dict = None) -> dict:
+    """Genera las clases en paralelo y las escribe en disco en orden, cada una en cuanto le toca."""
+    total_clases = len(clases_info)
+    # 📌 Mismo checkpoint de contenido que el camino de Google: un reintento no vuelve a pedir lo ya generado
+    clave = CheckpointClases.clave("exportacion-local", nombre_doc, clases_info, perfil_estudiante, industria)
+    with CheckpointClases.exclusivo(clave):
+        checkpoint = CheckpointClases.abrir(clave, reiniciar=regenerar)
+        escritor = EscritorClases(ruta_base, nombre_doc, formatos)
+        try:
+            with contexto_clases(perfil_estudiante, industria, clases_info, curso) as contexto, \
+                    ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+                futuros = {
+                    numero: enviar_con_contexto(executor, generar_clase_segura, checkpoint, numero, clase_info,
+                                                perfil_estudiante, industria, regenerar, contexto)
+                    for numero, clase_info in enumerate(clases_info, 1)
+                }
+                for numero, clase_info in enumerate(clases_info, 1):
+                    # Se suelta el futuro al escribir la clase: en memoria solo quedan las que esperan turno
+                    contenido, _ = futuros.pop(numero).result()
+                    escritor.escribir_clase(numero, clase_info["titulo"], contenido.strip())
+                    progreso(f"Clase {numero} de {total_clases}", numero, total_clases)
+        finally:
+            rutas = escritor.cerrar()
+        return rutas
+
+
+# =========================
+# 📦 CURSO COMPLETO
+# =========================
+def limpiar_exportaciones(directorio: str, vigencia_segundos: int = 24 * 3600):
+    """Borra las exportaciones (una carpeta por corrida) con más de `vigencia_segundos`."""
+    if not os.path.isdir(directorio):
+        return
+    limite = time.time() - vigencia_segundos
+    for nombre in os.listdir(directorio):
+        ruta = os.path.join(directorio, nombre)
+        if os.path.isdir(ruta) and os.path.getmtime(ruta) < limite:
+            shutil.rmtree(ruta, ignore_errors=True)
+
+
+def _nombre_archivo(nombre: str) -> str:
+    return re.sub(r"[^\w\- ]+", "", nombre).strip().replace(" ", "_") or "curso"
+
+
+@trazar()
+def exportar_curso(directorio: str, nombre_del_curso, nivel, publico, student_persona, siguiente, objetivos_raw,
+                   num_clases, industria: str = "analítica de datos", max_workers: int = 4, regenerar: bool = False,
+                   progreso=sin_progreso, con_clases: bool = True, formatos_clases=("docx", "md"),
+                   subir: bool = False) -> dict:
+    """Escribe syllabus, outline y clases en `directorio`; devuelve {"archivos": {...}, "links": {...}}.
+
+    Con `subir`, al final se suben todos los archivos a Google Drive de una vez.
+    """
+    os.makedirs(directorio, exist_ok=True)
+    base = os.path.join(directorio, _nombre_archivo(nombre_del_curso))
+    progreso("Generando datos generales del curso", 0, 3)
+    perfil_ingreso, objetivos_mejorados, perfil_egreso, outline, \
+    titulo1, desc1, titulo2, desc2, titulo3, desc3 = obtener_datos_generales(
+        nombre_del_curso, nivel, publico, student_persona, siguiente, objetivos_raw, num_clases, regenerar
+    )
+    curso = datos_del_curso(nombre_del_curso, nivel, objetivos_mejorados, perfil_ingreso, perfil_egreso)
+
+    def syllabus():
+        secciones = pedir_secciones_syllabus(curso, outline, list(SECCIONES_SYLLABUS), regenerar)
+        valores = valores_syllabus(nombre_del_curso, ANIO, secciones, titulo1, desc1, titulo2, desc2, titulo3, desc3)
+        return llenar_plantilla_docx(plantilla_syllabus_local(), valores, f"{base}-syllabus.docx")
+
+    def outline_archivos():
+        return {
+            "xlsx": escribir_outline_xlsx(outline, f"{base}-outline.xlsx"),
+            "csv": escribir_outline_csv(outline, f"{base}-outline.csv"),
+        }
+
+    def clases():
+        return exportar_clases(
+            f"{base}-clases", f"Clases - {nombre_del_curso}", list(clases_desde_filas(outline)), student_persona,
+            industria, max_workers=max_workers, regenerar=regenerar, progreso=progreso, formatos=formatos_clases,
+            curso=curso,
+        )
+
+    # ⚡ Las clases solo necesitan el outline: se generan mientras se piden las secciones del syllabus
+    etapas = {"syllabus": (syllabus, []), "outline": (outline_archivos, [])}
+    if con_clases:
+        etapas["clases"] = (clases, [])
+    progreso("Generando syllabus, outline y clases", 1, 3)
+    resultados = ejecutar_etapas(etapas)
+
+    archivos = {
+        "syllabus": resultados["syllabus"],
+        "outline_xlsx": resultados["outline"]["xlsx"],
+        "outline_csv": resultados["outline"]["csv"],
+    }
+    for formato, ruta in resultados.get("clases", {}).items():
+        archivos[f"clases_{formato}"] = ruta
+
+    links = subir_a_google(archivos, nombre_del_curso) if subir else {}
+    progreso("Listo", 3, 3)
+    return {"archivos": archivos, "links": links}
+
+
+# =========================
+# ☁️ SUBIDA OPCIONAL A GOOGLE DRIVE
+# =========================
+@trazar()
+def subir_a_google(archivos: dict, nombre_del_curso: str, max_workers: int = 4) -> dict:
+    """Sube los archivos exportados convirtiéndolos a Docs/Sheets; una carga por archivo, en paralelo."""
+    from googleapiclient.http import MediaFileUpload
+
+    # clave de `archivos` -> (nombre en Drive, tipo de Google, MIME local, dominio con permiso de edición)
+    destinos = {
+        "syllabus": (f"Syllabus - {nombre_del_curso}", "document", MIME_DOCX, "purpura.ai"),
+        "outline_xlsx": (f"Outline - {nombre_del_curso}", "spreadsheet", MIME_XLSX, "purpura.ai"),
+        "clases_docx": (f"Clases - {nombre_del_curso}", "document", MIME_DOCX, "datarebels.mx"),
+    }
+
+    def subir(clave):
+        nombre, tipo, mime, _ = destinos[clave]
+        peticion = get_drive_service().files().create(
+            body={"name": nombre, "mimeType": f"application/vnd.google-apps.{tipo}"},
+            media_body=MediaFileUpload(archivos[clave], mimetype=mime, resumable=False),
+            fields="id",
+        )
+        # Como el de batch, el URI de carga no respeta api_endpoint: se ajusta a mano si hay uno
+        endpoint = secreto("GOOGLE_API_ENDPOINT", "")
+        if endpoint:
+            peticion.uri = endpoint.rstrip("/") + peticion.uri[peticion.uri.index("/upload/"):]
+        return ejecutar_google(peticion)["id"]
+
+    claves = [clave for clave in destinos if clave in archivos]
+    # Los hilos heredan los clientes de Google de quien llama (cada hilo usa su propio transporte)
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futuros = {clave: enviar_con_contexto(executor, subir, clave) for clave in claves}
+        ids = {clave: futuro.result() for clave, futuro in futuros.items()}
+
+    # Un batch de permisos por dominio, como en el camino de Google
+    for dominio, descubrible in (("purpura.ai", True), ("datarebels.mx", None)):
+        del_dominio = [ids[clave] for clave in claves if destinos[clave][3] == dominio]
+        if del_dominio:
+            conceder_permisos_dominio(del_dominio, dominio, allow_file_discovery=descubrible)
+
+    return {
+        clave: f"https://docs.google.com/{destinos[clave][1]}s/d/{file_id}/edit"
+        for clave, file_id in ids.items()
+    }
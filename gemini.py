@@ -0,0 +1,621 @@
+import json
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as TimeoutFuturo
+from email.utils import parsedate_to_datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from cache_gemini import CacheRespuestas
+from ejecutor_etapas import enviar_con_contexto
+from metricas import contar, span
+
+GEMINI_BASE_URL = "https://generativelanguage.googleapis.com/v1beta"
+MODELO_POR_DEFECTO = "gemini-2.5-flash"
+
+# Respuestas que vale la pena reintentar: cuota (429) y fallas transitorias del servidor
+STATUS_REINTENTABLES = {429, 500, 502, 503, 504}
+
+
+class ErrorGemini(Exception):
+    def __init__(self, mensaje, status_code=None):
+        super().__init__(mensaje)
+        self.status_code = status_code
+
+
+# =========================
+# 🪣 LIMITADOR DE CUOTA (TOKEN BUCKET)
+# =========================
+class LimitadorTokens:
+    """Token bucket doble: peticiones por minuto y tokens por minuto.
+
+    Una sola instancia se comparte entre todos los hilos y sesiones del proceso,
+    así que la app se mantiene justo por debajo de la cuota en vez de recibir 429.
+    """
+
+    def __init__(self, peticiones_por_minuto: int, tokens_por_minuto: int):
+        self.capacidad_peticiones = float(peticiones_por_minuto)
+        self.capacidad_tokens = float(tokens_por_minuto)
+        self.peticiones = self.capacidad_peticiones
+        self.tokens = self.capacidad_tokens
+        self.ultimo = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _rellenar(self):
+        ahora = time.monotonic()
+        transcurrido = ahora - self.ultimo
+        self.ultimo = ahora
+        self.peticiones = min(self.capacidad_peticiones, self.peticiones + transcurrido * self.capacidad_peticiones / 60)
+        self.tokens = min(self.capacidad_tokens, self.tokens + transcurrido * self.capacidad_tokens / 60)
+
+    def adquirir(self, tokens: int):
+        # Una petición más grande que el bucket completo solo puede esperar a que se llene
+        tokens = min(float(tokens), self.capacidad_tokens)
+        while True:
+            with self.lock:
+                self._rellenar()
+                if self.peticiones >= 1 and self.tokens >= tokens:
+                    self.peticiones -= 1
+                    self.tokens -= tokens
+                    return
+                falta_peticiones = max(0.0, 1 - self.peticiones) * 60 / self.capacidad_peticiones
+                falta_tokens = max(0.0, tokens - self.tokens) * 60 / self.capacidad_tokens
+                espera = max(falta_peticiones, falta_tokens)
+            time.sleep(min(espera, 5.0))
+
+    def ajustar(self, tokens_estimados: int, tokens_reales: int):
+        # Corrige el bucket con el conteo real que reporta Gemini (usageMetadata)
+        with self.lock:
+            self._rellenar()
+            self.tokens -= tokens_reales - tokens_estimados
+
+
+def estimar_tokens(texto: str) -> int:
+    # Aproximación estándar de ~4 caracteres por token
+    return max(1, len(texto) // 4)
+
+
+# =========================
+# 🏁 COBERTURA (HEDGING) DE LLAMADAS LENTAS
+# =========================
+class PoliticaCobertura:
+    """Decide cuándo duplicar una llamada lenta a Gemini.
+
+    Aprende la latencia de cada tipo de llamada (modelo + tarea) y, si una tarda más que
+    el `percentil` observado, autoriza un duplicado siempre que las llamadas duplicadas no
+    pasen de `presupuesto_extra` (0.1 = hasta 10 % más llamadas que sin cobertura).
+    """
+
+    def __init__(self, percentil: float = 0.9, presupuesto_extra: float = 0.1, min_muestras: int = 20,
+                 ventana: int = 200):
+        self.percentil = percentil
+        self.presupuesto_extra = presupuesto_extra
+        self.min_muestras = min_muestras
+        self.latencias = defaultdict(lambda: deque(maxlen=ventana))
+        self.llamadas = 0
+        self.duplicadas = 0
+        self.lock = threading.Lock()
+
+    def registrar(self, clave: str, segundos: float):
+        with self.lock:
+            self.latencias[clave].append(segundos)
+
+    def umbral(self, clave: str):
+        # None mientras no haya suficientes muestras para estimar el percentil
+        with self.lock:
+            self.llamadas += 1
+            muestras = sorted(self.latencias[clave])
+        if len(muestras) < self.min_muestras:
+            return None
+        return muestras[min(len(muestras) - 1, int(self.percentil * len(muestras)))]
+
+    def autorizar_duplicado(self) -> bool:
+        with self.lock:
+            if self.duplicadas + 1 > self.presupuesto_extra * self.llamadas:
+                return False
+            self.duplicadas += 1
+            return True
+
+
+# =========================
+# 🛬 VUELO ÚNICO (PETICIONES IDÉNTICAS SIMULTÁNEAS)
+# =========================
+class VueloUnico:
+    """Une peticiones idénticas en curso: la primera llama a Gemini y las demás esperan su resultado.
+
+    A diferencia de la caché, cubre el tiempo en que la respuesta todavía no existe (dos
+    sesiones que generan el mismo curso a la vez). Si la llamada falla, todas reciben el error.
+    """
+
+    def __init__(self):
+        self.en_vuelo = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def clave(modelo: str, generation_config: dict, prompt: str) -> str:
+        # Normalizada: espacios y saltos de línea de más no hacen distinta una petición
+        return CacheRespuestas.clave(modelo, generation_config, " ".join(prompt.split()))
+
+    def en_curso(self, clave: str):
+        with self.lock:
+            return self.en_vuelo.get(clave)
+
+    def hacer(self, clave: str, funcion, *args):
+        with self.lock:
+            futuro = self.en_vuelo.get(clave)
+            lider = futuro is None
+            if lider:
+                futuro = self.en_vuelo[clave] = Future()
+        if not lider:
+            contar("gemini_vuelo_unico_total", resultado="compartido")
+            with span("gemini_vuelo_unico_espera"):
+                return futuro.result()
+
+        contar("gemini_vuelo_unico_total", resultado="lider")
+        try:
+            resultado = funcion(*args)
+        except BaseException as e:
+            futuro.set_exception(e)
+            raise
+        else:
+            futuro.set_result(resultado)
+            return resultado
+        finally:
+            with self.lock:
+                del self.en_vuelo[clave]
+
+
+# =========================
+# 🤖 CLIENTE GEMINI
+# =========================
+class ClienteGemini:
+    """Cliente con sesión keep-alive, timeouts explícitos y reintentos con backoff."""
+
+    def __init__(self, api_key: str, limitador: LimitadorTokens = None, cache=None, modelo: str = MODELO_POR_DEFECTO,
+                 base_url: str = GEMINI_BASE_URL, timeout=(10, 300), max_reintentos: int = 5,
+                 backoff_base: float = 1.0, backoff_max: float = 60.0, pool_size: int = 32,
+                 max_concurrentes: int = None, cobertura: PoliticaCobertura = None):
+        self.api_key = api_key
+        self.limitador = limitador
+        self.cache = cache
+        self.modelo = modelo
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.max_reintentos = max_reintentos
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        # Tope global de llamadas simultáneas (además del límite por minuto del token bucket)
+        self.semaforo = threading.BoundedSemaphore(max_concurrentes) if max_concurrentes else None
+        # Con cobertura, cada llamada corre en este pool para poder esperarla con timeout y duplicarla;
+        # el doble de hilos que conexiones para que un duplicado no espere en cola detrás de originales
+        self.cobertura = cobertura
+        self.vuelos = VueloUnico()
+        self.executor_cobertura = ThreadPoolExecutor(
+            max_workers=2 * pool_size, thread_name_prefix="gemini-cobertura"
+        ) if cobertura else None
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Content-Type": "application/json", "x-goog-api-key": api_key})
+
+    def _leer_cache(self, clave: str, usar_cache: bool):
+        # Con usar_cache=False ("regenerar") se ignora lo guardado, pero la respuesta nueva sí se guarda
+        if not clave or not usar_cache:
+            return None
+        guardado = self.cache.obtener(clave)
+        contar("gemini_cache_total", resultado="hit" if guardado is not None else "miss")
+        return guardado
+
+    def _clave(self, modelo: str, generation_config: dict, prompt: str, contexto):
+        # La clave usa el prompt completo: da igual si el prefijo viajó en línea o desde cachedContents
+        if not self.cache:
+            return None
+        return self.cache.clave(modelo, generation_config, (contexto.prefijo if contexto else "") + prompt)
+
+    def _cuerpo(self, prompt: str, generation_config: dict, modelo: str, contexto) -> tuple:
+        # Con un contexto compartido vigente solo viaja el sufijo; si no, el prefijo va en línea al inicio
+        nombre = contexto.nombre_para(modelo) if contexto else None
+        if nombre:
+            data = {"cachedContent": nombre, "contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+        else:
+            texto = contexto.prefijo + prompt if contexto else prompt
+            data = {"contents": [{"role": "user", "parts": [{"text": texto}]}]}
+        if generation_config:
+            data["generationConfig"] = generation_config
+        return data, nombre
+
+    def _post_generacion(self, accion: str, prompt: str, generation_config: dict, modelo: str, contexto,
+                         **kwargs) -> tuple:
+        # Devuelve también los tokens estimados, para corregir el limitador con el conteo real
+        data, nombre = self._cuerpo(prompt, generation_config, modelo, contexto)
+        tokens = _tokens_enviados(data)
+        try:
+            return self._post(f"models/{modelo}:{accion}", data, tokens, **kwargs), tokens
+        except ErrorGemini as e:
+            if not nombre or e.status_code not in (400, 403, 404):
+                raise
+            # El contenido en caché expiró o ya no existe: se sigue con el prefijo en línea
+            contexto.descartar(nombre)
+            data, _ = self._cuerpo(prompt, generation_config, modelo, contexto)
+            tokens = _tokens_enviados(data)
+            return self._post(f"models/{modelo}:{accion}", data, tokens, **kwargs), tokens
+
+    def _intento(self, clave_latencia: str, prompt: str, generation_config: dict, modelo: str, contexto):
+        inicio = time.perf_counter()
+        respuesta, _ = self._post_generacion("generateContent", prompt, generation_config, modelo, contexto)
+        # El uso se registra aquí: un duplicado que pierde también cuesta tokens
+        registrar_uso(respuesta.get("usageMetadata", {}), modelo)
+        if self.cobertura:
+            self.cobertura.registrar(clave_latencia, time.perf_counter() - inicio)
+        return respuesta
+
+    def _con_cobertura(self, clave_latencia: str, *args):
+        umbral = self.cobertura.umbral(clave_latencia)
+        original = enviar_con_contexto(self.executor_cobertura, self._intento, clave_latencia, *args)
+        if umbral is None:
+            return original.result()
+        try:
+            return original.result(timeout=umbral)
+        except TimeoutFuturo:
+            pass
+        if not self.cobertura.autorizar_duplicado():
+            return original.result()
+
+        # Gana la primera respuesta correcta; la otra sigue en segundo plano y se descarta
+        contar("gemini_cobertura_total", resultado="lanzada")
+        duplicado = enviar_con_contexto(self.executor_cobertura, self._intento, clave_latencia, *args)
+        pendientes = {original, duplicado}
+        error = None
+        while pendientes:
+            listos, pendientes = wait(pendientes, return_when=FIRST_COMPLETED)
+            for futuro in listos:
+                try:
+                    respuesta = futuro.result()
+                except Exception as e:
+                    error = e
+                    continue
+                contar("gemini_cobertura_total", resultado="gano_duplicado" if futuro is duplicado else "gano_original")
+                return respuesta
+        raise error
+
+    def _generar_respuesta(self, prompt: str, generation_config: dict, modelo: str, contexto=None,
+                           tarea: str = None) -> dict:
+        clave_latencia = f"{modelo}:{tarea or 'general'}"
+        if self.cobertura:
+            return self._con_cobertura(clave_latencia, prompt, generation_config, modelo, contexto)
+        return self._intento(clave_latencia, prompt, generation_config, modelo, contexto)
+
+    def _generar_texto(self, prompt: str, generation_config: dict, modelo: str, contexto=None,
+                       tarea: str = None) -> str:
+        return extraer_texto(self._generar_respuesta(prompt, generation_config, modelo, contexto, tarea))
+
+    def generar(self, prompt: str, generation_config: dict = None, modelo: str = None, usar_cache: bool = True,
+                contexto=None, tarea: str = None) -> str:
+        """Genera texto. Con `contexto` (ContextoCompartido), `prompt` es solo el sufijo tras el prefijo común.
+
+        `tarea` identifica el punto de llamada: la cobertura aprende una latencia distinta por tarea.
+        """
+        modelo = modelo or self.modelo
+        clave = self._clave(modelo, generation_config, prompt, contexto)
+        guardado = self._leer_cache(clave, usar_cache)
+        if guardado is not None:
+            return guardado
+
+        def generar_y_guardar():
+            texto = self._generar_texto(prompt, generation_config, modelo, contexto, tarea)
+            if clave:
+                self.cache.guardar(clave, texto)
+            return texto
+
+        vuelo = VueloUnico.clave(modelo, generation_config, (contexto.prefijo if contexto else "") + prompt)
+        return self.vuelos.hacer(vuelo, generar_y_guardar)
+
+    def generar_json(self, prompt: str, esquema: dict, generation_config: dict = None, modelo: str = None,
+                     usar_cache: bool = True, tarea: str = None) -> dict:
+        """Salida estructurada: Gemini responde JSON que cumple `esquema` (responseSchema)."""
+        modelo = modelo or self.modelo
+        generation_config = {
+            **(generation_config or {}), "responseMimeType": "application/json", "responseSchema": esquema
+        }
+        clave = self.cache.clave(modelo, generation_config, prompt) if self.cache else None
+        guardado = self._leer_cache(clave, usar_cache)
+        if guardado is not None:
+            return json.loads(guardado)
+
+        def generar_y_guardar():
+            config = generation_config
+            for intento in range(2):
+                respuesta = self._generar_respuesta(prompt, config, modelo, tarea=tarea)
+                motivo = motivo_fin(respuesta)
+                texto = texto_de_respuesta(respuesta)
+                try:
+                    json.loads(texto)
+                    break
+                except ValueError as e:
+                    if motivo == "MAX_TOKENS" and intento == 0:
+                        # El razonamiento también cuenta contra maxOutputTokens: se reintenta una vez
+                        # con más presupuesto de salida y el razonamiento acotado
+                        contar("gemini_json_reintentos_total", motivo="max_tokens")
+                        config = ampliar_presupuesto(config)
+                        continue
+                    # No se guarda en caché: un reintento posterior vuelve a pedirlo
+                    if motivo == "MAX_TOKENS":
+                        raise ErrorGemini(f"Gemini cortó el JSON al llegar a maxOutputTokens="
+                                          f"{config.get('maxOutputTokens')}, aun con el presupuesto ampliado") from e
+                    raise ErrorGemini(f"Gemini devolvió JSON inválido (finishReason={motivo}): {e}") from e
+            # Se guarda con la clave de la configuración original: la siguiente vez sale de caché
+            if clave:
+                self.cache.guardar(clave, texto)
+            return texto
+
+        # Se comparte el texto y cada quien decodifica el suyo: nadie recibe un dict que otro pueda modificar
+        texto = self.vuelos.hacer(VueloUnico.clave(modelo, generation_config, prompt), generar_y_guardar)
+        return json.loads(texto)
+
+    def generar_stream(self, prompt: str, generation_config: dict = None, modelo: str = None,
+                       usar_cache: bool = True, contexto=None):
+        """Igual que `generar`, pero va entregando el texto en fragmentos (streamGenerateContent/SSE)."""
+        modelo = modelo or self.modelo
+        clave = self._clave(modelo, generation_config, prompt, contexto)
+        guardado = self._leer_cache(clave, usar_cache)
+        if guardado is not None:
+            yield guardado
+            return
+        # Si la misma clase ya se está generando sin streaming, se espera esa respuesta en lugar de pedirla otra vez
+        en_curso = self.vuelos.en_curso(
+            VueloUnico.clave(modelo, generation_config, (contexto.prefijo if contexto else "") + prompt)
+        )
+        if en_curso is not None:
+            contar("gemini_vuelo_unico_total", resultado="compartido")
+            yield en_curso.result()
+            return
+
+        # Los reintentos solo cubren el arranque: una vez que llega texto no se puede repetir
+        response, tokens_estimados = self._post_generacion("streamGenerateContent", prompt, generation_config, modelo, contexto,
+                                         params={"alt": "sse"}, stream=True)
+
+        fragmentos = []
+        uso = {}
+        with response:
+            for linea in response.iter_lines(decode_unicode=True):
+                if not linea or not linea.startswith("data:"):
+                    continue
+                evento = json.loads(linea[len("data:"):])
+                uso = evento.get("usageMetadata", uso)
+                for candidato in evento.get("candidates", [])[:1]:
+                    for parte in candidato.get("content", {}).get("parts", []):
+                        if parte.get("text"):
+                            fragmentos.append(parte["text"])
+                            yield parte["text"]
+
+        registrar_uso(uso, modelo)
+        if self.limitador:
+            self.limitador.ajustar(tokens_estimados, uso.get("totalTokenCount", tokens_estimados))
+        texto = "".join(fragmentos).strip()
+        if not texto:
+            raise ErrorGemini("Respuesta vacía de Gemini en modo streaming")
+        if clave:
+            self.cache.guardar(clave, texto)
+
+    # === Caché de contexto (cachedContents) ===
+    def crear_contexto(self, prefijo: str, modelo: str, ttl_segundos: int) -> str:
+        data = {
+            "model": f"models/{modelo}",
+            "contents": [{"role": "user", "parts": [{"text": prefijo}]}],
+            "ttl": f"{ttl_segundos}s",
+        }
+        return self._post("cachedContents", data, estimar_tokens(prefijo))["name"]
+
+    def borrar_contexto(self, nombre: str):
+        # Si falla no pasa nada: el contenido expira solo al cumplirse su ttl
+        try:
+            self.session.delete(f"{self.base_url}/{nombre}", timeout=self.timeout)
+        except requests.RequestException:
+            pass
+
+    def _espera_backoff(self, intento: int) -> float:
+        # Exponential backoff con "full jitter"
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** intento))
+
+    def _post(self, ruta: str, data: dict, tokens_estimados: int, params: dict = None, stream: bool = False):
+        # Con stream=True devuelve la respuesta HTTP abierta en vez del JSON ya decodificado
+        url = f"{self.base_url}/{ruta}"
+        # Se serializa una vez: el mismo cuerpo sirve para todos los reintentos y para contar bytes
+        cuerpo_http = json.dumps(data).encode("utf-8")
+        ultimo_error = None
+        for intento in range(self.max_reintentos + 1):
+            if self.limitador:
+                inicio_espera = time.perf_counter()
+                self.limitador.adquirir(tokens_estimados)
+                contar("gemini_espera_cuota_segundos_total", time.perf_counter() - inicio_espera)
+            contar("gemini_bytes_enviados_total", len(cuerpo_http))
+            try:
+                with span("gemini_http", ruta=ruta, intento=intento):
+                    if self.semaforo:
+                        with self.semaforo:
+                            response = self.session.post(url, data=cuerpo_http, params=params,
+                                                         timeout=self.timeout, stream=stream)
+                    else:
+                        response = self.session.post(url, data=cuerpo_http, params=params,
+                                                     timeout=self.timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                contar("gemini_peticiones_total", status="red")
+                ultimo_error = ErrorGemini(f"Error de red con Gemini: {e}")
+                espera = self._espera_backoff(intento)
+            else:
+                contar("gemini_peticiones_total", status=response.status_code)
+                if response.status_code == 200:
+                    if stream:
+                        return response
+                    cuerpo = response.json()
+                    if self.limitador:
+                        uso = cuerpo.get("usageMetadata", {})
+                        self.limitador.ajustar(tokens_estimados, uso.get("totalTokenCount", tokens_estimados))
+                    return cuerpo
+                ultimo_error = ErrorGemini(f"{response.status_code} - {response.text}", response.status_code)
+                if response.status_code not in STATUS_REINTENTABLES:
+                    raise ultimo_error
+                espera = _leer_retry_after(response)
+                if espera is None:
+                    espera = self._espera_backoff(intento)
+
+            if intento < self.max_reintentos:
+                contar("gemini_reintentos_total")
+                time.sleep(min(espera, self.backoff_max))
+        raise ultimo_error
+
+
+# =========================
+# 🧷 PREFIJO DE PROMPT COMPARTIDO
+# =========================
+# Mínimo de tokens que cachedContents acepta por modelo; un modelo desconocido usa el más alto
+MIN_TOKENS_CONTEXTO = {
+    "gemini-2.5-flash": 1024,
+    "gemini-2.5-flash-lite": 1024,
+    "gemini-2.5-pro": 4096,
+}
+MIN_TOKENS_CONTEXTO_POR_DEFECTO = 4096
+
+
+class ContextoCompartido:
+    """Prefijo de prompt común a muchas llamadas, registrado una sola vez con cachedContents.
+
+    Si Gemini no lo acepta (prefijo por debajo del mínimo de tokens, modelo sin soporte,
+    endpoint no disponible) las llamadas mandan el prefijo en línea, al inicio del prompt,
+    donde todavía puede aprovecharlo el caché implícito de Gemini. Dura una corrida:
+    al cerrarlo se borra del lado de Gemini.
+    """
+
+    def __init__(self, cliente: ClienteGemini, prefijo: str, modelo: str = None, ttl_segundos: int = 3600,
+                 registrar: bool = True):
+        # registrar=False: nunca se llama a cachedContents, el prefijo siempre va en línea
+        self.cliente = cliente
+        self.prefijo = prefijo
+        self.modelo = modelo or cliente.modelo
+        self.ttl_segundos = ttl_segundos
+        self.nombre = None
+        self.disponible = registrar
+        self.lock = threading.Lock()
+        minimo = MIN_TOKENS_CONTEXTO.get(self.modelo, MIN_TOKENS_CONTEXTO_POR_DEFECTO)
+        if registrar and estimar_tokens(prefijo) < minimo:
+            # Gemini lo rechazaría con un 400: ni se intenta, y los hilos no esperan ese POST
+            self.disponible = False
+            contar("gemini_contexto_total", resultado="bajo_minimo")
+
+    def nombre_para(self, modelo: str):
+        # El contenido en caché está atado a un modelo; otro modelo usa el prefijo en línea
+        if modelo != self.modelo:
+            return None
+        with self.lock:
+            # Se crea en la primera llamada; los demás hilos esperan aquí en vez de crear otro
+            if self.nombre is None and self.disponible:
+                try:
+                    self.nombre = self.cliente.crear_contexto(self.prefijo, self.modelo, self.ttl_segundos)
+                except ErrorGemini:
+                    self.disponible = False
+                    contar("gemini_contexto_total", resultado="en_linea")
+                else:
+                    contar("gemini_contexto_total", resultado="creado")
+            return self.nombre
+
+    def descartar(self, nombre: str):
+        with self.lock:
+            if self.nombre == nombre:
+                self.nombre = None
+                self.disponible = False
+
+    def cerrar(self):
+        with self.lock:
+            nombre, self.nombre = self.nombre, None
+            self.disponible = False
+        if nombre:
+            self.cliente.borrar_contexto(nombre)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.cerrar()
+
+
+def registrar_uso(uso: dict, modelo: str):
+    # usageMetadata trae el conteo real de tokens: es lo que se cobra por curso
+    for campo, tipo in (("promptTokenCount", "prompt"), ("candidatesTokenCount", "salida"),
+                        ("thoughtsTokenCount", "razonamiento"), ("cachedContentTokenCount", "cache")):
+        if uso.get(campo):
+            contar("gemini_tokens_total", uso[campo], tipo=tipo, modelo=modelo)
+
+
+def _tokens_enviados(data: dict) -> int:
+    # Solo cuenta el texto que viaja en la petición, no el prefijo que ya está en cachedContents
+    return estimar_tokens("".join(p.get("text", "") for c in data["contents"] for p in c["parts"]))
+
+
+# Tope de maxOutputTokens al ampliar el presupuesto (el máximo de salida de gemini-2.5-flash)
+MAX_TOKENS_SALIDA = 65536
+# Razonamiento permitido al reintentar una respuesta cortada: deja casi todo el presupuesto a la salida
+PRESUPUESTO_RAZONAMIENTO_REINTENTO = 1024
+
+
+def motivo_fin(respuesta: dict):
+    candidatos = respuesta.get("candidates") or []
+    return candidatos[0].get("finishReason") if candidatos else None
+
+
+def texto_de_respuesta(respuesta: dict) -> str:
+    # Como extraer_texto, pero una respuesta vacía devuelve "" (p. ej. todo se fue en razonamiento)
+    candidatos = respuesta.get("candidates") or []
+    if not candidatos:
+        raise ErrorGemini(f"Gemini no devolvió candidatos: {respuesta.get('promptFeedback', respuesta)}")
+    partes = candidatos[0].get("content", {}).get("parts", [])
+    return "".join(parte.get("text", "") for parte in partes).strip()
+
+
+def extraer_texto(respuesta: dict) -> str:
+    texto = texto_de_respuesta(respuesta)
+    if not texto:
+        raise ErrorGemini(f"Respuesta vacía de Gemini (finishReason={motivo_fin(respuesta)})")
+    return texto
+
+
+def ampliar_presupuesto(generation_config: dict) -> dict:
+    """Configuración para reintentar una respuesta cortada por MAX_TOKENS."""
+    actual = generation_config.get("maxOutputTokens", 8192)
+    config = {**generation_config, "maxOutputTokens": min(MAX_TOKENS_SALIDA, actual * 2)}
+    config.setdefault("thinkingConfig", {"thinkingBudget": PRESUPUESTO_RAZONAMIENTO_REINTENTO})
+    return config
+
+
+def _leer_retry_after(response):
+    valor = response.headers.get("Retry-After")
+    if not valor:
+        return None
+    try:
+        return max(0.0, float(valor))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(valor).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# === Un cliente (y un limitador) por API key para todo el proceso ===
+_clientes = {}
+_clientes_lock = threading.Lock()
+
+
+def obtener_cliente(api_key: str, peticiones_por_minuto: int = 900, tokens_por_minuto: int = 900_000,
+                    **config) -> ClienteGemini:
+    # La configuración solo aplica la primera vez que se pide el cliente de una API key
+    with _clientes_lock:
+        if api_key not in _clientes:
+            limitador = LimitadorTokens(peticiones_por_minuto, tokens_por_minuto)
+            _clientes[api_key] = ClienteGemini(api_key, limitador=limitador, **config)
+        return _clientes[api_key]
@@ -1,38 +1,69 @@
-import pandas as pd
-import re
-from utils import call_gemini, docs_service, drive_service, sheets_service
-
-
-def leer_outline_desde_sheets(sheet_url: str) -> list:
-    match = re.search(r"/d/([a-zA-Z0-9-_]+)", sheet_url)
-    spreadsheet_id = match.group(1) if match else None
-    if not spreadsheet_id:
-        raise ValueError("URL de Google Sheets no válida")
-
-    sheet_data = sheets_service.spreadsheets().values().get(
-        spreadsheetId=spreadsheet_id, range="A1:G100"
-    ).execute()
-    values = sheet_data.get("values", [])
-
-    headers = values[0]
-    rows = values[1:]
-    clases = []
-    for row in rows:
-        if len(row) < 7:
-            continue
-        clase = {
-            "numero": row[0],
-            "titulo": row[1],
-            "conceptos": row[2],
-            "objetivos": [row[3], row[4], row[5]],
-            "descripcion": row[6]
-        }
-        clases.append(clase)
-    return clases
-
-
-def generar_clase_con_prompt(clase_info: dict, perfil_estudiante: str, industria: str) -> str:
-    prompt = f"""
+from concurrent.futures import ThreadPoolExecutor
+from checkpoints import CheckpointClases
+from ejecutor_etapas import enviar_con_contexto
+from metricas import trazar
+from outline import clases_desde_filas, filas_desde_clases, outline_markdown
+from gemini import ContextoCompartido
+from utils import (
+    abrir_contexto_gemini, call_gemini, call_gemini_stream, ejecutar_google, conceder_permisos_dominio, LoteDocumento,
+    get_docs_service, get_drive_service, get_sheets_service, id_desde_link, obtener_servicios, sin_progreso,
+    texto_en_rango, texto_para_docs, unidades_utf16, MAX_UNIDADES_POR_DOCUMENTO
+)
+
+
+def _filas_de_hoja(spreadsheet_id: str, filas_por_pagina: int):
+    # Sin rango fijo: se lee el tamaño real de la primera hoja y se recorre por páginas de filas
+    sheets_service = get_sheets_service()
+    metadatos = ejecutar_google(sheets_service.spreadsheets().get(
+        spreadsheetId=spreadsheet_id, fields="sheets.properties(title,gridProperties.rowCount)"
+    ))
+    propiedades = metadatos["sheets"][0]["properties"]
+    titulo = propiedades["title"].replace("'", "''")
+    total_filas = propiedades.get("gridProperties", {}).get("rowCount", filas_por_pagina)
+
+    for inicio in range(1, total_filas + 1, filas_por_pagina):
+        fin = min(inicio + filas_por_pagina - 1, total_filas)
+        pagina = ejecutar_google(sheets_service.spreadsheets().values().get(
+            spreadsheetId=spreadsheet_id, range=f"'{titulo}'!{inicio}:{fin}"
+        )).get("values", [])
+        yield from pagina
+        # Una página incompleta significa que ya no hay más filas con datos
+        if len(pagina) < fin - inicio + 1:
+            return
+
+
+@trazar()
+def leer_outline_desde_sheets(sheet_url: str, filas_por_pagina: int = 500) -> list:
+    """Lee un outline externo o editado a mano; el que genera la app ya viene en memoria."""
+    filas = _filas_de_hoja(id_desde_link(sheet_url), filas_por_pagina)
+    filas = ([str(celda).strip() for celda in fila] for fila in filas)
+    return list(clases_desde_filas(filas))
+
+
+def _contexto_del_curso(clases_info: list = None, curso: dict = None) -> str:
+    # Lo estable del curso (datos generales y outline completo): también va en el prefijo, y con esto
+    # pasa el mínimo de tokens de cachedContents que las instrucciones solas no alcanzan
+    texto = ""
+    if curso:
+        texto += f"""
+        - Curso: {curso["nombre_del_curso"]}
+        - Nivel: {curso["nivel"]}
+        - Objetivos del curso: {curso["objetivos"]}
+        - Perfil de ingreso: {curso["perfil_ingreso"]}
+        - Perfil de egreso: {curso["perfil_egreso"]}
+        """
+    if clases_info:
+        texto += f"""
+        Outline completo del curso (úsalo para no repetir lo que cubren otras clases y mantener la progresión):
+
+{outline_markdown(filas_desde_clases(clases_info))}
+        """
+    return texto
+
+
+def _prefijo_clase(perfil_estudiante: str, industria: str, clases_info: list = None, curso: dict = None) -> str:
+    # Parte común a todas las clases de un curso: va primero para poder reutilizarse como caché de contexto
+    return f"""
         Actúa como un **diseñador instruccional experto y un tutor experimentado** con profunda experiencia en tecnología,
         negocios y analítica de datos. Tu tarea es generar **TODO el contenido detallado y final de una clase compuesta por 20 slides**,
         **aplicando los principios de la ciencia del aprendizaje (LearnLM)** para maximizar la comprensión, la retención
@@ -70,69 +101,336 @@ def generar_clase_con_prompt(clase_info: dict, perfil_estudiante: str, industria
         19. Actividad práctica   
         20. Cierre con resumen y llamada a la acción 
 
-        Contexto:
+        No uses frases como “puedes incluir” o “se recomienda mostrar”. Escribe el contenido real final como si fuera a presentarse en un aula o sesión empresarial. Evita repeticiones y asegura profundidad en cada slide.
+
+        Contexto del curso:
+
+        - Perfil del estudiante: {perfil_estudiante}
+        - Industria de enfoque: {industria}
+        """ + _contexto_del_curso(clases_info, curso)
+
+
+def _sufijo_clase(clase_info: dict) -> str:
+    return f"""
+        Contexto de la clase:
 
         - Título de la clase: {clase_info['titulo']}
         - Descripción: {clase_info['descripcion']}
         - Objetivos: {clase_info['objetivos']}
         - Conceptos clave: {clase_info['conceptos']}
-        - Perfil del estudiante: {perfil_estudiante}
-        - Industria de enfoque: {industria}
-
-        No uses frases como “puedes incluir” o “se recomienda mostrar”. Escribe el contenido real final como si fuera a presentarse en un aula o sesión empresarial. Evita repeticiones y asegura profundidad en cada slide.
         """
-    return call_gemini(prompt)
 
 
-def generar_documento_clases_completo(nombre_doc: str, clases_info: list, perfil_estudiante: str, industria: str) -> list:
+def contexto_clases(perfil_estudiante: str, industria: str, clases_info: list = None,
+                    curso: dict = None) -> ContextoCompartido:
+    """Prefijo compartido por las clases de una corrida; usar con `with`.
+
+    `clases_info` es el outline completo y `curso` los datos de `datos_del_curso`.
+    """
+    return abrir_contexto_gemini(_prefijo_clase(perfil_estudiante, industria, clases_info, curso))
+
+
+@trazar()
+def generar_clase_con_prompt(clase_info: dict, perfil_estudiante: str, industria: str, regenerar: bool = False,
+                             contexto: ContextoCompartido = None, clases_info: list = None,
+                             curso: dict = None) -> str:
+    # `contexto` debe venir de contexto_clases con el mismo perfil, industria, outline y curso
+    if contexto is None:
+        prefijo = _prefijo_clase(perfil_estudiante, industria, clases_info, curso)
+        return call_gemini(prefijo + _sufijo_clase(clase_info), regenerar=regenerar, tarea="clase")
+    return call_gemini(_sufijo_clase(clase_info), regenerar=regenerar, contexto=contexto, tarea="clase")
+
+
+def generar_clase_en_streaming(clase_info: dict, perfil_estudiante: str, industria: str, regenerar: bool = False,
+                               contexto: ContextoCompartido = None, clases_info: list = None, curso: dict = None):
+    # Mismo contenido que generar_clase_con_prompt, entregado en fragmentos conforme llega
+    if contexto is None:
+        prefijo = _prefijo_clase(perfil_estudiante, industria, clases_info, curso)
+        return call_gemini_stream(prefijo + _sufijo_clase(clase_info), regenerar=regenerar, tarea="clase")
+    return call_gemini_stream(_sufijo_clase(clase_info), regenerar=regenerar, contexto=contexto, tarea="clase")
+
+
+def generar_clase_segura(checkpoint: CheckpointClases, numero: int, clase_info: dict, perfil_estudiante: str,
+                         industria: str, regenerar: bool = False, contexto: ContextoCompartido = None):
+    # Devuelve (contenido, ok); las clases ya terminadas salen del checkpoint sin llamar a Gemini
+    entrada = CheckpointClases.clave(clase_info)
+    guardado = checkpoint.contenido(numero)
+    if guardado is not None and checkpoint.entrada(numero) == entrada:
+        return guardado, True
+    # Un fallo en una clase no debe tumbar el documento: se deja un placeholder de error
+    # (que no se guarda, para que un reintento vuelva a generarla)
+    try:
+        contenido = generar_clase_con_prompt(clase_info, perfil_estudiante, industria, regenerar, contexto)
+    except Exception as e:
+        return f"[ERROR al generar esta clase]: {e}", False
+    checkpoint.guardar_contenido(numero, contenido, entrada)
+    return contenido, True
+
+
+def _texto_clase(numero: int, clase_info: dict, contenido_clase: str) -> str:
+    # Ya sin lo que Docs descartaría: su tamaño es exactamente el rango que ocupará en el documento
+    return texto_para_docs(f"\n\nCLASE {numero}: {clase_info['titulo']}\n\n{contenido_clase}\n")
+
+
+def _crear_documento(nombre: str) -> str:
+    documento = ejecutar_google(get_drive_service().files().create(
+        body={"name": nombre, "mimeType": "application/vnd.google-apps.document"},
+        fields="id"
+    ))
+    return documento["id"]
+
+
+def _desplazar_rangos(rangos: dict, numero: str, delta: int):
+    # La clase `numero` cambió de tamaño en `delta` unidades: crece su rango y se recorren las siguientes
+    inicio = rangos[numero][0]
+    for otro, (desde, hasta) in rangos.items():
+        if otro == numero:
+            rangos[otro] = [desde, hasta + delta]
+        elif desde > inicio:
+            rangos[otro] = [desde + delta, hasta + delta]
+
+
+def _reescribir_en_rangos(lote: LoteDocumento, rangos: dict, textos: dict) -> dict:
+    """Agrega al lote el reemplazo de cada clase de `textos` en su rango; devuelve los rangos ya recorridos.
+
+    Del último rango al primero, para que los índices de los anteriores sigan valiendo dentro del lote.
+    """
+    rangos = {numero: list(rango) for numero, rango in rangos.items()}
+    for numero in sorted(textos, key=lambda n: -rangos[n][0]):
+        inicio, fin = rangos[numero]
+        lote.reemplazar_rango(inicio, fin, textos[numero])
+        _desplazar_rangos(rangos, numero, unidades_utf16(textos[numero]) - (fin - inicio))
+    return rangos
+
+
+def _verificar_rangos(document_id: str, nombre: str, rangos: dict, huellas: dict, numeros: list):
+    # Una edición a mano recorre los índices: reemplazar un rango guardado borraría texto de otra clase.
+    # Antes de tocar la parte se lee una vez y cada rango debe tener exactamente lo que se escribió.
+    documento = ejecutar_google(get_docs_service().documents().get(documentId=document_id, fields="body.content"))
+    for numero in numeros:
+        huella = huellas.get(str(numero))
+        actual = texto_en_rango(documento, *rangos[str(numero)])
+        if huella is None or actual is None or CheckpointClases.clave(actual) != huella:
+            raise ValueError(
+                f"La clase {numero} de '{nombre}' ya no coincide con lo que se escribió (¿se editó el documento?). "
+                "No se reescribe en su lugar para no borrar texto de otras clases: usa 'Regenerar' para crear "
+                "documentos nuevos."
+            )
+
+
+@trazar()
+def generar_documento_clases_completo(nombre_doc: str, clases_info: list, perfil_estudiante: str, industria: str,
+                                      max_workers: int = 4, regenerar: bool = False, progreso=sin_progreso,
+                                      checkpoint_id: str = None,
+                                      max_unidades_por_doc: int = MAX_UNIDADES_POR_DOCUMENTO,
+                                      rehacer: list = None, curso: dict = None) -> list:
+    # `rehacer`: números de clase que se regeneran aunque su fila del outline no haya cambiado;
+    # `curso` (de `datos_del_curso`) va con el outline en el prefijo común de las clases
+    obtener_servicios()  # se resuelven en este hilo antes de repartir el trabajo
     docs_links = []
-    # Dividir automáticamente las clases en partes de máximo 6 (para evitar límites de API)
-    max_por_doc = 6
-    partes = [clases_info[i:i + max_por_doc] for i in range(0, len(clases_info), max_por_doc)]
-
-
-    for parte_idx, parte in enumerate(partes, 1):
-        # Crear documento vacío
-        documento = drive_service.files().create(
-            body={"name": f"{nombre_doc} - Parte {parte_idx}", "mimeType": "application/vnd.google-apps.document"},
-            fields="id"
-        ).execute()
-        document_id = documento["id"]
-
-        # Insertar clase por clase en orden
-        cursor_index = 1  # se va actualizando manualmente
-        for i, clase in enumerate(parte, 1):
-            try:
-                contenido_clase = generar_clase_con_prompt(clase, perfil_estudiante, industria)
-            except Exception as e:
-                contenido_clase = f"[ERROR al generar esta clase]: {e}"
-
-            texto = f"\n\nCLASE {i + (parte_idx - 1) * 6}: {clase['titulo']}\n\n{contenido_clase.strip()}\n"
-
-            docs_service.documents().batchUpdate(
-                documentId=document_id,
-                body={
-                    "requests": [
-                        {
-                            "insertText": {
-                                "location": {"index": cursor_index},
-                                "text": texto
-                            }
-                        }
-                    ]
-                }
-            ).execute()
-
-            # Actualiza la posición para el siguiente insert
-            cursor_index += len(texto)
-
-        # Dar permisos de edición en dominio
-        drive_service.permissions().create(
-            fileId=document_id,
-            body={"type": "domain", "role": "writer", "domain": "datarebels.mx"},
-            fields="id"
-        ).execute()
-
-        docs_links.append(f"https://docs.google.com/document/d/{document_id}/edit")
-
-    return docs_links
+    document_ids = []
+    total_clases = len(clases_info)
+
+    # 📌 El checkpoint es del documento de clases (hoja, nombre, perfil e industria), no del contenido
+    # del outline: si cambia una fila, solo esa clase se regenera y se reescribe en su rango.
+    # "clases-incrementales" lo separa de los checkpoints anteriores, atados al outline completo.
+    clave = CheckpointClases.clave("clases-incrementales", checkpoint_id, nombre_doc, total_clases, perfil_estudiante,
+                                   industria)
+    # Un segundo trabajo sobre el mismo documento (doble clic, dos sesiones con el mismo outline) espera
+    # aquí y después solo reutiliza lo que el primero escribió, en lugar de crear sus propias "Parte N"
+    with CheckpointClases.exclusivo(clave):
+        checkpoint = CheckpointClases.abrir(clave, reiniciar=regenerar)
+        partes_escritas = [(indice, estado) for indice, estado in checkpoint.partes() if estado["escrito"]]
+        escritas = sorted(int(numero) for _, estado in partes_escritas for numero in estado["clases"])
+        # Las partes se escriben en orden, así que las escritas cubren un prefijo del outline
+        primera_libre = len(escritas) + 1
+
+        # Ya escritas, hace falta contenido nuevo para las que fallaron, cambiaron en el outline o se piden de nuevo
+        rehacer = set(rehacer or [])
+        for numero in escritas:
+            cambio = checkpoint.entrada(numero) != CheckpointClases.clave(clases_info[numero - 1])
+            if cambio or numero in rehacer:
+                checkpoint.descartar_contenido(numero)
+        pendientes = [numero for numero in escritas if checkpoint.contenido(numero) is None]
+        pendientes.extend(range(primera_libre, total_clases + 1))
+
+        # ⚡ Las clases pendientes se generan en paralelo (máximo `max_workers` llamadas a Gemini a la vez).
+        # Los servicios de Google se siguen usando solo desde este hilo. Las instrucciones comunes
+        # se registran una sola vez como caché de contexto y se borran al terminar la corrida.
+        with contexto_clases(perfil_estudiante, industria, clases_info, curso) as contexto, \
+                ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+            futuros = {
+                numero: enviar_con_contexto(executor, generar_clase_segura, checkpoint, numero,
+                                            clases_info[numero - 1], perfil_estudiante, industria,
+                                            # Rehacer una clase con el mismo prompt se salta la caché de respuestas
+                                            regenerar or numero in rehacer, contexto)
+                for numero in pendientes
+            }
+
+            progreso(f"Generando {len(futuros)} de {total_clases} clases", total_clases - len(futuros), total_clases)
+            listas = total_clases - len(futuros)
+
+            def esperar_clase(numero):
+                nonlocal listas
+                contenido_clase, ok = futuros[numero].result()
+                listas += 1
+                progreso(f"Clase {numero} de {total_clases}", listas, total_clases)
+                return contenido_clase.strip(), ok
+
+            def registrar_documento(document_id):
+                document_ids.append(document_id)
+                docs_links.append(f"https://docs.google.com/document/d/{document_id}/edit")
+                progreso(link=docs_links[-1])
+
+            for indice, estado in partes_escritas:
+                # Parte ya escrita: solo se reescriben, en su rango, las clases regeneradas
+                errores = {numero: error for numero, error in estado["errores"].items() if int(numero) not in futuros}
+                huellas = dict(estado.get("huellas", {}))
+                por_reescribir = [numero for numero in estado["clases"] if numero in futuros]
+                if por_reescribir:
+                    _verificar_rangos(estado["document_id"], f"{nombre_doc} - Parte {indice}", estado["rangos"],
+                                      huellas, por_reescribir)
+                textos = {}
+                for numero in por_reescribir:
+                    contenido_clase, ok = esperar_clase(numero)
+                    textos[str(numero)] = _texto_clase(numero, clases_info[numero - 1], contenido_clase)
+                    huellas[str(numero)] = CheckpointClases.clave(textos[str(numero)])
+                    if not ok:
+                        errores[str(numero)] = contenido_clase
+                lote = LoteDocumento(estado["document_id"])
+                rangos = _reescribir_en_rangos(lote, estado["rangos"], textos)
+                lote.enviar()
+                checkpoint.guardar_parte(indice, estado["document_id"], True, errores, estado["clases"], rangos,
+                                         huellas)
+                registrar_documento(estado["document_id"])
+
+            def escribir_parte(indice, grupo):
+                # `grupo` es [(numero, texto, error)]; toda la parte viaja en un solo insert al final del documento
+                estado = checkpoint.parte(indice)
+                numeros = [numero for numero, _, _ in grupo]
+                if estado:
+                    # El documento se creó pero no alcanzó a escribirse: se reutiliza
+                    document_id = estado["document_id"]
+                else:
+                    document_id = _crear_documento(f"{nombre_doc} - Parte {indice}")
+                    checkpoint.guardar_parte(indice, document_id, False, clases=numeros)
+
+                # Un documento nuevo empieza en el índice 1; los rangos se cuentan en unidades UTF-16
+                rangos = {}
+                cursor = 1
+                for numero, texto, _ in grupo:
+                    rangos[str(numero)] = [cursor, cursor + unidades_utf16(texto)]
+                    cursor = rangos[str(numero)][1]
+                LoteDocumento(document_id).insertar_al_final("".join(texto for _, texto, _ in grupo)).enviar()
+
+                errores = {str(numero): error for numero, _, error in grupo if error}
+                huellas = {str(numero): CheckpointClases.clave(texto) for numero, texto, _ in grupo}
+                checkpoint.guardar_parte(indice, document_id, True, errores, numeros, rangos, huellas)
+                registrar_documento(document_id)
+
+            # Las clases restantes se agrupan en orden según su tamaño real: una parte se cierra
+            # cuando la siguiente clase ya no cabe en el documento
+            indice = len(partes_escritas) + 1
+            reservadas = set((checkpoint.parte(indice) or {}).get("clases", []))
+            grupo = []
+            unidades = 0
+            for numero in range(primera_libre, total_clases + 1):
+                contenido_clase, ok = esperar_clase(numero)
+                texto = _texto_clase(numero, clases_info[numero - 1], contenido_clase)
+                tamano = unidades_utf16(texto)
+
+                # Una parte ya creada en un intento anterior conserva exactamente sus clases
+                if grupo and grupo[0][0] in reservadas:
+                    cortar = numero not in reservadas
+                else:
+                    cortar = unidades + tamano > max_unidades_por_doc
+                if grupo and cortar:
+                    escribir_parte(indice, grupo)
+                    indice += 1
+                    grupo, unidades = [], 0
+                grupo.append((numero, texto, None if ok else contenido_clase))
+                unidades += tamano
+            if grupo:
+                escribir_parte(indice, grupo)
+
+        # Dar permisos de edición en dominio a todas las partes en una sola llamada batch
+        if not checkpoint.permisos:
+            conceder_permisos_dominio(document_ids, "datarebels.mx")
+            checkpoint.marcar_permisos()
+
+        return docs_links
+
+
+@trazar()
+def generar_clases_desde_outline(sheet_url: str, nombre_doc: str, perfil_estudiante: str, industria: str,
+                                 max_workers: int = 4, regenerar: bool = False, progreso=sin_progreso,
+                                 clases_info: list = None, rehacer: list = None, curso: dict = None) -> list:
+    # Con `clases_info` (el outline recién generado) no se vuelve a leer la hoja
+    if clases_info is None:
+        progreso("Leyendo outline")
+        clases_info = leer_outline_desde_sheets(sheet_url)
+    return generar_documento_clases_completo(
+        nombre_doc, clases_info, perfil_estudiante, industria,
+        max_workers=max_workers, regenerar=regenerar, progreso=progreso,
+        checkpoint_id=id_desde_link(sheet_url), rehacer=rehacer, curso=curso
+    )
+
+
+class EscritorDocumentoStreaming:
+    """Escribe clases en Google Docs mientras se generan, con envíos periódicos al final del documento."""
+
+    def __init__(self, nombre_doc: str, max_unidades_por_doc: int = MAX_UNIDADES_POR_DOCUMENTO,
+                 caracteres_por_envio: int = 2000):
+        self.nombre_doc = nombre_doc
+        self.max_unidades_por_doc = max_unidades_por_doc
+        self.caracteres_por_envio = caracteres_por_envio
+        self.document_ids = []
+        self.unidades_en_doc = 0
+        self.clase_mas_grande = 0
+        self.lote = None
+        self.pendiente = 0
+
+    def _documento_actual(self):
+        # El tamaño de la clase que empieza aún no se conoce: se reserva lugar para la más grande vista
+        if self.lote is None or self.unidades_en_doc + self.clase_mas_grande > self.max_unidades_por_doc:
+            document_id = _crear_documento(f"{self.nombre_doc} - Parte {len(self.document_ids) + 1}")
+            self.document_ids.append(document_id)
+            self.lote = LoteDocumento(document_id)
+            self.unidades_en_doc = 0
+        return self.lote
+
+    def _agregar(self, texto: str, forzar: bool = False):
+        # Solo se guarda en memoria lo que falta por enviar, no la clase completa
+        texto = texto_para_docs(texto)
+        self.lote.insertar_al_final(texto)
+        self.pendiente += len(texto)
+        self.unidades_en_doc += unidades_utf16(texto)
+        if forzar or self.pendiente >= self.caracteres_por_envio:
+            self.lote.enviar()
+            self.pendiente = 0
+
+    def escribir_clase(self, numero: int, titulo: str, fragmentos):
+        # Generador que reenvía los fragmentos (para st.write_stream) mientras los escribe en el doc
+        self._documento_actual()
+        inicio_clase = self.unidades_en_doc
+        self._agregar(f"\n\nCLASE {numero}: {titulo}\n\n")
+        inicio = True
+        try:
+            for fragmento in fragmentos:
+                if inicio:
+                    fragmento = fragmento.lstrip()
+                    inicio = not fragmento
+                if fragmento:
+                    self._agregar(fragmento)
+                    yield fragmento
+        except Exception as e:
+            error = f"[ERROR al generar esta clase]: {e}"
+            self._agregar(error)
+            yield error
+        self._agregar("\n", forzar=True)
+        self.clase_mas_grande = max(self.clase_mas_grande, self.unidades_en_doc - inicio_clase)
+
+    def cerrar(self) -> list:
+        # Dar permisos de edición en dominio a todas las partes en una sola llamada batch
+        conceder_permisos_dominio(self.document_ids, "datarebels.mx")
+        return [f"https://docs.google.com/document/d/{document_id}/edit" for document_id in self.document_ids]
@@ -0,0 +1,179 @@
+"""Generación por lotes (sin Streamlit) de syllabus, outlines y documentos de clases.
+
+Uso:
+    python lote.py cursos.csv --credenciales token.json --salida resultados.jsonl
+    python lote.py cursos.csv --destino local --directorio exportaciones [--subir --credenciales token.json]
+
+El manifiesto (CSV con encabezados o JSONL) trae una fila por curso con las columnas
+nombre, nivel, publico, objetivos, num_clases y siguiente. `token.json` es un
+authorized-user JSON de Google (el mismo formato que guarda la app en la sesión).
+Con `--destino local` los cursos se escriben como .docx/.xlsx/.md en `--directorio`
+(sin credenciales hace falta SYLLABUS_PLANTILLA_DOCX con la plantilla del syllabus).
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+
+from ejecutor_etapas import enviar_con_contexto
+from metricas import corrida
+
+CAMPOS = ["nombre", "nivel", "publico", "objetivos", "num_clases", "siguiente"]
+
+
+def leer_manifiesto(ruta: str) -> list:
+    with open(ruta, encoding="utf-8") as f:
+        if ruta.endswith(".jsonl"):
+            cursos = [json.loads(linea) for linea in f if linea.strip()]
+        else:
+            cursos = list(csv.DictReader(f))
+
+    for numero, curso in enumerate(cursos, 1):
+        # DictReader llena con None las columnas que faltan al final de una fila corta
+        faltantes = [campo for campo in CAMPOS if not str(curso.get(campo) or "").strip()]
+        if faltantes:
+            raise ValueError(f"Curso {numero} del manifiesto sin: {', '.join(faltantes)}")
+        curso["num_clases"] = int(curso["num_clases"])
+    return cursos
+
+
+def cargar_credenciales(ruta: str):
+    from google.auth.transport.requests import Request
+    from google.oauth2.credentials import Credentials
+    from utils import SCOPES
+
+    creds = Credentials.from_authorized_user_file(ruta, SCOPES)
+    if not creds.valid and creds.refresh_token:
+        creds.refresh(Request())
+    return creds
+
+
+def _generar_en_google(curso: dict, args, resultado: dict):
+    from checkpoints import EstadoSyllabus
+    from utils import STUDENT_PERSONA, generar_syllabus_y_outline, id_desde_link
+    from generador_clases import generar_clases_desde_outline
+
+    t = time.perf_counter()
+    link_syllabus, link_outline, clases_info = generar_syllabus_y_outline(
+        curso["nombre"], curso["nivel"], curso["publico"], curso.get("student_persona") or STUDENT_PERSONA,
+        curso["siguiente"], curso["objetivos"], curso["num_clases"], regenerar=args.regenerar
+    )
+    resultado["tiempos"]["syllabus_y_outline_s"] = round(time.perf_counter() - t, 3)
+    resultado["link_syllabus"] = link_syllabus
+    resultado["link_outline"] = link_outline
+
+    if not args.sin_clases:
+        t = time.perf_counter()
+        resultado["links_clases"] = generar_clases_desde_outline(
+            link_outline, f"Clases - {curso['nombre']}",
+            curso.get("student_persona") or STUDENT_PERSONA,
+            curso.get("industria") or "analítica de datos",
+            max_workers=args.workers_clases, regenerar=args.regenerar, clases_info=clases_info,
+            curso=EstadoSyllabus.de_documento(id_desde_link(link_syllabus)).leer("curso")
+        )
+        resultado["tiempos"]["clases_s"] = round(time.perf_counter() - t, 3)
+
+
+def _exportar_local(curso: dict, args, resultado: dict):
+    from utils import STUDENT_PERSONA
+    from exportar import exportar_curso
+
+    t = time.perf_counter()
+    exportado = exportar_curso(
+        args.directorio, curso["nombre"], curso["nivel"], curso["publico"],
+        curso.get("student_persona") or STUDENT_PERSONA, curso["siguiente"], curso["objetivos"], curso["num_clases"],
+        industria=curso.get("industria") or "analítica de datos", max_workers=args.workers_clases,
+        regenerar=args.regenerar, con_clases=not args.sin_clases, subir=args.subir
+    )
+    resultado["tiempos"]["exportacion_s"] = round(time.perf_counter() - t, 3)
+    resultado["archivos"] = exportado["archivos"]
+    resultado["links"] = exportado["links"]
+
+
+def procesar_curso(curso: dict, creds, args) -> dict:
+    from utils import build_services, usar_servicios
+
+    resultado = {"nombre": curso["nombre"], "estado": "ok", "tiempos": {}}
+    inicio = time.perf_counter()
+    # Los cursos comparten el pool de clientes de la credencial; cada hilo usa su propio transporte
+    servicios = usar_servicios(build_services(creds)) if creds is not None else nullcontext()
+    with servicios, corrida(f"curso:{curso['nombre']}") as traza:
+        try:
+            if args.destino == "local":
+                _exportar_local(curso, args, resultado)
+            else:
+                _generar_en_google(curso, args, resultado)
+        except Exception as e:
+            resultado["estado"] = "error"
+            resultado["error"] = f"{type(e).__name__}: {e}"
+    resultado["tiempos"]["total_s"] = round(time.perf_counter() - inicio, 3)
+    # Tokens y llamadas por curso; los spans completos van a METRICAS_JSONL si se pidió
+    resumen = traza.resumen()
+    resultado["metricas"] = {"contadores": resumen["contadores"], "por_span": resumen["por_span"]}
+    return resultado
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Genera syllabus, outlines y clases para muchos cursos.")
+    parser.add_argument("manifiesto", help="CSV o JSONL con una fila por curso")
+    parser.add_argument("--credenciales", help="authorized-user JSON de Google (obligatorio salvo --destino local)")
+    parser.add_argument("--salida", default="resultados.jsonl", help="JSONL con links, tiempos y errores")
+    parser.add_argument("--cursos-paralelos", type=int, default=3)
+    parser.add_argument("--workers-clases", type=int, default=4, help="clases en paralelo dentro de cada curso")
+    parser.add_argument("--max-gemini", type=int, default=8, help="tope global de llamadas simultáneas a Gemini")
+    parser.add_argument("--sin-clases", action="store_true", help="solo syllabus y outline")
+    parser.add_argument("--regenerar", action="store_true", help="ignorar caché y checkpoints")
+    parser.add_argument("--destino", choices=["google", "local"], default="google",
+                        help="google: Docs/Sheets en Drive; local: archivos .docx/.xlsx/.md")
+    parser.add_argument("--directorio", default="exportaciones", help="carpeta de salida con --destino local")
+    parser.add_argument("--subir", action="store_true", help="con --destino local, subir los archivos a Drive al final")
+    parser.add_argument("--metricas", help="JSONL donde se agrega la traza completa de cada curso")
+    args = parser.parse_args(argv)
+    if not args.credenciales and (args.destino == "google" or args.subir):
+        parser.error("--credenciales es obligatorio con --destino google o --subir")
+    if not args.credenciales and not os.environ.get("SYLLABUS_PLANTILLA_DOCX"):
+        parser.error("sin --credenciales hace falta SYLLABUS_PLANTILLA_DOCX para llenar el syllabus")
+
+    if args.metricas:
+        os.environ["METRICAS_JSONL"] = args.metricas
+
+    # El tope global se aplica en el cliente de Gemini compartido por todos los cursos
+    os.environ["GEMINI_MAX_CONCURRENTES"] = str(args.max_gemini)
+
+    cursos = leer_manifiesto(args.manifiesto)
+    creds = cargar_credenciales(args.credenciales) if args.credenciales else None
+
+    inicio = time.perf_counter()
+    resultados = []
+    with open(args.salida, "w", encoding="utf-8") as salida, \
+            ThreadPoolExecutor(max_workers=max(1, args.cursos_paralelos)) as executor:
+        futuros = [enviar_con_contexto(executor, procesar_curso, curso, creds, args) for curso in cursos]
+        for futuro in as_completed(futuros):
+            resultado = futuro.result()
+            resultados.append(resultado)
+            # Cada curso se escribe en cuanto termina: un corte a la mitad no pierde lo ya hecho
+            salida.write(json.dumps(resultado, ensure_ascii=False) + "\n")
+            salida.flush()
+            print(f"[{len(resultados)}/{len(cursos)}] {resultado['estado']:5} {resultado['nombre']} "
+                  f"({resultado['tiempos']['total_s']} s)", file=sys.stderr)
+
+    total = time.perf_counter() - inicio
+    ok = sum(1 for r in resultados if r["estado"] == "ok")
+    reporte = {
+        "cursos": len(cursos),
+        "ok": ok,
+        "fallidos": len(cursos) - ok,
+        "tiempo_total_s": round(total, 3),
+        "cursos_por_hora": round(len(cursos) / total * 3600, 2) if total else None,
+        "salida": args.salida,
+    }
+    print(json.dumps(reporte, ensure_ascii=False, indent=2))
+    return 0 if ok == len(cursos) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
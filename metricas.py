@@ -0,0 +1,253 @@
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Cotas de los histogramas de duración (segundos), como en Prometheus
+BUCKETS_SEGUNDOS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _clave(nombre: str, etiquetas: dict) -> tuple:
+    return nombre, tuple(sorted((k, str(v)) for k, v in etiquetas.items()))
+
+
+def _formatear_etiquetas(etiquetas: tuple) -> str:
+    if not etiquetas:
+        return ""
+    pares = ",".join(f'{k}="{v}"' for k, v in etiquetas)
+    return "{" + pares + "}"
+
+
+# =========================
+# 📈 MÉTRICAS DEL PROCESO
+# =========================
+class RegistroMetricas:
+    """Contadores e histogramas acumulados por todo el proceso (todas las sesiones y trabajos)."""
+
+    def __init__(self):
+        self.contadores = defaultdict(float)
+        self.histogramas = {}
+        self.lock = threading.Lock()
+
+    def contar(self, nombre: str, valor: float = 1, **etiquetas):
+        with self.lock:
+            self.contadores[_clave(nombre, etiquetas)] += valor
+
+    def observar(self, nombre: str, segundos: float, **etiquetas):
+        with self.lock:
+            clave = _clave(nombre, etiquetas)
+            if clave not in self.histogramas:
+                self.histogramas[clave] = {"buckets": [0] * len(BUCKETS_SEGUNDOS), "suma": 0.0, "n": 0}
+            histograma = self.histogramas[clave]
+            for i, cota in enumerate(BUCKETS_SEGUNDOS):
+                if segundos <= cota:
+                    histograma["buckets"][i] += 1
+            histograma["suma"] += segundos
+            histograma["n"] += 1
+
+    def prometheus(self) -> str:
+        lineas = []
+        with self.lock:
+            for (nombre, etiquetas), valor in sorted(self.contadores.items()):
+                lineas.append(f"{nombre}{_formatear_etiquetas(etiquetas)} {valor:g}")
+            for (nombre, etiquetas), histograma in sorted(self.histogramas.items()):
+                for cota, n in zip(BUCKETS_SEGUNDOS, histograma["buckets"]):
+                    lineas.append(f"{nombre}_bucket{_formatear_etiquetas(etiquetas + (('le', f'{cota:g}'),))} {n}")
+                lineas.append(f"{nombre}_bucket{_formatear_etiquetas(etiquetas + (('le', '+Inf'),))} {histograma['n']}")
+                lineas.append(f"{nombre}_sum{_formatear_etiquetas(etiquetas)} {histograma['suma']:.6f}")
+                lineas.append(f"{nombre}_count{_formatear_etiquetas(etiquetas)} {histograma['n']}")
+        return "\n".join(lineas) + "\n"
+
+    def json(self) -> dict:
+        with self.lock:
+            return {
+                "contadores": {
+                    f"{nombre}{_formatear_etiquetas(etiquetas)}": valor
+                    for (nombre, etiquetas), valor in sorted(self.contadores.items())
+                },
+                "duraciones": {
+                    f"{nombre}{_formatear_etiquetas(etiquetas)}": {"n": h["n"], "suma_s": round(h["suma"], 6)}
+                    for (nombre, etiquetas), h in sorted(self.histogramas.items())
+                },
+            }
+
+
+registro = RegistroMetricas()
+
+
+# =========================
+# 🧭 TRAZA DE UNA CORRIDA
+# =========================
+class Corrida:
+    """Spans anidados y contadores de una sola generación (un trabajo, un curso del lote)."""
+
+    def __init__(self, nombre: str, max_spans: int = 5000):
+        self.id = uuid.uuid4().hex[:12]
+        self.nombre = nombre
+        self.inicio = time.time()
+        self.fin = None
+        self.max_spans = max_spans
+        self.spans = []
+        self.contadores = defaultdict(float)
+        self.lock = threading.Lock()
+
+    def agregar_span(self, span: dict):
+        with self.lock:
+            # Un lote enorme no debe crecer sin límite: se conservan los primeros spans
+            if len(self.spans) < self.max_spans:
+                self.spans.append(span)
+
+    def contar(self, nombre: str, valor: float = 1, **etiquetas):
+        with self.lock:
+            self.contadores[f"{nombre}{_formatear_etiquetas(_clave(nombre, etiquetas)[1])}"] += valor
+
+    def resumen(self) -> dict:
+        with self.lock:
+            spans = list(self.spans)
+            contadores = dict(self.contadores)
+        por_span = defaultdict(lambda: {"n": 0, "total_s": 0.0, "max_s": 0.0, "errores": 0})
+        for span in spans:
+            acumulado = por_span[span["nombre"]]
+            acumulado["n"] += 1
+            acumulado["total_s"] += span["duracion_s"]
+            acumulado["max_s"] = max(acumulado["max_s"], span["duracion_s"])
+            acumulado["errores"] += 1 if span["error"] else 0
+        fin = self.fin or time.time()
+        return {
+            "id": self.id,
+            "nombre": self.nombre,
+            "inicio": self.inicio,
+            "duracion_s": round(fin - self.inicio, 4),
+            "contadores": dict(sorted(contadores.items())),
+            "por_span": {
+                nombre: {**a, "total_s": round(a["total_s"], 4), "max_s": round(a["max_s"], 4)}
+                for nombre, a in sorted(por_span.items(), key=lambda item: -item[1]["total_s"])
+            },
+            "spans": spans,
+        }
+
+
+_corrida_actual = ContextVar("corrida_actual", default=None)
+_span_actual = ContextVar("span_actual", default=None)
+
+
+@contextmanager
+def corrida(nombre: str):
+    # Todo lo que se ejecute dentro (incluidos hilos lanzados con enviar_con_contexto) se anota aquí
+    actual = Corrida(nombre)
+    token = _corrida_actual.set(actual)
+    try:
+        yield actual
+    finally:
+        actual.fin = time.time()
+        _corrida_actual.reset(token)
+        _exportar_corrida(actual)
+
+
+def corrida_actual():
+    return _corrida_actual.get()
+
+
+def contar(nombre: str, valor: float = 1, **etiquetas):
+    registro.contar(nombre, valor, **etiquetas)
+    actual = _corrida_actual.get()
+    if actual is not None:
+        actual.contar(nombre, valor, **etiquetas)
+
+
+@contextmanager
+def span(nombre: str, **atributos):
+    actual = _corrida_actual.get()
+    padre = _span_actual.get()
+    span_id = uuid.uuid4().hex[:8]
+    token = _span_actual.set(span_id)
+    inicio = time.time()
+    t0 = time.perf_counter()
+    error = None
+    try:
+        yield atributos
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        duracion = time.perf_counter() - t0
+        _span_actual.reset(token)
+        registro.observar("syllabus_span_segundos", duracion, span=nombre)
+        if error:
+            registro.contar("syllabus_span_errores_total", span=nombre)
+        if actual is not None:
+            actual.agregar_span({
+                "id": span_id, "padre": padre, "nombre": nombre,
+                "inicio_s": round(inicio - actual.inicio, 4), "duracion_s": round(duracion, 4),
+                "error": error, "atributos": atributos,
+            })
+
+
+def trazar(nombre: str = None):
+    """Decorador: cada llamada a la función queda como un span con su nombre."""
+    def decorador(funcion):
+        nombre_span = nombre or funcion.__name__
+
+        @functools.wraps(funcion)
+        def trazada(*args, **kwargs):
+            with span(nombre_span):
+                return funcion(*args, **kwargs)
+        return trazada
+    return decorador
+
+
+# =========================
+# 📤 EXPORTACIÓN
+# =========================
+_exportacion_lock = threading.Lock()
+
+
+def _exportar_corrida(actual: Corrida):
+    # METRICAS_JSONL: cada corrida terminada se agrega como una línea JSON
+    ruta = os.environ.get("METRICAS_JSONL")
+    if not ruta:
+        return
+    linea = json.dumps(actual.resumen(), ensure_ascii=False, default=str)
+    with _exportacion_lock:
+        with open(ruta, "a", encoding="utf-8") as f:
+            f.write(linea + "\n")
+
+
+class _HandlerMetricas(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.startswith("/metrics.json"):
+            cuerpo, tipo = json.dumps(registro.json()).encode("utf-8"), "application/json"
+        elif self.path.startswith("/metrics"):
+            cuerpo, tipo = registro.prometheus().encode("utf-8"), "text/plain; version=0.0.4"
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", tipo)
+        self.send_header("Content-Length", str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+
+_servidor = None
+_servidor_lock = threading.Lock()
+
+
+def iniciar_servidor_metricas(puerto: int, host: str = "0.0.0.0"):
+    """Sirve /metrics (texto Prometheus) y /metrics.json; una sola vez por proceso."""
+    global _servidor
+    with _servidor_lock:
+        if _servidor is None:
+            _servidor = ThreadingHTTPServer((host, puerto), _HandlerMetricas)
+            _servidor.daemon_threads = True
+            threading.Thread(target=_servidor.serve_forever, daemon=True, name="metricas").start()
+        return _servidor
@@ -0,0 +1,85 @@
+import re
+from typing import TypedDict
+
+_ESPACIOS_DE_CONTROL = re.compile(r"[\r\n\t]")
+
+# Columnas del outline en la hoja y el campo JSON que llena cada una
+COLUMNAS = [
+    ("Clase", "clase"),
+    ("Título", "titulo"),
+    ("Conceptos Clave", "conceptos_clave"),
+    ("Objetivo 1", "objetivo_1"),
+    ("Objetivo 2", "objetivo_2"),
+    ("Objetivo 3", "objetivo_3"),
+    ("Descripción", "descripcion"),
+]
+
+# responseSchema de una fila del outline (salida estructurada de Gemini)
+ESQUEMA_CLASE = {
+    "type": "OBJECT",
+    "properties": {
+        "clase": {"type": "INTEGER"},
+        "titulo": {"type": "STRING"},
+        "conceptos_clave": {"type": "STRING"},
+        "objetivo_1": {"type": "STRING"},
+        "objetivo_2": {"type": "STRING"},
+        "objetivo_3": {"type": "STRING"},
+        "descripcion": {"type": "STRING"},
+    },
+    "required": [campo for _, campo in COLUMNAS],
+    "propertyOrdering": [campo for _, campo in COLUMNAS],
+}
+
+
+class ClaseOutline(TypedDict):
+    numero: str
+    titulo: str
+    conceptos: str
+    objetivos: list
+    descripcion: str
+
+
+# =========================
+# 🧾 FILAS DEL OUTLINE
+# =========================
+def filas_desde_json(clases: list) -> list:
+    """Filas para la hoja (encabezado incluido) a partir de las clases que devuelve Gemini en JSON."""
+    filas = [[encabezado for encabezado, _ in COLUMNAS]]
+    for clase in clases:
+        filas.append([_ESPACIOS_DE_CONTROL.sub(" ", str(clase.get(campo, ""))).strip() for _, campo in COLUMNAS])
+    return filas
+
+
+def filas_desde_clases(clases) -> list:
+    """Inversa de clases_desde_filas: filas (encabezado incluido) a partir de las clases."""
+    filas = [[encabezado for encabezado, _ in COLUMNAS]]
+    for clase in clases:
+        filas.append([str(clase["numero"]), clase["titulo"], clase["conceptos"], *clase["objetivos"],
+                      clase["descripcion"]])
+    return filas
+
+
+def clases_desde_filas(filas):
+    """Convierte filas (la primera es el encabezado) en clases; las filas incompletas se omiten."""
+    filas = iter(filas)
+    next(filas, None)
+    for fila in filas:
+        if len(fila) < 7:
+            continue
+        yield ClaseOutline(
+            numero=fila[0],
+            titulo=fila[1],
+            conceptos=fila[2],
+            objetivos=[fila[3], fila[4], fila[5]],
+            descripcion=fila[6],
+        )
+
+
+def outline_markdown(filas: list) -> str:
+    """Tabla Markdown del outline para incluirla en prompts; los pipes de las celdas se escapan."""
+    lineas = []
+    for indice, fila in enumerate(filas):
+        lineas.append("| " + " | ".join(celda.replace("|", "\\|") for celda in fila) + " |")
+        if indice == 0:
+            lineas.append("|" + "---|" * len(fila))
+    return "\n".join(lineas)
@@ -0,0 +1,73 @@
+"""Reescritura de clases en su rango sobre un documento en memoria (el mismo modelo del servidor falso)."""
+import types
+
+import pytest
+
+import generador_clases
+from benchmarks.servidores_falsos import DocumentoFalso
+from checkpoints import CheckpointClases
+from generador_clases import _desplazar_rangos, _reescribir_en_rangos, _verificar_rangos
+from utils import LoteDocumento, texto_en_rango, unidades_utf16
+
+
+def _escribir_parte(textos: dict):
+    # Como `escribir_parte`: todo en un insert al final, rangos contados desde el índice 1
+    documento = DocumentoFalso()
+    rangos, cursor = {}, 1
+    for numero, texto in textos.items():
+        rangos[numero] = [cursor, cursor + unidades_utf16(texto)]
+        cursor = rangos[numero][1]
+    documento.aplicar({"insertText": {"endOfSegmentLocation": {}, "text": "".join(textos.values())}})
+    return documento, rangos
+
+
+def _aplicar(documento: DocumentoFalso, lote: LoteDocumento):
+    for request in lote.requests:
+        documento.aplicar(request)
+
+
+def _docs_falso(monkeypatch, documento: DocumentoFalso):
+    documentos = types.SimpleNamespace(get=lambda **_: {"body": documento.cuerpo()})
+    servicio = types.SimpleNamespace(documents=lambda: documentos)
+    monkeypatch.setattr(generador_clases, "get_docs_service", lambda: servicio)
+    monkeypatch.setattr(generador_clases, "ejecutar_google", lambda llamada: llamada)
+
+
+def test_desplazar_rangos_mueve_solo_los_posteriores():
+    rangos = {"1": [1, 10], "2": [10, 25], "3": [25, 40]}
+    _desplazar_rangos(rangos, "2", 5)
+    assert rangos == {"1": [1, 10], "2": [10, 30], "3": [30, 45]}
+
+
+def test_reescribe_del_ultimo_rango_al_primero():
+    textos = {"1": "\n\nCLASE 1: Uno\n\nA 📈\n", "2": "\n\nCLASE 2: Dos\n\nB\n", "3": "\n\nCLASE 3: Tres\n\nC 🚀\n"}
+    documento, rangos = _escribir_parte(textos)
+
+    nuevos = {"1": "\n\nCLASE 1: Uno\n\nmucho más largo 🧠🧠\n", "3": "\n\nCLASE 3: Tres\n\n\n"}
+    lote = LoteDocumento("doc")
+    rangos_finales = _reescribir_en_rangos(lote, rangos, nuevos)
+    _aplicar(documento, lote)
+
+    final = {**textos, **nuevos}
+    assert documento.texto.decode("utf-16-le") == "".join(final.values()) + "\n"
+    cuerpo = {"body": documento.cuerpo()}
+    for numero, texto in final.items():
+        assert texto_en_rango(cuerpo, *rangos_finales[numero]) == texto
+    # Los rangos originales no se tocan: el checkpoint los reemplaza solo después de enviar el lote
+    assert rangos["3"][0] != rangos_finales["3"][0]
+
+
+def test_edicion_a_mano_aborta_antes_de_reescribir(monkeypatch):
+    textos = {"1": "\n\nCLASE 1: Uno\n\nA\n", "2": "\n\nCLASE 2: Dos\n\nB\n"}
+    documento, rangos = _escribir_parte(textos)
+    huellas = {numero: CheckpointClases.clave(texto) for numero, texto in textos.items()}
+    _docs_falso(monkeypatch, documento)
+
+    _verificar_rangos("doc", "Curso - Parte 1", rangos, huellas, [1, 2])
+
+    # Un párrafo agregado a mano en la clase 1 recorre el rango de la clase 2
+    documento.aplicar({"insertText": {"location": {"index": 3}, "text": "Nota del docente\n"}})
+    with pytest.raises(ValueError, match="clase 1"):
+        _verificar_rangos("doc", "Curso - Parte 1", rangos, huellas, [1])
+    with pytest.raises(ValueError, match="clase 2"):
+        _verificar_rangos("doc", "Curso - Parte 1", rangos, huellas, [2])
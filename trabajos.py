@@ -0,0 +1,109 @@
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass, field
+
+from ejecutor_etapas import enviar_con_contexto
+from metricas import corrida
+
+
+# =========================
+# 🧵 TRABAJOS EN SEGUNDO PLANO
+# =========================
+@dataclass
+class Trabajo:
+    id: str
+    tipo: str
+    estado: str = "pendiente"  # pendiente | en_curso | terminado | error
+    etapa: str = ""
+    actual: int = 0
+    total: int = 0
+    links: list = field(default_factory=list)
+    resultado: object = None
+    error: str = ""
+    metricas: dict = field(default_factory=dict)  # resumen de spans y contadores al terminar
+    creado: float = field(default_factory=time.time)
+    actualizado: float = field(default_factory=time.time)
+
+
+class GestorTrabajos:
+    """Corre las generaciones fuera del hilo del script de Streamlit.
+
+    El estado vive en el proceso, no en la sesión: un refresh del navegador, una
+    reconexión o cualquier otra sesión puede consultar el progreso con el id.
+    """
+
+    def __init__(self, max_workers: int = 4, max_historial: int = 200):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="trabajo")
+        self.max_historial = max_historial
+        self.trabajos = {}
+        self.lock = threading.Lock()
+
+    def enviar(self, tipo: str, funcion, *args, **kwargs) -> str:
+        # `funcion` recibe un callback `progreso` además de sus argumentos
+        trabajo = Trabajo(id=uuid.uuid4().hex[:12], tipo=tipo)
+        with self.lock:
+            self.trabajos[trabajo.id] = trabajo
+            self._purgar()
+        enviar_con_contexto(self.executor, self._correr, trabajo.id, funcion, args, kwargs)
+        return trabajo.id
+
+    def obtener(self, trabajo_id: str):
+        # Devuelve una copia para que la UI no lea un estado a medio actualizar
+        with self.lock:
+            trabajo = self.trabajos.get(trabajo_id)
+            return Trabajo(**asdict(trabajo)) if trabajo else None
+
+    def _actualizar(self, trabajo_id: str, **cambios):
+        with self.lock:
+            trabajo = self.trabajos[trabajo_id]
+            for campo, valor in cambios.items():
+                setattr(trabajo, campo, valor)
+            trabajo.actualizado = time.time()
+
+    def _correr(self, trabajo_id: str, funcion, args, kwargs):
+        def progreso(etapa: str = None, actual: int = None, total: int = None, link: str = None):
+            with self.lock:
+                trabajo = self.trabajos[trabajo_id]
+                if etapa is not None:
+                    trabajo.etapa = etapa
+                if actual is not None:
+                    trabajo.actual = actual
+                if total is not None:
+                    trabajo.total = total
+                if link is not None:
+                    trabajo.links.append(link)
+                trabajo.actualizado = time.time()
+
+        self._actualizar(trabajo_id, estado="en_curso")
+        with corrida(self.trabajos[trabajo_id].tipo) as traza:
+            try:
+                resultado = funcion(*args, progreso=progreso, **kwargs)
+            except Exception as e:
+                cambios = {"estado": "error", "error": str(e)}
+            else:
+                cambios = {"estado": "terminado", "resultado": resultado}
+        self._actualizar(trabajo_id, metricas=traza.resumen(), **cambios)
+
+    def _purgar(self):
+        # Solo se conservan los trabajos más recientes que ya terminaron
+        terminados = sorted(
+            (t for t in self.trabajos.values() if t.estado in ("terminado", "error")),
+            key=lambda t: t.actualizado,
+        )
+        for trabajo in terminados[:max(0, len(self.trabajos) - self.max_historial)]:
+            del self.trabajos[trabajo.id]
+
+
+# === Un gestor para todo el proceso, compartido por todas las sesiones ===
+_gestor = None
+_gestor_lock = threading.Lock()
+
+
+def obtener_gestor() -> GestorTrabajos:
+    global _gestor
+    with _gestor_lock:
+        if _gestor is None:
+            _gestor = GestorTrabajos()
+        return _gestor
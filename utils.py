@@ -1,12 +1,18 @@
 import streamlit as st
+import base64
 import json
-import pandas as pd
-import io
+import os
 import re
-import requests
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import Flow
-from google.oauth2.credentials import Credentials
+import secrets
+from contextlib import contextmanager
+from contextvars import ContextVar
+from ejecutor_etapas import ejecutar_etapas
+from gemini import GEMINI_BASE_URL, ContextoCompartido, ErrorGemini, PoliticaCobertura, obtener_cliente
+from cache_gemini import obtener_cache
+from checkpoints import EstadoSyllabus
+from clientes_google import obtener_clientes_google
+from metricas import contar, span, trazar
+from outline import ESQUEMA_CLASE, clases_desde_filas, filas_desde_json, outline_markdown
 
 # =========================
 # 🔐 CONFIGURACIÓN GOOGLE OAUTH
@@ -19,6 +25,8 @@ SCOPES = [
 
 # === Helper: flujo de autorización ===
 def _build_flow():
+    from google_auth_oauthlib.flow import Flow
+
     client_config = {
         "web": {
             "client_id": st.secrets["GOOGLE_OAUTH_CLIENT_ID"],
@@ -33,16 +41,45 @@ def _build_flow():
     return flow
 
 
+# Parámetros que agrega Google al volver del consentimiento; el resto de la URL viaja en `state`
+PARAMETROS_OAUTH = ("code", "state", "scope", "authuser", "hd", "prompt")
+
+
+def _state_oauth(params) -> str:
+    # El redirect vuelve a una URL fija: los parámetros de la app (p. ej. los trabajos en curso)
+    # se guardan en el state para restaurarlos después del callback
+    conservar = {clave: valor for clave, valor in params.items() if clave not in PARAMETROS_OAUTH}
+    carga = base64.urlsafe_b64encode(json.dumps(conservar).encode("utf-8")).decode("ascii").rstrip("=")
+    return f"{secrets.token_urlsafe(16)}.{carga}"
+
+
+def _params_desde_state(state: str) -> dict:
+    _, _, carga = (state or "").partition(".")
+    try:
+        params = json.loads(base64.urlsafe_b64decode(carga + "=" * (-len(carga) % 4)))
+    except ValueError:
+        return {}
+    return {str(clave): str(valor) for clave, valor in params.items()} if isinstance(params, dict) else {}
+
+
 def get_google_creds():
-    # 1️⃣ Ya autenticado
+    from google.auth.transport.requests import Request
+    from google.oauth2.credentials import Credentials
+
+    # 1️⃣ Ya autenticado (el objeto se reutiliza entre reruns de la misma sesión)
+    creds = st.session_state.get("_google_creds_obj")
+    if creds and creds.valid:
+        return creds
     if "google_creds" in st.session_state:
         creds_dict = st.session_state["google_creds"]
         creds = Credentials.from_authorized_user_info(creds_dict, SCOPES)
         if creds and creds.valid:
+            st.session_state["_google_creds_obj"] = creds
             return creds
         if creds and creds.expired and creds.refresh_token:
-            creds.refresh(requests.Request())
+            creds.refresh(Request())
             st.session_state["google_creds"] = json.loads(creds.to_json())
+            st.session_state["_google_creds_obj"] = creds
             return creds
 
     # 2️⃣ Si vengo del callback de Google (url con ?code=...)
@@ -56,7 +93,7 @@ def get_google_creds():
         flow.fetch_token(authorization_response=full_url)
         creds = flow.credentials
         st.session_state["google_creds"] = json.loads(creds.to_json())
-        st.query_params.clear()
+        st.query_params.from_dict(_params_desde_state(params.get("state")))
         return creds
 
     # 3️⃣ Mostrar botón de autorización si no hay sesión
@@ -66,7 +103,8 @@ def get_google_creds():
         auth_url, state = flow.authorization_url(
             access_type="offline",
             prompt="consent",
-            include_granted_scopes="true"
+            include_granted_scopes="true",
+            state=_state_oauth(st.query_params)
         )
         st.session_state["oauth_state"] = state
         st.markdown(f"[Haz clic aquí para autorizar tu cuenta de Google]({auth_url})")
@@ -75,43 +113,219 @@ def get_google_creds():
     st.stop()
 
 
-def build_services():
-    creds = get_google_creds()
-    docs_service = build("docs", "v1", credentials=creds)
-    drive_service = build("drive", "v3", credentials=creds)
-    sheets_service = build("sheets", "v4", credentials=creds)
-    return docs_service, drive_service, sheets_service
+def build_services(creds=None):
+    # Clientes por hilo de la credencial; se comparten entre sesiones y trabajos de la misma cuenta
+    return obtener_clientes_google(creds or get_google_creds(), endpoint=secreto("GOOGLE_API_ENDPOINT", ""))
+
+
+# === Servicios perezosos: el pool de la credencial se resuelve al primer uso y se guarda por sesión ===
+_servicios_actuales = ContextVar("servicios_google", default=None)
+
+
+@contextmanager
+def usar_servicios(servicios):
+    # Fija los servicios a usar fuera del hilo de Streamlit (hilos de trabajo, modo headless)
+    token = _servicios_actuales.set(servicios)
+    try:
+        yield servicios
+    finally:
+        _servicios_actuales.reset(token)
+
+
+def obtener_servicios():
+    servicios = _servicios_actuales.get()
+    if servicios is None:
+        if "google_services" not in st.session_state:
+            st.session_state["google_services"] = build_services()
+        servicios = st.session_state["google_services"]
+        # Los hilos que se lancen desde aquí heredan los servicios vía contextvars
+        _servicios_actuales.set(servicios)
+    return servicios
+
+
+# Cada hilo recibe sus propios clientes: una petición se construye y ejecuta en el mismo hilo
+def get_docs_service():
+    return obtener_servicios().docs()
+
+
+def get_drive_service():
+    return obtener_servicios().drive()
 
 
-# === Inicializamos los servicios globales ===
-docs_service, drive_service, sheets_service = build_services()
+def get_sheets_service():
+    return obtener_servicios().sheets()
+
+
+def ejecutar_google(peticion):
+    # methodId es p. ej. "docs.documents.batchUpdate"; los BatchHttpRequest no lo tienen
+    metodo = getattr(peticion, "methodId", None) or "batch"
+    cuerpo = getattr(peticion, "body", None)
+    if cuerpo:
+        contar("google_bytes_enviados_total", len(cuerpo), metodo=metodo)
+    contar("google_llamadas_total", metodo=metodo)
+    obtener_servicios().asegurar_token()
+    with span("google", metodo=metodo):
+        return peticion.execute()
 
 # =========================
 # 🤖 GEMINI API
 # =========================
-def call_gemini(prompt: str) -> str:
-    # url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.0-flash-lite:generateContent"
-    url = "https://generativelanguage.googleapis.com/v1beta/models/gemini-2.5-flash:generateContent"
-    headers = {"Content-Type": "application/json"}
-    params = {"key": st.secrets["GEMINI_API_KEY"]}
-    data = {
-        "contents": [{"parts": [{"text": prompt}]}],
-        "generationConfig": {"maxOutputTokens": 8192},
-    }
+def secreto(nombre, default=None):
+    # Las variables de entorno tienen prioridad: así el modo por lotes puede sobrescribir la configuración
+    if nombre in os.environ:
+        return os.environ[nombre]
+    try:
+        return st.secrets[nombre]
+    except (KeyError, FileNotFoundError):
+        if default is None:
+            raise
+        return default
+
+
+# Modelo y tope de salida por tarea; GEMINI_RUTAS (JSON) sobrescribe tareas sueltas,
+# p. ej. {"clase": {"modelo": "gemini-2.5-pro"}}
+RUTAS_GEMINI = {
+    "general": {"modelo": "gemini-2.5-flash", "max_tokens": 8192},
+    "datos_generales": {"modelo": "gemini-2.5-flash", "max_tokens": 8192},
+    # Secciones cortas del syllabus: el modelo ligero basta y responde antes
+    "secciones_syllabus": {"modelo": "gemini-2.5-flash-lite", "max_tokens": 4096},
+    "clase": {"modelo": "gemini-2.5-flash", "max_tokens": 8192},
+}
+
+
+def ruta_gemini(tarea: str) -> dict:
+    rutas = secreto("GEMINI_RUTAS", "{}")
+    if isinstance(rutas, str):
+        rutas = json.loads(rutas)
+    return {**RUTAS_GEMINI["general"], **RUTAS_GEMINI.get(tarea, {}), **dict(rutas.get(tarea, {}))}
+
+
+def obtener_cliente_gemini():
+    # Cliente y limitador compartidos por todas las sesiones de Streamlit del proceso
+    max_concurrentes = int(secreto("GEMINI_MAX_CONCURRENTES", 0))
+    cobertura = None
+    if secreto("GEMINI_COBERTURA", "0") == "1":
+        # Duplica las llamadas más lentas que el percentil, sin pasar del presupuesto de llamadas extra
+        cobertura = PoliticaCobertura(
+            percentil=float(secreto("GEMINI_COBERTURA_PERCENTIL", 0.9)),
+            presupuesto_extra=float(secreto("GEMINI_COBERTURA_PRESUPUESTO", 0.1)),
+        )
+    return obtener_cliente(
+        secreto("GEMINI_API_KEY"),
+        base_url=secreto("GEMINI_BASE_URL", GEMINI_BASE_URL),
+        peticiones_por_minuto=int(secreto("GEMINI_RPM", 900)),
+        tokens_por_minuto=int(secreto("GEMINI_TPM", 900_000)),
+        max_concurrentes=max_concurrentes or None,
+        cache=obtener_cache(
+            secreto("GEMINI_CACHE_PATH", ".cache/gemini.sqlite"),
+            ttl_segundos=int(secreto("GEMINI_CACHE_TTL", 30 * 24 * 3600)),
+            max_bytes=int(secreto("GEMINI_CACHE_MAX_MB", 200)) * 1024 * 1024,
+        ),
+        cobertura=cobertura,
+    )
+
+
+def abrir_contexto_gemini(prefijo: str, tarea: str = "clase") -> ContextoCompartido:
+    # Prefijo común de una corrida (p. ej. las instrucciones de todas las clases de un curso);
+    # se usa con `with` para que el contenido en caché se borre al terminar.
+    # El contenido en caché es por modelo: `tarea` debe ser la misma que la de las llamadas
+    return ContextoCompartido(
+        obtener_cliente_gemini(), prefijo, modelo=ruta_gemini(tarea)["modelo"],
+        ttl_segundos=int(secreto("GEMINI_CONTEXTO_TTL", 3600)),
+        registrar=secreto("GEMINI_CONTEXTO_CACHE", "1") != "0",
+    )
+
+
+@trazar()
+def call_gemini(prompt: str, regenerar: bool = False, contexto: ContextoCompartido = None,
+                tarea: str = "general") -> str:
+    # modelo anterior: gemini-2.0-flash-lite
+    # Con `contexto`, `prompt` es solo la parte propia de esta llamada
+    ruta = ruta_gemini(tarea)
+    try:
+        return obtener_cliente_gemini().generar(
+            prompt, {"maxOutputTokens": ruta["max_tokens"]}, modelo=ruta["modelo"], usar_cache=not regenerar,
+            contexto=contexto, tarea=tarea
+        )
+    except ErrorGemini as e:
+        st.error(f"Error en API Gemini: {e}")
+        raise Exception(f"Fallo la llamada a Gemini con API Key: {e}") from e
 
-    response = requests.post(url, headers=headers, params=params, json=data)
-    if response.status_code == 200:
-        return response.json()["candidates"][0]["content"]["parts"][0]["text"].strip()
-    else:
-        st.error(f"Error en API Gemini: {response.status_code} - {response.text}")
-        raise Exception("Fallo la llamada a Gemini con API Key.")
+
+def call_gemini_json(prompt: str, esquema: dict, regenerar: bool = False, tarea: str = "general") -> dict:
+    ruta = ruta_gemini(tarea)
+    try:
+        return obtener_cliente_gemini().generar_json(
+            prompt, esquema, {"maxOutputTokens": ruta["max_tokens"]}, modelo=ruta["modelo"],
+            usar_cache=not regenerar, tarea=tarea
+        )
+    except ErrorGemini as e:
+        st.error(f"Error en API Gemini: {e}")
+        raise Exception(f"Fallo la llamada a Gemini con API Key: {e}") from e
+
+
+def call_gemini_stream(prompt: str, regenerar: bool = False, contexto: ContextoCompartido = None,
+                       tarea: str = "general"):
+    # Generador de fragmentos de texto; pensado para st.write_stream (sin cobertura: ya muestra avance)
+    ruta = ruta_gemini(tarea)
+    try:
+        yield from obtener_cliente_gemini().generar_stream(
+            prompt, {"maxOutputTokens": ruta["max_tokens"]}, modelo=ruta["modelo"], usar_cache=not regenerar,
+            contexto=contexto
+        )
+    except ErrorGemini as e:
+        st.error(f"Error en API Gemini: {e}")
+        raise Exception(f"Fallo la llamada a Gemini con API Key: {e}") from e
 
 
 # =========================
 # 🧠 PROMPTING Y LÓGICA DE GENERACIÓN
 # =========================
+# Perfil fijo del estudiante tipo
+STUDENT_PERSONA = (
+    "Usuario de negocios quiere construir productos de datos pero:\n"
+    "- No tiene el hábito o modelo de trabajo mental de tomar decisiones basadas en datos.\n"
+    "- No tiene conocimiento suficiente para traducir sus problemas a productos de datos.\n"
+    "- No tiene habilidades técnicas para manipular data.\n"
+    "- No colabora activamente con equipos de data.\n"
+    "- Tiene poco tiempo y necesita soluciones prácticas que le ayuden a avanzar ya."
+)
+
+def _esquema_textos(*campos):
+    return {
+        "type": "OBJECT",
+        "properties": {campo: {"type": "STRING"} for campo in campos},
+        "required": list(campos),
+        "propertyOrdering": list(campos),
+    }
+
+
+# responseSchema de los datos generales del curso (outline incluido)
+ESQUEMA_DATOS_GENERALES = _esquema_textos(
+    "perfil_ingreso", "objetivos", "perfil_egreso",
+    "titulo_primer_objetivo_secundario", "descripcion_primer_objetivo_secundario",
+    "titulo_segundo_objetivo_secundario", "descripcion_segundo_objetivo_secundario",
+    "titulo_tercer_objetivo_secundario", "descripcion_tercer_objetivo_secundario",
+)
+ESQUEMA_DATOS_GENERALES["properties"]["outline"] = {"type": "ARRAY", "items": ESQUEMA_CLASE}
+ESQUEMA_DATOS_GENERALES["required"].append("outline")
+ESQUEMA_DATOS_GENERALES["propertyOrdering"].insert(3, "outline")
+
+# Secciones del syllabus que se piden a Gemini: campo -> instrucción. Cada una llena el placeholder {{campo}}
+SECCIONES_SYLLABUS = {
+    "generalidades_del_programa": "Redacta un párrafo breve que combine descripción general del curso, su objetivo y el perfil de egreso.",
+    "perfil_ingreso": "Redacta un párrafo claro y directo del perfil de ingreso del estudiante.",
+    "detalles_plan_estudios": "Escribe la lista de la clases seleccionadas, cada una con título y una breve descripción, NO usar negritas en markdown.",
+}
+
+# responseSchema de las tres secciones que el syllabus pide a Gemini
+ESQUEMA_SECCIONES_SYLLABUS = _esquema_textos(*SECCIONES_SYLLABUS)
+
+
 @st.cache_data(show_spinner=False)
-def generar_datos_generales(nombre_del_curso, nivel, publico, student_persona, siguiente, objetivos_raw, num_clases):
+@trazar()
+def generar_datos_generales(nombre_del_curso, nivel, publico, student_persona, siguiente, objetivos_raw, num_clases,
+                            regenerar=False):
     prompt = f"""
     Eres un experto en diseño instruccional y un tutor experimentado, aplicando los principios de la ciencia del aprendizaje
     para crear experiencias educativas efectivas y atractivas. Tu objetivo es generar un syllabus y outline
@@ -126,76 +340,164 @@ def generar_datos_generales(nombre_del_curso, nivel, publico, student_persona, s
     - Objetivos iniciales: {objetivos_raw}
     - Curso sugerido posterior: {siguiente} (no lo menciones directamente)
 
-    Devuélveme lo siguiente, separado por etiquetas:
-
-    [PERFIL_INGRESO]
-    ...
-    [OBJETIVOS]
-    ...
-    [PERFIL_EGRESO]
-    ...
-    [OUTLINE]
-    ...
-
-    [TITULO_PRIMER_OBJETIVO_SECUNDARIO]
-    ...
-    [DESCRIPCION_PRIMER_OBJETIVO_SECUNDARIO]
-    ...
-    [TITULO_SEGUNDO_OBJETIVO_SECUNDARIO]
-    ...
-    [DESCRIPCION_SEGUNDO_OBJETIVO_SECUNDARIO]
-    ...
-    [TITULO_TERCER_OBJETIVO_SECUNDARIO]
-    ...
-    [DESCRIPCION_TERCER_OBJETIVO_SECUNDARIO]
-    ...
-
-    El outline debe incluir exactamente {num_clases} clases.  
-    Debe estar en formato de tabla Markdown con estas columnas:
+    Devuélveme un objeto JSON con estos campos:
 
+    - perfil_ingreso: párrafo con el perfil de ingreso del estudiante.
+    - objetivos: objetivos mejorados del curso.
+    - perfil_egreso: párrafo con el perfil de egreso.
+    - outline: lista de clases.
+    - titulo_primer_objetivo_secundario y descripcion_primer_objetivo_secundario
+    - titulo_segundo_objetivo_secundario y descripcion_segundo_objetivo_secundario
+    - titulo_tercer_objetivo_secundario y descripcion_tercer_objetivo_secundario
 
-    | Clase | Título | Conceptos Clave | Objetivo 1 | Objetivo 2 | Objetivo 3 | Descripción |
+    El outline debe incluir exactamente {num_clases} clases.  
+    Cada clase del outline lleva: clase (número), titulo, conceptos_clave, objetivo_1, objetivo_2, objetivo_3 y descripcion.
     
-    Cada clase debe tener **todas las columnas llenas**, sin dejar ningún campo vacío.  
+    Cada clase debe tener **todos los campos llenos**, sin dejar ningún campo vacío.  
     Cada “Objetivo” debe ser una oración breve (máx. 12 palabras) que comience con un verbo de acción (por ejemplo: “Analizar”, “Aplicar”, “Diseñar”, “Desarrollar”, “Evaluar”, etc.).  
     Si un objetivo no aplica, reformúlalo para mantener tres objetivos por clase.  
-    No uses “X”, ni dejes celdas vacías.  
-    Ejemplo de formato esperado:
+    No uses “X”, ni dejes campos vacíos.  
+    Ejemplo de una clase:
 
-    | Clase | Título | Conceptos Clave | Objetivo 1 | Objetivo 2 | Objetivo 3 | Descripción |
-    |-------|---------|----------------|-------------|-------------|-------------|--------------|
-    | 1 | Introducción a Gen AI para Creativos  | Modelos de Lenguaje, Difusión, ética | Identificar las aplicaciones de Gen AI en procesos creativos.  | Distinguir entre diferentes tipos de modelos de Gen AI.  | Analizar impactos éticos de la IA |Exploración del potencial de Gen AI en el sector retail y la importancia de su aplicación responsable.  |
+    {{"clase": 1, "titulo": "Introducción a Gen AI para Creativos", "conceptos_clave": "Modelos de Lenguaje, Difusión, ética", "objetivo_1": "Identificar las aplicaciones de Gen AI en procesos creativos.", "objetivo_2": "Distinguir entre diferentes tipos de modelos de Gen AI.", "objetivo_3": "Analizar impactos éticos de la IA", "descripcion": "Exploración del potencial de Gen AI en el sector retail y la importancia de su aplicación responsable."}}
     """
-    respuesta = call_gemini(prompt)
-
-    def extraer(etiqueta):
-        patron = rf"\[{etiqueta}\]\n(.*?)(?=\[|\Z)"
-        r = re.search(patron, respuesta, re.DOTALL)
-        return r.group(1).strip() if r else ""
-
-    perfil_ingreso = extraer("PERFIL_INGRESO")
-    objetivos = extraer("OBJETIVOS")
-    perfil_egreso = extraer("PERFIL_EGRESO")
-    outline = extraer("OUTLINE")
-    titulo1 = extraer("TITULO_PRIMER_OBJETIVO_SECUNDARIO")
-    desc1 = extraer("DESCRIPCION_PRIMER_OBJETIVO_SECUNDARIO")
-    titulo2 = extraer("TITULO_SEGUNDO_OBJETIVO_SECUNDARIO")
-    desc2 = extraer("DESCRIPCION_SEGUNDO_OBJETIVO_SECUNDARIO")
-    titulo3 = extraer("TITULO_TERCER_OBJETIVO_SECUNDARIO")
-    desc3 = extraer("DESCRIPCION_TERCER_OBJETIVO_SECUNDARIO")
+    # Salida estructurada: una sola decodificación en lugar de una regex por etiqueta
+    datos = call_gemini_json(prompt, ESQUEMA_DATOS_GENERALES, regenerar=regenerar, tarea="datos_generales")
+
+    perfil_ingreso = datos["perfil_ingreso"].strip()
+    objetivos = datos["objetivos"].strip()
+    perfil_egreso = datos["perfil_egreso"].strip()
+    outline = filas_desde_json(datos["outline"])
+    titulo1 = datos["titulo_primer_objetivo_secundario"].strip()
+    desc1 = datos["descripcion_primer_objetivo_secundario"].strip()
+    titulo2 = datos["titulo_segundo_objetivo_secundario"].strip()
+    desc2 = datos["descripcion_segundo_objetivo_secundario"].strip()
+    titulo3 = datos["titulo_tercer_objetivo_secundario"].strip()
+    desc3 = datos["descripcion_tercer_objetivo_secundario"].strip()
 
     return perfil_ingreso, objetivos, perfil_egreso, outline, titulo1, desc1, titulo2, desc2, titulo3, desc3
 
 
+# =========================
+# ✍️ ESCRITURA AGRUPADA EN GOOGLE
+# =========================
+# Límites conservadores de Google Docs (el tope real de un documento ronda 1.02 M de caracteres)
+MAX_UNIDADES_POR_DOCUMENTO = 500_000
+
+
+# insertText descarta estos caracteres (control salvo \t, \n y \v; uso privado del plano básico)
+_DESCARTADOS_POR_DOCS = re.compile("[\x00-\x08\x0c-\x1f\ue000-\uf8ff]")
+
+
+def texto_para_docs(texto: str) -> str:
+    # Se quitan antes de medir: si no, los rangos guardados quedan más largos que lo que Docs escribió
+    return _DESCARTADOS_POR_DOCS.sub("", texto)
+
+
+def unidades_utf16(texto: str) -> int:
+    # Los índices de la API de Docs cuentan unidades UTF-16: un emoji o carácter astral ocupa 2
+    return len(texto.encode("utf-16-le")) // 2
+
+
+class LoteDocumento:
+    """Acumula las mutaciones de un documento y las envía en un solo batchUpdate."""
+
+    def __init__(self, document_id):
+        self.document_id = document_id
+        self.requests = []
+
+    def agregar(self, request):
+        self.requests.append(request)
+        return self
+
+    def reemplazar(self, placeholder, new_text):
+        return self.agregar({
+            "replaceAllText": {
+                "containsText": {"text": placeholder, "matchCase": True},
+                "replaceText": new_text
+            }
+        })
+
+    def insertar(self, index, texto):
+        return self.agregar({"insertText": {"location": {"index": index}, "text": texto_para_docs(texto)}})
+
+    def insertar_al_final(self, texto):
+        return self.agregar({"insertText": {"endOfSegmentLocation": {}, "text": texto_para_docs(texto)}})
+
+    def reemplazar_rango(self, inicio, fin, texto):
+        # [inicio, fin) en unidades UTF-16; con varios rangos en un lote, agregarlos del último al primero
+        self.agregar({"deleteContentRange": {"range": {"startIndex": inicio, "endIndex": fin}}})
+        return self.insertar(inicio, texto)
+
+    def enviar(self):
+        # Los requests se aplican en orden dentro de un mismo batchUpdate
+        if not self.requests:
+            return None
+        respuesta = ejecutar_google(get_docs_service().documents().batchUpdate(
+            documentId=self.document_id, body={"requests": self.requests}
+        ))
+        self.requests = []
+        return respuesta
+
+
+@trazar()
+def conceder_permisos_dominio(file_ids, dominio, allow_file_discovery=None):
+    # Todas las altas de permisos viajan en una sola llamada al endpoint batch de Drive
+    permiso = {"type": "domain", "role": "writer", "domain": dominio}
+    if allow_file_discovery is not None:
+        permiso["allowFileDiscovery"] = allow_file_discovery
+
+    drive_service = get_drive_service()
+    errores = []
+
+    def callback(request_id, response, exception):
+        if exception is not None:
+            errores.append(exception)
+
+    # El endpoint batch de Google acepta hasta 100 llamadas por petición
+    # El URI de batch sale del discovery y no respeta api_endpoint: se ajusta a mano si hay uno
+    endpoint = secreto("GOOGLE_API_ENDPOINT", "")
+    for inicio in range(0, len(file_ids), 100):
+        if endpoint:
+            from googleapiclient.http import BatchHttpRequest
+            batch = BatchHttpRequest(callback=callback, batch_uri=f"{endpoint.rstrip('/')}/batch/drive/v3")
+        else:
+            batch = drive_service.new_batch_http_request(callback=callback)
+        for file_id in file_ids[inicio:inicio + 100]:
+            batch.add(drive_service.permissions().create(fileId=file_id, body=permiso, fields="id"))
+        ejecutar_google(batch)
+
+    if errores:
+        raise errores[0]
+
+
+@trazar()
+def crear_hoja_con_valores(titulo, values):
+    # La hoja se crea ya con sus celdas: no hace falta un values().update posterior
+    row_data = [
+        {"values": [{"userEnteredValue": {"stringValue": str(valor)}} for valor in fila]}
+        for fila in values
+    ]
+    sheet = ejecutar_google(get_sheets_service().spreadsheets().create(
+        body={
+            "properties": {"title": titulo},
+            "sheets": [{"data": [{"startRow": 0, "startColumn": 0, "rowData": row_data}]}],
+        },
+        fields="spreadsheetId"
+    ))
+    return sheet["spreadsheetId"]
+
+
 # === REEMPLAZO DE PLACEHOLDERS EN LA PLANTILLA ===
 def replace_placeholder(document_id, placeholder, new_text):
-    requests = [{
-        "replaceAllText": {
-            "containsText": {"text": placeholder, "matchCase": True},
-            "replaceText": new_text
-        }
-    }]
-    docs_service.documents().batchUpdate(documentId=document_id, body={"requests": requests}).execute()
+    LoteDocumento(document_id).reemplazar(placeholder, new_text).enviar()
+
+
+def reemplazar_placeholders(document_id, reemplazos: dict):
+    lote = LoteDocumento(document_id)
+    for placeholder, new_text in reemplazos.items():
+        lote.reemplazar(placeholder, new_text)
+    lote.enviar()
 
 
 # =========================
@@ -203,101 +505,317 @@ def replace_placeholder(document_id, placeholder, new_text):
 # =========================
 #TEMPLATE_ID = "1h_9m4EENmpsDXy85drjN0LI4LnbzDSKfbIP0Nilsly8"
 TEMPLATE_ID = "1flkuQhtLTlJQevfjAthL6WV_tp2uMSr1z-E_kc-NHCI"
+ANIO = 2025
+
+
+def valores_syllabus(nombre_del_curso, anio, secciones, titulo1, desc1, titulo2, desc2, titulo3, desc3) -> dict:
+    # placeholder de la plantilla -> texto; lo usan el syllabus en Google Docs y el .docx local
+    return {
+        "{{nombre_del_curso}}": nombre_del_curso,
+        "{{anio}}": str(anio),
+        "{{generalidades_del_programa}}": secciones["generalidades_del_programa"],
+        "{{perfil_ingreso}}": secciones["perfil_ingreso"],
+        "{{detalles_plan_estudios}}": secciones["detalles_plan_estudios"],
+        "{{titulo_primer_objetivo_secundario}}": titulo1,
+        "{{descripcion_primer_objetivo_secundario}}": desc1,
+        "{{titulo_segundo_objetivo_secundario}}": titulo2,
+        "{{descripcion_segundo_objetivo_secundario}}": desc2,
+        "{{titulo_tercer_objetivo_secundario}}": titulo3,
+        "{{descripcion_tercer_objetivo_secundario}}": desc3,
+    }
 
-def generar_syllabus_completo(nombre_del_curso, nivel, objetivos_mejorados, publico, siguiente,
-                               perfil_ingreso, perfil_egreso, outline,
-                               titulo1, desc1, titulo2, desc2, titulo3, desc3):
-    anio = 2025
-
-    def pedir_seccion(etiqueta, instruccion):
-        prompt = f"""
+def pedir_secciones_syllabus(curso: dict, outline: list, campos: list, regenerar: bool = False) -> dict:
+    instrucciones = "\n".join(f"        - {campo}: {SECCIONES_SYLLABUS[campo]}" for campo in campos)
+    prompt = f"""
         Como experto en diseño instruccional y aplicando los principios de LearnLM, genera el siguiente contenido:
-        Curso: {nombre_del_curso}
-        Año: {anio}
-        Nivel: {nivel}
-        Objetivos: {objetivos_mejorados}
-        Perfil de ingreso: {perfil_ingreso}
-        Perfil de egreso: {perfil_egreso}
+        Curso: {curso["nombre_del_curso"]}
+        Año: {curso["anio"]}
+        Nivel: {curso["nivel"]}
+        Objetivos: {curso["objetivos"]}
+        Perfil de ingreso: {curso["perfil_ingreso"]}
+        Perfil de egreso: {curso["perfil_egreso"]}
         Outline:
-        {outline}
-        Devuelve únicamente el contenido para la sección: [{etiqueta}]
-        {instruccion}
+        {outline_markdown(outline)}
+        Devuelve un objeto JSON con estas secciones del syllabus:
+{instrucciones}
         """
-        respuesta = call_gemini(prompt)
-        return respuesta.strip()
-
-    generalidades = pedir_seccion("GENERALIDADES_DEL_PROGRAMA", "Redacta un párrafo breve que combine descripción general del curso, su objetivo y el perfil de egreso.")
-    ingreso = pedir_seccion("PERFIL_INGRESO", "Redacta un párrafo claro y directo del perfil de ingreso del estudiante.")
-    detalles = pedir_seccion("DETALLES_PLAN_ESTUDIOS", "Escribe la lista de la clases seleccionadas, cada una con título y una breve descripción, NO usar negritas en markdown.")
-
-    template_copy = drive_service.files().copy(
-        fileId=TEMPLATE_ID,
-        body={"name": f"Syllabus - {nombre_del_curso}"}
-    ).execute()
-    document_id = template_copy["id"]
-    # 🔐 Dar acceso a todo el dominio purpura.ai
-    drive_service.permissions().create(
-        fileId=document_id,
-        body={
-            "type": "domain",
-            "role": "writer",      # Usa "reader" si solo quieres lectura
-            "domain": "purpura.ai",
-            "allowFileDiscovery": True
-        },
-        fields="id"
-    ).execute()
-
-
-    replace_placeholder(document_id, "{{nombre_del_curso}}", nombre_del_curso)
-    replace_placeholder(document_id, "{{anio}}", str(anio))
-    replace_placeholder(document_id, "{{generalidades_del_programa}}", generalidades)
-    replace_placeholder(document_id, "{{perfil_ingreso}}", ingreso)
-    replace_placeholder(document_id, "{{detalles_plan_estudios}}", detalles)
-    replace_placeholder(document_id, "{{titulo_primer_objetivo_secundario}}", titulo1)
-    replace_placeholder(document_id, "{{descripcion_primer_objetivo_secundario}}", desc1)
-    replace_placeholder(document_id, "{{titulo_segundo_objetivo_secundario}}", titulo2)
-    replace_placeholder(document_id, "{{descripcion_segundo_objetivo_secundario}}", desc2)
-    replace_placeholder(document_id, "{{titulo_tercer_objetivo_secundario}}", titulo3)
-    replace_placeholder(document_id, "{{descripcion_tercer_objetivo_secundario}}", desc3)
+    secciones = call_gemini_json(prompt, _esquema_textos(*campos), regenerar=regenerar, tarea="secciones_syllabus")
+    return {campo: texto.strip() for campo, texto in secciones.items()}
+
+
+def datos_del_curso(nombre_del_curso, nivel, objetivos_mejorados, perfil_ingreso, perfil_egreso) -> dict:
+    # Lo que las secciones del syllabus necesitan saber del curso (también se guarda para corregirlas después)
+    return {
+        "nombre_del_curso": nombre_del_curso, "anio": ANIO, "nivel": nivel, "objetivos": objetivos_mejorados,
+        "perfil_ingreso": perfil_ingreso, "perfil_egreso": perfil_egreso,
+    }
+
+
+def obtener_datos_generales(nombre_del_curso, nivel, publico, student_persona, siguiente, objetivos_raw, num_clases,
+                            regenerar=False):
+    if regenerar:
+        # st.cache_data no permite invalidar una sola entrada
+        generar_datos_generales.clear()
+    return generar_datos_generales(
+        nombre_del_curso, nivel, publico, student_persona, siguiente, objetivos_raw, num_clases, regenerar
+    )
+
+
+@trazar()
+def generar_syllabus_completo(nombre_del_curso, nivel, objetivos_mejorados, publico, siguiente,
+                               perfil_ingreso, perfil_egreso, outline,
+                               titulo1, desc1, titulo2, desc2, titulo3, desc3, regenerar=False):
+    anio = ANIO
+    obtener_servicios()  # se resuelven en este hilo antes de repartir las etapas
+
+    # Lo que necesitan las secciones; se guarda con el documento para poder pedir una sola más adelante
+    curso = datos_del_curso(nombre_del_curso, nivel, objetivos_mejorados, perfil_ingreso, perfil_egreso)
+
+    def pedir_secciones():
+        # Las tres secciones salen de una sola llamada con salida estructurada
+        return pedir_secciones_syllabus(curso, outline, list(SECCIONES_SYLLABUS), regenerar)
+
+    def copiar_plantilla():
+        template_copy = ejecutar_google(get_drive_service().files().copy(
+            fileId=TEMPLATE_ID,
+            body={"name": f"Syllabus - {nombre_del_curso}"}
+        ))
+        return template_copy["id"]
+
+    def dar_permiso(document_id):
+        # 🔐 Dar acceso a todo el dominio purpura.ai
+        conceder_permisos_dominio([document_id], "purpura.ai", allow_file_discovery=True)
+        return document_id
+
+    def llenar_placeholders(document_id, secciones):
+        # Los 11 placeholders se reemplazan en un único batchUpdate
+        valores = valores_syllabus(nombre_del_curso, anio, secciones, titulo1, desc1, titulo2, desc2, titulo3, desc3)
+        reemplazar_placeholders(document_id, valores)
+        # 📌 Lo escrito en cada placeholder queda guardado: una sección se corrige después sin rehacer el curso
+        EstadoSyllabus.de_documento(document_id).actualizar(
+            document_id=document_id, valores=valores, curso=curso, filas=outline
+        )
+        return document_id
+
+    # ⚡ Las secciones de Gemini y la copia de la plantilla corren al mismo tiempo;
+    # los placeholders se llenan en cuanto todo lo anterior está listo.
+    resultados = ejecutar_etapas({
+        "secciones": (pedir_secciones, []),
+        "copia": (copiar_plantilla, []),
+        "permiso": (dar_permiso, ["copia"]),
+        "placeholders": (llenar_placeholders, ["permiso", "secciones"]),
+    })
+    document_id = resultados["placeholders"]
 
     return f"https://docs.google.com/document/d/{document_id}/edit"
 
 
+@trazar()
 def generar_outline_csv(nombre_del_curso, nivel, objetivos_mejorados, perfil_ingreso, siguiente, outline):
-    lines = [line.strip() for line in outline.splitlines() if "|" in line and not line.startswith("|---")]
-    df = pd.read_csv(io.StringIO("\n".join(lines)), sep="|", engine="python", skipinitialspace=True)
-    df = df.dropna(axis=1, how="all")
-    df.columns = [col.strip() for col in df.columns]
-
-    # 🔧 Limpieza robusta de datos antes de enviar
-    df = df.fillna("")
-    df = df.astype(str)
-    df = df.applymap(lambda x: re.sub(r"[\r\n\t]", " ", x))
-
-    sheet = sheets_service.spreadsheets().create(
-        body={"properties": {"title": f"Outline - {nombre_del_curso}"}},
-        fields="spreadsheetId"
-    ).execute()
-    spreadsheet_id = sheet["spreadsheetId"]
-   
-    drive_service.permissions().create(
-    fileId=spreadsheet_id,
-    body={
-        "type": "domain",
-        "role": "writer",
-        "domain": "purpura.ai",
-        "allowFileDiscovery": True
-    },
-    fields="id"
-    ).execute()
-
-    values = [df.columns.tolist()] + df.values.tolist()
-    sheets_service.spreadsheets().values().update(
-        spreadsheetId=spreadsheet_id,
-        range="A1",
-        valueInputOption="RAW",
-        body={"values": values}
-    ).execute()
+    # `outline` son las filas (encabezado incluido) que armó generar_datos_generales a partir del JSON
+    spreadsheet_id = crear_hoja_con_valores(f"Outline - {nombre_del_curso}", outline)
+    conceder_permisos_dominio([spreadsheet_id], "purpura.ai", allow_file_discovery=True)
 
     return f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}/edit"
 
+
+def sin_progreso(etapa=None, actual=None, total=None, link=None):
+    pass
+
+
+@trazar()
+def generar_syllabus_y_outline(nombre_del_curso, nivel, publico, student_persona, siguiente, objetivos_raw, num_clases,
+                               regenerar=False, progreso=sin_progreso):
+    obtener_servicios()  # se resuelven en este hilo antes de repartir las etapas
+    progreso("Generando datos generales del curso", 0, 3)
+    perfil_ingreso, objetivos_mejorados, perfil_egreso, outline, \
+    titulo1, desc1, titulo2, desc2, titulo3, desc3 = obtener_datos_generales(
+        nombre_del_curso, nivel, publico, student_persona, siguiente, objetivos_raw, num_clases, regenerar
+    )
+
+    progreso("Generando syllabus y outline", 1, 3)
+    # Las clases se devuelven para que la generación de clases no tenga que volver a leer
+    # la hoja recién escrita
+    clases = list(clases_desde_filas(outline))
+
+    def con_progreso(generar):
+        # Cada artefacto avisa en cuanto su link está listo
+        def etapa():
+            link = generar()
+            progreso(link=link)
+            return link
+        return etapa
+
+    # ⚡ El outline solo necesita los datos generales: se escribe mientras se arma el syllabus
+    resultados = ejecutar_etapas({
+        "syllabus": (con_progreso(lambda: generar_syllabus_completo(
+            nombre_del_curso, nivel, objetivos_mejorados, publico, siguiente,
+            perfil_ingreso, perfil_egreso, outline,
+            titulo1, desc1, titulo2, desc2, titulo3, desc3, regenerar
+        )), []),
+        "outline": (con_progreso(lambda: generar_outline_csv(
+            nombre_del_curso, nivel, objetivos_mejorados, perfil_ingreso, siguiente, outline
+        )), []),
+    })
+    EstadoSyllabus.de_documento(id_desde_link(resultados["syllabus"])).actualizar(
+        spreadsheet_id=id_desde_link(resultados["outline"])
+    )
+    progreso("Listo", 3, 3)
+    return resultados["syllabus"], resultados["outline"], clases
+
+
+# =========================
+# 🔁 CORRECCIONES EN SU LUGAR
+# =========================
+# Qué depende de qué: datos generales -> secciones -> syllabus; filas del outline -> plan de estudios
+# del syllabus y -> contenido de cada clase -> su rango en el documento de clases
+SECCIONES_QUE_DEPENDEN_DEL_OUTLINE = ["detalles_plan_estudios"]
+
+
+def id_desde_link(link: str) -> str:
+    match = re.search(r"/d/([a-zA-Z0-9-_]+)", link)
+    if not match:
+        raise ValueError(f"Link de Google no válido: {link}")
+    return match.group(1)
+
+
+def _fragmentos_de_texto(contenido: list):
+    # (índice inicial, texto) de cada textRun del cuerpo, incluidas las celdas de tablas
+    for elemento in contenido:
+        for fragmento in elemento.get("paragraph", {}).get("elements", []):
+            if "textRun" in fragmento:
+                yield fragmento["startIndex"], fragmento["textRun"]["content"]
+        for fila in elemento.get("table", {}).get("tableRows", []):
+            for celda in fila.get("tableCells", []):
+                yield from _fragmentos_de_texto(celda.get("content", []))
+        yield from _fragmentos_de_texto(elemento.get("tableOfContents", {}).get("content", []))
+
+
+def _ubicar_texto(documento: dict, texto: str):
+    """[inicio, fin) en unidades UTF-16 de la primera aparición de `texto`, o None."""
+    fragmentos = list(_fragmentos_de_texto(documento.get("body", {}).get("content", [])))
+    completo = "".join(contenido for _, contenido in fragmentos)
+    posicion = completo.find(texto)
+    if posicion < 0:
+        return None
+
+    def indice(desplazamiento, es_fin):
+        # En el borde entre dos fragmentos, un inicio cae en el siguiente y un fin en el anterior
+        for inicio, contenido in fragmentos:
+            if desplazamiento < len(contenido) or (es_fin and desplazamiento == len(contenido)):
+                return inicio + unidades_utf16(contenido[:desplazamiento])
+            desplazamiento -= len(contenido)
+        return None
+
+    inicio, fin = indice(posicion, False), indice(posicion + len(texto), True)
+    # Si el texto cruza un salto entre fragmentos no contiguos (p. ej. de una celda a otra), no es un rango
+    if inicio is None or fin is None or fin - inicio != unidades_utf16(texto):
+        return None
+    return inicio, fin
+
+
+def texto_en_rango(documento: dict, inicio: int, fin: int):
+    """Texto que ocupa [inicio, fin) (unidades UTF-16) en el cuerpo, o None si el rango no es texto continuo."""
+    partes = []
+    cubiertas = 0
+    for desde, contenido in _fragmentos_de_texto(documento.get("body", {}).get("content", [])):
+        datos = contenido.encode("utf-16-le")
+        hasta = desde + len(datos) // 2
+        if hasta <= inicio or desde >= fin:
+            continue
+        a, b = max(desde, inicio), min(hasta, fin)
+        partes.append((a, datos[(a - desde) * 2:(b - desde) * 2].decode("utf-16-le", errors="replace")))
+        cubiertas += b - a
+    # Un objeto incrustado, un salto de sección o una tabla ocupan índices sin textRun: el rango no es texto
+    if cubiertas != fin - inicio:
+        return None
+    return "".join(texto for _, texto in sorted(partes))
+
+
+def reescribir_textos(document_id: str, cambios: dict) -> list:
+    """Sustituye cada texto viejo por el nuevo en el documento; devuelve los que no se encontraron.
+
+    Primero un replaceAllText por texto; los que no coinciden (p. ej. un texto de varios párrafos)
+    se ubican leyendo el documento una vez y se reescriben por rango.
+    """
+    cambios = {viejo: nuevo for viejo, nuevo in cambios.items() if viejo and viejo != nuevo}
+    if not cambios:
+        return []
+    lote = LoteDocumento(document_id)
+    for viejo, nuevo in cambios.items():
+        lote.reemplazar(viejo, nuevo)
+    respuestas = lote.enviar().get("replies", [])
+    faltantes = [
+        viejo for viejo, respuesta in zip(cambios, respuestas)
+        if not respuesta.get("replaceAllText", {}).get("occurrencesChanged")
+    ]
+    if not faltantes:
+        return []
+
+    documento = ejecutar_google(get_docs_service().documents().get(documentId=document_id))
+    rangos = []
+    no_encontrados = []
+    for viejo in faltantes:
+        rango = _ubicar_texto(documento, viejo)
+        if rango:
+            rangos.append((rango, cambios[viejo]))
+        else:
+            no_encontrados.append(viejo)
+    # Del último rango al primero: así los índices de los anteriores siguen valiendo
+    for (inicio, fin), nuevo in sorted(rangos, key=lambda item: -item[0][0]):
+        lote.reemplazar_rango(inicio, fin, nuevo)
+    lote.enviar()
+    return no_encontrados
+
+
+@trazar()
+def regenerar_secciones_syllabus(link_syllabus: str, campos: list, outline: list = None) -> dict:
+    """Vuelve a pedir solo `campos` y los reescribe en el syllabus ya creado; devuelve las secciones nuevas."""
+    estado = EstadoSyllabus.de_documento(id_desde_link(link_syllabus))
+    if not estado.leer("document_id"):
+        raise ValueError("Este syllabus no se generó en este servidor: no hay registro de sus secciones")
+    if outline is None:
+        outline = estado.leer("filas")
+    secciones = pedir_secciones_syllabus(estado.leer("curso"), outline, campos, regenerar=True)
+
+    valores = estado.leer("valores")
+    nuevos = {f"{{{{{campo}}}}}": texto for campo, texto in secciones.items()}
+    no_encontrados = reescribir_textos(estado.leer("document_id"), {
+        valores.get(placeholder, ""): texto for placeholder, texto in nuevos.items()
+    })
+    if no_encontrados:
+        raise ValueError("No se encontró en el documento el texto anterior de una sección (¿se editó a mano?)")
+    estado.actualizar_valores(nuevos)
+    return secciones
+
+
+@trazar()
+def actualizar_outline(link_syllabus: str, filas: list, actualizar_syllabus: bool = True) -> list:
+    """Escribe en la hoja solo las filas del outline que cambiaron; devuelve los números de clase afectados.
+
+    Con `actualizar_syllabus`, también se regeneran las secciones del syllabus que dependen del outline.
+    El documento de clases se pone al día la próxima vez que se generen las clases: solo se rehacen
+    las clases cuya fila cambió.
+    """
+    estado = EstadoSyllabus.de_documento(id_desde_link(link_syllabus))
+    anteriores = estado.leer("filas")
+    if len(filas) != len(anteriores):
+        raise ValueError("Agregar o quitar clases cambia todo el curso: genera el syllabus y outline de nuevo")
+
+    cambiadas = [indice for indice, (fila, anterior) in enumerate(zip(filas, anteriores)) if fila != anterior]
+    if not cambiadas:
+        return []
+    # Rangos sin nombre de hoja: aplican a la primera, que es donde se escribió el outline
+    ejecutar_google(get_sheets_service().spreadsheets().values().batchUpdate(
+        spreadsheetId=estado.leer("spreadsheet_id"),
+        body={
+            "valueInputOption": "RAW",
+            "data": [{"range": f"A{indice + 1}", "values": [filas[indice]]} for indice in cambiadas],
+        },
+    ))
+    estado.actualizar(filas=filas)
+    if actualizar_syllabus:
+        regenerar_secciones_syllabus(link_syllabus, SECCIONES_QUE_DEPENDEN_DEL_OUTLINE, filas)
+    # La fila 0 es el encabezado: la fila i es la clase i
+    return [indice for indice in cambiadas if indice > 0]
+